@@ -1,13 +1,95 @@
+import functools
 import logging
+from queue import Queue
+from typing import Callable, List, Optional
 
-from telegram.ext import Updater
+import telegram
+from telegram import Update
+from telegram.ext import Updater, Dispatcher, JobQueue, ExtBot
+from telegram.utils.request import Request
 
-import handlers.handlers
+import handlers
+from utils.conversation_store import ConversationStore
+from utils.keyed_executor import KeyedExecutor
+
+
+class KeyedDispatcher(Dispatcher):
+    """
+    Dispatcher, that processes updates of different users in parallel on a `KeyedExecutor`.
+
+    Updates of a single user are still processed strictly in order,
+    which conversations and editing just published content rely on.
+    """
+
+    def __init__(self, bot: telegram.Bot, update_queue: Queue, executor: KeyedExecutor, **kwargs):
+        super().__init__(bot, update_queue, **kwargs)
+        self.executor = executor
+        # called once dispatcher has stopped taking updates, before workers stop (e.g. to submit pending work)
+        self.stop_callbacks: List[Callable[[], None]] = []
+
+    def start(self, ready=None) -> None:
+        self.executor.start()
+        super().start(ready)
+
+    def stop(self) -> None:
+        super().stop()
+        for callback in self.stop_callbacks:
+            callback()
+        # let workers finish updates that have already been taken from update queue
+        self.executor.shutdown()
+
+    def process_update(self, update: object) -> None:
+        if not isinstance(update, Update):
+            super().process_update(update)
+            return
+        # updates without user (e.g. channel posts) are keyed by chat
+        if update.effective_user is not None:
+            key = update.effective_user.id
+        elif update.effective_chat is not None:
+            key = update.effective_chat.id
+        else:
+            key = None
+        self.executor.submit(key, functools.partial(Dispatcher.process_update, self), update)
 
 
 class Bot:
-    def __init__(self, token):
-        self.updater = Updater(token)
+    def __init__(
+            self,
+            token,
+            workers: int = 0,
+            worker_queue_size: int = 100,
+            conversation_store: Optional[ConversationStore] = None,
+            conversation_flush_interval: float = 5.0,
+            request: Optional[Request] = None,
+    ):
+        """
+        :param token: bot token
+        :param workers: number of threads processing updates of different users in parallel,
+            `0` to process all updates on dispatcher thread
+        :param worker_queue_size: max number of updates waiting for a single worker
+        :param conversation_store: store of conversation state, if not given state is kept in memory only
+        :param conversation_flush_interval: time (in seconds) between persisting batches of changed conversation state
+        :param request: transport of Bot API requests, by default a pool of connections to Telegram
+        """
+        self.conversation_store = conversation_store or ConversationStore(None)
+        self.updater: Updater
+        # every worker may be sending a request at the same time
+        bot = ExtBot(token, request=request or Request(con_pool_size=workers + 8))
+        if workers > 0:
+            executor = KeyedExecutor(workers, worker_queue_size, name="handler_worker")
+            dispatcher = KeyedDispatcher(
+                bot, Queue(), executor, job_queue=JobQueue(), persistence=self.conversation_store
+            )
+            dispatcher.job_queue.set_dispatcher(dispatcher)
+            self.updater = Updater(dispatcher=dispatcher, workers=None)
+        else:
+            self.updater = Updater(bot=bot, persistence=self.conversation_store)
+        self.conversation_store.set_dispatcher(self.updater.dispatcher)
+        job_queue = self.updater.job_queue
+        job_queue.run_repeating(lambda _: self.conversation_store.flush(), interval=conversation_flush_interval)
+        job_queue.run_repeating(lambda _: self.conversation_store.evict(), interval=60)
+        # resolve auth status before any other handler
+        self.updater.dispatcher.add_handler(handlers.auth_middleware, group=-1)
         for handler in handlers.handlers:
             self.updater.dispatcher.add_handler(handler)
         logging.info(f"Registered a total of {len(handlers.handlers)} handlers.")
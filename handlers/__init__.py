@@ -1,7 +1,12 @@
-from .handlers import handlers
+from .handlers import handlers, auth_middleware
 
 from .start_handler import *
 from .timezone_handler import *
+from .export_handler import *
+from .read_handler import *
+from .search_handler import *
+from .stats_handler import *
+from .import_handler import *
 
 # INFO: has to come last!!
 from handlers.content import *
@@ -7,15 +7,17 @@ from telegram import Update
 from telegram.ext import CallbackContext, ConversationHandler, CommandHandler, RegexHandler
 
 from handlers import cancel, register_protected_handler
+from handlers.misc import conversation_timeout
 from strings import Strings
 from utils.content_utils import ContentEnums, save_message_content_by_date, get_content_message_handler
+from utils.outbox import Outbox
 
 
 def time_selection(update: Update, _: CallbackContext):
     """
     Ask user for their desired date to be associated with content
     """
-    update.effective_message.reply_text(Strings.please_enter_date)
+    Outbox.reply(update.effective_message, Strings.please_enter_date)
     return ContentEnums.AWAITING_DATE
 
 
@@ -31,7 +33,7 @@ def date_entering(update: Update, context: CallbackContext):
         _ = datetime.date.fromisoformat(date_str)
     except ValueError as e:
         # if failed to create `date`, reply with failed
-        update.effective_message.reply_text(Strings.try_again_check_validity)
+        Outbox.reply(update.effective_message, Strings.try_again_check_validity)
         # log client error
         logging.debug(e.__str__())
         # prompt to try again
@@ -39,7 +41,7 @@ def date_entering(update: Update, context: CallbackContext):
     # save user input for the next step
     context.user_data["custom_date"] = date_str
     # prompt to enter diary content
-    update.effective_message.reply_text(Strings.please_enter_content)
+    Outbox.reply(update.effective_message, Strings.please_enter_content)
     return ContentEnums.AWAITING_CONTENT
 
 
@@ -51,7 +53,7 @@ def custom_date_content_handler(update: Update, context: CallbackContext):
     ud: Optional[dict] = context.user_data
     if ud is None or "custom_date" not in ud:
         # if not, something went very wrong
-        update.effective_message.reply_text(Strings.server_error_and_cancelled)
+        Outbox.reply(update.effective_message, Strings.server_error_and_cancelled)
         # log error
         logging.error("No custom_date in user data!")
         return ConversationHandler.END
@@ -73,6 +75,9 @@ custom_date_conv_handler = ConversationHandler(
         ],
     },
     fallbacks=[CommandHandler("cancel", cancel)],
+    conversation_timeout=conversation_timeout,
+    name="custom_date",
+    persistent=True,
 )
 
 register_protected_handler(custom_date_conv_handler)
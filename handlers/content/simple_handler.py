@@ -1,46 +1,117 @@
-from telegram import Update, ReplyKeyboardMarkup, Message
+from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import CallbackContext, ConversationHandler, MessageHandler, Filters, CommandHandler
 
 from handlers import register_protected_handler, cancel
+from handlers.misc import conversation_timeout
 from strings import Strings
 from utils import Dao
 from utils.content_utils import ContentEnums, get_content_update_handler, get_content_message_handler
+from utils.message_snapshot import snapshot_message, restore_message
+from utils.outbox import Outbox, Priority
+
+# time (in seconds) parts of an album are collected for, before confirmation is asked once for all of them
+album_window = 1.0
+
+
+def confirmation_keyboard() -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup([[Strings.Yes, Strings.No]], one_time_keyboard=True)
+
+
+def album_confirmation_job_name(user_id: int) -> str:
+    return f"album_confirmation_{user_id}"
 
 
 def content_confirmation(update: Update, context: CallbackContext):
+    # keep a compact reference instead of the whole message
     context.user_data[
         "content_awaiting_confirmation"
-    ] = update.effective_message.to_dict()
+    ] = snapshot_message(update.effective_message)
+
+    if update.effective_message.media_group_id is not None:
+        # further parts of album are collected by `album_part`, confirmation is asked once they all have arrived
+        context.user_data["album_awaiting_confirmation"] = []
+        schedule_album_confirmation(update, context)
+        return ContentEnums.AWAITING_CONFIRMATION
 
     message_id = update.effective_message.message_id
-    keyboard = [[Strings.Yes, Strings.No]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
-    update.effective_message.reply_text(
-        Strings.confirm_save, reply_markup=reply_markup, reply_to_message_id=message_id
+    Outbox.reply(
+        update.effective_message,
+        Strings.confirm_save,
+        reply_markup=confirmation_keyboard(),
+        reply_to_message_id=message_id,
     )
     return ContentEnums.AWAITING_CONFIRMATION
 
 
+def album_part(update: Update, context: CallbackContext):
+    """
+    Collects a further part of album awaiting confirmation
+    """
+    message = update.effective_message
+    awaiting = context.user_data.get("content_awaiting_confirmation")
+    if awaiting is None or message.media_group_id is None or awaiting.get("media_group_id") != message.media_group_id:
+        # not a part of the album, ignored as any other content while awaiting confirmation
+        return None
+    context.user_data["album_awaiting_confirmation"].append(snapshot_message(message))
+    schedule_album_confirmation(update, context)
+    return None
+
+
+def schedule_album_confirmation(update: Update, context: CallbackContext) -> None:
+    """
+    (Re)schedules confirmation of album, so that it is asked once no part has arrived for `album_window`
+    """
+    name = album_confirmation_job_name(update.effective_user.id)
+    for job in context.job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    first_message_id = context.user_data["content_awaiting_confirmation"]["message_id"]
+    context.job_queue.run_once(
+        ask_album_confirmation, album_window, context=(update.effective_chat.id, first_message_id), name=name
+    )
+
+
+def ask_album_confirmation(context: CallbackContext) -> None:
+    chat_id, first_message_id = context.job.context
+    Outbox.send_message(
+        context.bot,
+        chat_id,
+        Strings.confirm_save,
+        priority=Priority.INTERACTIVE,
+        reply_markup=confirmation_keyboard(),
+        reply_to_message_id=first_message_id,
+    )
+
+
 def content_handler_with_confirmation(update: Update, context: CallbackContext):
+    # confirmation of album may not have been asked yet
+    for job in context.job_queue.get_jobs_by_name(album_confirmation_job_name(update.effective_user.id)):
+        job.schedule_removal()
+    album = context.user_data.pop("album_awaiting_confirmation", None)
     answer = update.effective_message.text
     if answer != Strings.Yes:
-        update.effective_message.reply_text(Strings.cancelled)
+        context.user_data.pop("content_awaiting_confirmation", None)
+        Outbox.reply(update.effective_message, Strings.cancelled)
         return ConversationHandler.END
-    obj = context.user_data["content_awaiting_confirmation"]
+    obj = context.user_data.pop("content_awaiting_confirmation")
 
     # get user timezone
     user_timezone = Dao.get_user_timezone(update.effective_user)
     # get content message from context
-    message = Message.de_json(obj, context.bot)
+    message = restore_message(obj, context.bot, update.effective_user)
     # calculate time at user's
     user_datetime = message.date.astimezone(user_timezone)
-    # publish
-    Dao.publish(
-        update.effective_user, user_datetime, message
-    )
+    # publish, wait until it is written
+    if album:
+        # whole album is a single entry
+        parts = [restore_message(part, context.bot, update.effective_user) for part in album]
+        Dao.publish_album(update.effective_user, user_datetime, [message] + parts).result()
+    else:
+        Dao.publish(
+            update.effective_user, user_datetime, message
+        ).result()
     # answer user
-    update.effective_message.reply_text(
-        Strings.published(user_datetime), reply_to_message_id=message.message_id
+    Outbox.reply(
+        update.effective_message, Strings.published(user_datetime), reply_to_message_id=message.message_id
     )
     return ConversationHandler.END
 
@@ -51,9 +122,13 @@ register_protected_handler(
         entry_points=[get_content_message_handler(content_confirmation)],
         states={
             ContentEnums.AWAITING_CONFIRMATION: [
-                MessageHandler(Filters.text, content_handler_with_confirmation)
+                MessageHandler(Filters.update.message & (Filters.photo | Filters.document), album_part),
+                MessageHandler(Filters.text, content_handler_with_confirmation),
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=conversation_timeout,
+        name="content_confirmation",
+        persistent=True,
     )
 )
@@ -1,16 +1,74 @@
+import threading
+from typing import Dict, Tuple
+
 from telegram import Update
-from telegram.ext import CallbackContext
+from telegram.ext import CallbackContext, Dispatcher
 
 from handlers import register_protected_handler
 from strings import Strings
 from utils import Dao
 from utils.content_utils import get_content_update_handler
+from utils.outbox import Outbox
+
+# time (in seconds) within which successive edits of a message are collapsed into a single write
+edit_debounce = 2.0
 
+# (user id, message id) -> latest edit, waiting to be saved
+pending_edits: Dict[Tuple[int, int], Update] = {}
+pending_edits_lock = threading.Lock()
 
-def update_handler(update: Update, _: CallbackContext):
+
+def save_edit(update: Update) -> None:
     has_been_updated = Dao.update_message(update.effective_user, update.effective_message)
     if has_been_updated:
-        update.effective_message.reply_text(Strings.updated, reply_to_message_id=update.effective_message.message_id)
+        Outbox.reply(update.effective_message, Strings.updated, reply_to_message_id=update.effective_message.message_id)
+
+
+def save_pending_edit(key: Tuple[int, int]) -> None:
+    with pending_edits_lock:
+        update = pending_edits.pop(key, None)
+    # may have been saved by `flush_pending_edits` already
+    if update is not None:
+        save_edit(update)
+
+
+def submit_pending_edit(dispatcher: Dispatcher, key: Tuple[int, int]) -> None:
+    """
+    Saves pending edit on the worker of its user (if dispatcher has workers), so that it is written in order with
+    other writes of the user
+    """
+    executor = getattr(dispatcher, "executor", None)
+    if executor is not None:
+        executor.submit(key[0], save_pending_edit, key)
+    else:
+        save_pending_edit(key)
+
+
+def on_debounced(context: CallbackContext) -> None:
+    submit_pending_edit(context.dispatcher, context.job.context)
+
+
+def flush_pending_edits(dispatcher: Dispatcher) -> None:
+    """
+    Saves edits still waiting for debounce, called on shutdown before workers stop
+    """
+    with pending_edits_lock:
+        keys = list(pending_edits)
+    for key in keys:
+        submit_pending_edit(dispatcher, key)
+
+
+def update_handler(update: Update, context: CallbackContext):
+    """
+    Saves edit of diary content once message has not been edited for `edit_debounce`
+    """
+    key = (update.effective_user.id, update.effective_message.message_id)
+    with pending_edits_lock:
+        is_scheduled = key in pending_edits
+        # only the latest edit is saved
+        pending_edits[key] = update
+    if not is_scheduled:
+        context.job_queue.run_once(on_debounced, edit_debounce, context=key)
 
 
 register_protected_handler(get_content_update_handler(update_handler))
@@ -4,6 +4,7 @@ from telegram import Update
 from telegram.ext import CallbackContext, ConversationHandler, CommandHandler
 
 from handlers import cancel, register_protected_handler
+from handlers.misc import conversation_timeout
 from utils import Dao
 from utils.content_utils import save_message_content_by_date, prompt_content_input, get_content_message_handler, \
     ContentEnums
@@ -33,6 +34,9 @@ yesterday_conv_handler = ConversationHandler(
         ]
     },
     fallbacks=[CommandHandler("cancel", cancel)],
+    conversation_timeout=conversation_timeout,
+    name="yesterday",
+    persistent=True,
 )
 
 register_protected_handler(yesterday_conv_handler)
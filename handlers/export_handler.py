@@ -0,0 +1,61 @@
+"""
+Handler for exporting user diary as a zip archive.
+"""
+import datetime
+import functools
+import logging
+import os
+
+from telegram import Update
+from telegram.ext import CallbackContext, CommandHandler
+
+from handlers.handlers import register_protected_handler
+from strings import Strings
+from utils.dao import Dao
+from utils.export import Exporter, write_export
+from utils.outbox import Outbox, Priority
+
+# max size of a document sent by bot
+max_document_size = 50 << 20
+
+
+def export_handler(update: Update, context: CallbackContext):
+    """
+    Starts export of user diary in background, archive is sent once written
+    """
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+
+    def send_archive(path: str) -> None:
+        # file is opened by every attempt, as retried sends would read on from where the failed one has stopped
+        with open(path, "rb") as document:
+            context.bot.send_document(
+                chat_id,
+                document,
+                filename=f"libreta-{datetime.date.today().isoformat()}.zip",
+                caption=Strings.export_caption,
+            )
+
+    def export(path: str) -> None:
+        try:
+            count = write_export(Dao.iter_entries(user, page_size=Exporter.page_size), path)
+            if count == 0:
+                Outbox.send_message(context.bot, chat_id, Strings.export_empty)
+            elif os.path.getsize(path) > max_document_size:
+                Outbox.send_message(context.bot, chat_id, Strings.export_too_large)
+            else:
+                # archive is removed once export returns
+                Outbox.submit(chat_id, functools.partial(send_archive, path), Priority.BACKGROUND).result()
+        except Exception as e:
+            logging.error(f"Export of user {user.id} has failed: {e}")
+            Outbox.send_message(context.bot, chat_id, Strings.server_error_and_cancelled)
+
+    if Exporter.is_running(user.id):
+        Outbox.reply(update.effective_message, Strings.export_in_progress)
+    elif Exporter.try_start(user.id, export):
+        Outbox.reply(update.effective_message, Strings.export_started)
+    else:
+        Outbox.reply(update.effective_message, Strings.export_busy)
+
+
+register_protected_handler(CommandHandler("export", export_handler))
@@ -1,19 +1,49 @@
+import functools
 from typing import List
 
 from telegram import Update
-from telegram.ext import Handler, CallbackContext, ConversationHandler
+from telegram.ext import Handler, CallbackContext, ConversationHandler, TypeHandler
 
 from strings import Strings
 from utils.dao import Dao
+from utils.metrics import instrument_handler_callback
+from utils.outbox import Outbox
 
 handlers: List[Handler] = []
 
 
+def resolve_auth(update: Update, context: CallbackContext):
+    """
+    Pre-dispatch middleware. Resolves auth status of update sender once per update,
+    so that protected handlers do not have to query it themselves.
+    """
+    context.is_authorized = Dao.is_user_authorized(update.effective_user)
+
+
+# has to be added to a group that precedes all other handlers, as `CallbackContext` is shared between groups
+auth_middleware = TypeHandler(Update, resolve_auth)
+
+
+def instrument_handler(handler: Handler) -> Handler:
+    """
+    Makes calls of handler (or of every handler of a conversation) be recorded in metrics, by callback name
+    """
+    if isinstance(handler, ConversationHandler):
+        nested = handler.entry_points + handler.fallbacks
+        for state_handlers in handler.states.values():
+            nested += state_handlers
+        for nested_handler in nested:
+            instrument_handler(nested_handler)
+    else:
+        handler.callback = instrument_handler_callback(handler.callback.__name__, handler.callback)
+    return handler
+
+
 def register_unprotected_handler(handler: Handler):
     """
     Adds given handler to `Bot`
     """
-    handlers.append(handler)
+    handlers.append(instrument_handler(handler))
 
 
 def add_authguard_to_handler(handler: Handler) -> Handler:
@@ -50,15 +80,20 @@ def add_authguard_to_handler(handler: Handler) -> Handler:
         # get default callback
         callback = handler.callback
 
-        # custom callback
+        # custom callback, named after the default one
+        @functools.wraps(callback)
         def auth_guard_callback(update: Update, context: CallbackContext):
-            # check user auth status
-            if Dao.is_user_authorized(update.effective_user):
+            # get user auth status, as resolved by `auth_middleware`
+            is_authorized = getattr(context, "is_authorized", None)
+            if is_authorized is None:
+                # middleware has not been run (e.g. handler is used outside of `Bot`)
+                is_authorized = Dao.is_user_authorized(update.effective_user)
+            if is_authorized:
                 # if authenticated, continue execution
                 return callback(update, context)
-            else:
-                # if not authenticated, reply with failed
-                update.effective_message.reply_text(Strings.unauthenticated)
+            elif update.effective_message is not None:
+                # if not authenticated, reply with failed (inline queries have no message to reply to)
+                Outbox.reply(update.effective_message, Strings.unauthenticated)
 
         # apply custom callback
         handler.callback = auth_guard_callback
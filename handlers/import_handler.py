@@ -0,0 +1,74 @@
+"""
+Handler for `/import`: imports a diary kept elsewhere, sent as a document, see `utils.importer`.
+"""
+from enum import Enum, auto
+
+from telegram import Update
+from telegram.ext import CallbackContext, CommandHandler, ConversationHandler, Filters, MessageHandler
+
+from handlers.handlers import register_protected_handler
+from handlers.misc import cancel, conversation_timeout
+from strings import Strings
+from utils.dao import Dao
+from utils.importer import Importer
+from utils.outbox import Outbox
+
+# max size of a file downloaded by bot
+max_download_size = 20 << 20
+
+
+class ImportStates(Enum):
+    AWAITING_FILE = auto()
+
+
+def import_handler(update: Update, _: CallbackContext):
+    """
+    Asks user for the file to be imported
+    """
+    if Importer.is_running(update.effective_user.id):
+        Outbox.reply(update.effective_message, Strings.import_in_progress)
+        return ConversationHandler.END
+    Outbox.reply(update.effective_message, Strings.import_usage)
+    return ImportStates.AWAITING_FILE
+
+
+def import_file(update: Update, context: CallbackContext):
+    """
+    Starts import of the sent document in background, messages are dated by user's timezone
+    """
+    user = update.effective_user
+    document = update.effective_message.document
+    if document.file_size is not None and document.file_size > max_download_size:
+        Outbox.reply(update.effective_message, Strings.import_too_large)
+        return ConversationHandler.END
+    tz_name = str(Dao.get_user_timezone(user))
+    if Importer.try_start(context.bot, user.id, tz_name, document.file_id):
+        Outbox.reply(update.effective_message, Strings.import_started)
+    else:
+        Outbox.reply(update.effective_message, Strings.import_busy)
+    return ConversationHandler.END
+
+
+def not_import_file(update: Update, _: CallbackContext):
+    """
+    Keeps waiting for a document, so that other messages are not taken for diary content meanwhile
+    """
+    Outbox.reply(update.effective_message, Strings.import_usage)
+    return None
+
+
+register_protected_handler(
+    ConversationHandler(
+        entry_points=[CommandHandler("import", import_handler)],
+        states={
+            ImportStates.AWAITING_FILE: [
+                MessageHandler(Filters.update.message & Filters.document, import_file),
+                MessageHandler(Filters.update.message & ~Filters.command, not_import_file),
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=conversation_timeout,
+        name="import",
+        persistent=True,
+    )
+)
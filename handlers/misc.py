@@ -1,7 +1,13 @@
+from typing import Optional
+
 from telegram import Update
 from telegram.ext import CallbackContext, ConversationHandler
 
 from strings import Strings
+from utils.outbox import Outbox
+
+# time (in seconds) after which an abandoned conversation is ended
+conversation_timeout = 30 * 60
 
 
 def cancel(update: Update, _: CallbackContext):
@@ -9,7 +15,21 @@ def cancel(update: Update, _: CallbackContext):
     Simple cancel handler
     """
     # reply and hide any current keyboard
-    update.effective_message.reply_text(
-        Strings.cancelled, reply_markup={"remove_keyboard": True}
+    Outbox.reply(
+        update.effective_message, Strings.cancelled, reply_markup={"remove_keyboard": True}
     )
     return ConversationHandler.END
+
+
+def set_conversation_state(name: str, update: Update, context: CallbackContext, state: Optional[object]) -> None:
+    """
+    Moves (persistent) conversation of update's chat and user to given state, from a handler outside of it,
+    e.g. of buttons of an inline keyboard, as callback queries are not tracked by per-chat conversations
+
+    :param name: name of conversation
+    :param state: new state, `ConversationHandler.END` (or `None`) to end conversation
+    """
+    # conversations are keyed by (chat id, user id), persistence shares its dict with `ConversationHandler`
+    key = (update.effective_chat.id, update.effective_user.id)
+    new_state = None if state == ConversationHandler.END else state
+    context.dispatcher.persistence.update_conversation(name, key, new_state)
@@ -0,0 +1,148 @@
+"""
+Handlers for reading diary back: `/day`, `/week` and `/month`.
+
+Pages are planned from month index (number of entries by date), so only entries of the shown page are read from db.
+Further pages are loaded on demand by inline buttons.
+"""
+import datetime
+import functools
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import CallbackContext, CommandHandler, CallbackQueryHandler
+
+from handlers.handlers import register_protected_handler
+from strings import Strings
+from utils import entry_schema
+from utils.dao import Dao
+from utils.outbox import Outbox
+
+entries_per_page = 10
+# max length of a telegram message
+max_message_length = 4096
+
+# first entry of a page, as (ISO date, number of entries of that date on previous pages)
+PageStart = Tuple[str, int]
+
+
+def plan_pages(counts: Dict[str, int]) -> List[PageStart]:
+    """
+    Splits entries into pages of `entries_per_page`, using only their counts by date
+
+    :param counts: ISO date -> number of entries, in date order
+    :return: first entry of every page
+    """
+    pages: List[PageStart] = []
+    position = 0
+    for date, count in counts.items():
+        for offset in range(count):
+            if position % entries_per_page == 0:
+                pages.append((date, offset))
+            position += 1
+    return pages
+
+
+def parse_window(command: str, args: List[str], today: datetime.date) -> Optional[Tuple[datetime.date, datetime.date]]:
+    """
+    :param command: `day`, `week` or `month`
+    :param args: command arguments, optionally a date (`YYYY-MM-DD`, or `YYYY-MM` for month)
+    :param today: today at user's
+    :return: first and last date (inclusive), `None` if arguments are invalid
+    """
+    try:
+        if command == "month":
+            first = datetime.datetime.strptime(args[0], "%Y-%m").date() if args else today.replace(day=1)
+            next_month = (first + datetime.timedelta(days=31)).replace(day=1)
+            return first, next_month - datetime.timedelta(days=1)
+        day = datetime.date.fromisoformat(args[0]) if args else today
+    except ValueError:
+        return None
+    if command == "week":
+        # the week up to (and including) given day
+        return day - datetime.timedelta(days=6), day
+    return day, day
+
+
+def render_page(
+        update: Update, start_date: datetime.date, end_date: datetime.date, page: int
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """
+    Reads entries of a single page
+
+    :return: text of page and navigation buttons
+    """
+    user = update.effective_user
+    counts = Dao.get_entry_counts(user, start_date, end_date)
+    pages = plan_pages(counts)
+    if not pages:
+        return Strings.nothing_to_read, None
+    page = min(max(page, 0), len(pages) - 1)
+    first_date, skip = pages[page]
+    # last date of page, so that no entries beyond the page are read
+    dates = list(counts)
+    last_date = dates[-1]
+    if page + 1 < len(pages):
+        next_date, next_skip = pages[page + 1]
+        last_date = next_date if next_skip > 0 else dates[dates.index(next_date) - 1]
+
+    lines = [Strings.reading_page(start_date, end_date, page + 1, len(pages))]
+    shown = 0
+    current_date: Optional[str] = None
+    entries = Dao.iter_entries(
+        user, datetime.date.fromisoformat(first_date), datetime.date.fromisoformat(last_date), page_size=7
+    )
+    for entry in entries:
+        if entry.date == first_date and skip > 0:
+            skip -= 1
+            continue
+        if shown == entries_per_page:
+            break
+        if entry.date != current_date:
+            lines.append(f"\n{entry.date}")
+            current_date = entry.date
+        lines.append(entry_schema.entry_text(entry.content))
+        shown += 1
+    text = "\n".join(lines)
+    if len(text) > max_message_length:
+        text = text[:max_message_length - 1] + "…"
+
+    buttons = []
+    window = f"{start_date.isoformat()}:{end_date.isoformat()}"
+    if page > 0:
+        buttons.append(InlineKeyboardButton(Strings.previous_page, callback_data=f"read:{window}:{page - 1}"))
+    if page + 1 < len(pages):
+        buttons.append(InlineKeyboardButton(Strings.next_page, callback_data=f"read:{window}:{page + 1}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def read_handler(update: Update, context: CallbackContext):
+    """
+    Shows first page of entries of requested day, week or month
+    """
+    command = update.effective_message.text.split()[0].lstrip("/").split("@")[0]
+    today = datetime.datetime.now(Dao.get_user_timezone(update.effective_user)).date()
+    window = parse_window(command, context.args, today)
+    if window is None:
+        Outbox.reply(update.effective_message, Strings.try_again_check_validity)
+        return
+    text, reply_markup = render_page(update, window[0], window[1], 0)
+    Outbox.reply(update.effective_message, text, reply_markup=reply_markup)
+
+
+def read_page_handler(update: Update, _: CallbackContext):
+    """
+    Replaces shown page with the one requested by a navigation button
+    """
+    query = update.callback_query
+    _, start, end, page = query.data.split(":")
+    text, reply_markup = render_page(
+        update, datetime.date.fromisoformat(start), datetime.date.fromisoformat(end), int(page)
+    )
+    query.answer()
+    Outbox.submit(
+        update.effective_chat.id, functools.partial(query.edit_message_text, text, reply_markup=reply_markup)
+    )
+
+
+register_protected_handler(CommandHandler(["day", "week", "month"], read_handler))
+register_protected_handler(CallbackQueryHandler(read_page_handler, pattern=r"^read:"))
@@ -0,0 +1,79 @@
+"""
+Handlers for full-text search: `/search words` and inline queries (`@bot words`, inline mode has to be enabled
+for the bot by BotFather).
+
+Both are answered from search index, only the entries that are shown are read from db.
+"""
+import functools
+
+from telegram import Update, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import CallbackContext, CommandHandler, InlineQueryHandler
+
+from handlers.handlers import register_protected_handler
+from handlers.read_handler import max_message_length
+from strings import Strings
+from utils import entry_schema
+from utils.dao import Dao
+from utils.outbox import Outbox
+from utils.search_index import tokenize
+
+results_per_search = 10
+results_per_inline_query = 20
+# max length of entry text shown in a result
+max_snippet_length = 300
+
+
+def snippet(text: str) -> str:
+    return text if len(text) <= max_snippet_length else text[:max_snippet_length - 1] + "…"
+
+
+def search_handler(update: Update, context: CallbackContext):
+    """
+    Shows latest entries containing all words given to the command
+    """
+    query = " ".join(context.args)
+    if not tokenize(query):
+        Outbox.reply(update.effective_message, Strings.search_usage)
+        return
+    total, entries = Dao.search(update.effective_user, query, results_per_search)
+    if not entries:
+        Outbox.reply(update.effective_message, Strings.nothing_found)
+        return
+    lines = [Strings.search_results(len(entries), total)]
+    for entry in entries:
+        lines.append(f"\n{entry.date}")
+        lines.append(snippet(entry_schema.entry_text(entry.content)))
+    text = "\n".join(lines)
+    if len(text) > max_message_length:
+        text = text[:max_message_length - 1] + "…"
+    Outbox.reply(update.effective_message, text)
+
+
+def inline_search_handler(update: Update, _: CallbackContext):
+    """
+    Answers inline query with matching entries, paged by offset as user scrolls
+    """
+    inline_query = update.inline_query
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    total, entries = 0, []
+    if tokenize(inline_query.query):
+        total, entries = Dao.search(update.effective_user, inline_query.query, results_per_inline_query, offset)
+    results = []
+    for entry in entries:
+        text = entry_schema.entry_text(entry.content)
+        results.append(InlineQueryResultArticle(
+            id=f"{entry.date}:{entry.message_id}",
+            title=entry.date,
+            description=snippet(text),
+            input_message_content=InputTextMessageContent(text[:max_message_length]),
+        ))
+    next_offset = str(offset + len(entries)) if offset + len(entries) < total else ""
+    # results are personal and change with every entry, so they are not cached by telegram
+    answer = functools.partial(
+        inline_query.answer, results, cache_time=0, is_personal=True, next_offset=next_offset
+    )
+    Outbox.submit(update.effective_user.id, answer)
+
+
+register_protected_handler(CommandHandler("search", search_handler))
+register_protected_handler(InlineQueryHandler(inline_search_handler))
@@ -3,10 +3,11 @@ from telegram.ext import CallbackContext, CommandHandler
 
 from handlers.handlers import register_unprotected_handler
 from strings import Strings
+from utils.outbox import Outbox
 
 
 def start_handler(update: Update, _: CallbackContext):
-    update.effective_message.reply_text(Strings.start)
+    Outbox.reply(update.effective_message, Strings.start)
 
 
 register_unprotected_handler(CommandHandler("start", start_handler))
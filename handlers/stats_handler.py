@@ -0,0 +1,28 @@
+"""
+Handler for `/stats`: number of entries, days written, streaks and entries of recent months.
+"""
+import datetime
+
+from telegram import Update
+from telegram.ext import CallbackContext, CommandHandler
+
+from handlers.handlers import register_protected_handler
+from strings import Strings
+from utils.dao import Dao
+from utils.outbox import Outbox
+
+
+def stats_handler(update: Update, _: CallbackContext):
+    """
+    Shows writing statistics of user, read at once from aggregates
+    """
+    user = update.effective_user
+    today = datetime.datetime.now(Dao.get_user_timezone(user)).date()
+    stats = Dao.get_stats(user, today)
+    if stats.entries == 0:
+        Outbox.reply(update.effective_message, Strings.no_stats)
+        return
+    Outbox.reply(update.effective_message, Strings.stats(stats))
+
+
+register_protected_handler(CommandHandler("stats", stats_handler))
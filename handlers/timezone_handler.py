@@ -2,41 +2,96 @@
 Handler for specifying user timezone.
 
 User timezone in turn is needed to figure out, what day user is sending content for.
+Timezone is either resolved from a shared location, or selected by continent and city.
 """
+import functools
 from enum import Enum, auto
-from typing import List, Dict
+from typing import List, Optional
 
-import pytz
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     CallbackContext,
     ConversationHandler,
     CommandHandler,
+    CallbackQueryHandler,
+    MessageHandler,
     RegexHandler,
+    Filters,
 )
 
 from handlers.handlers import register_protected_handler
-from handlers.misc import cancel
+from handlers.misc import cancel, conversation_timeout, set_conversation_state
 from strings import Strings
-from utils.dao import Dao
-
-# parse timezones
-
-# get common timezones
-timezones = pytz.common_timezones
-# group by continent
-structured_timezones: Dict[str, List[str]] = {}
-for tz in timezones:
-    # skip UTC, GMT etc, as they are not geographical places
-    if "/" not in tz:
-        continue
-    #  parse into continent and city
-    #  `maxsplit` is needed as timezones with three parts exist,
-    #  e.g. `America/Kentucky/Louisville`
-    cont, city = tz.split("/", maxsplit=1)
-    # save to dict
-    structured_timezones.setdefault(cont, [])
-    structured_timezones[cont].append(city)
+from utils import timezones
+from utils.dao import Dao, get_zone
+from utils.outbox import Outbox
+from utils.reminders import Reminders
+
+# layout of a page of city keyboard
+city_columns = 3
+city_rows = 6
+# max length of a city name prefix, so that it fits into callback data
+max_prefix_length = 16
+
+
+@functools.lru_cache(maxsize=None)
+def continent_keyboard() -> ReplyKeyboardMarkup:
+    """
+    Keyboard of continents with a button sharing location, built once
+    """
+    continents = [KeyboardButton(continent) for continent in timezones.get_tables().cities_by_continent]
+    keyboard = [[KeyboardButton(Strings.share_location, request_location=True)]]
+    keyboard += [continents[i:i + city_columns] for i in range(0, len(continents), city_columns)]
+    return ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+
+
+def normalize_city(city: str) -> str:
+    """
+    Makes city comparable to user input, e.g. `Argentina/Buenos_Aires` -> `argentina/buenos aires`
+    """
+    return city.replace("_", " ").lower()
+
+
+def matching_cities(continent: str, prefix: str) -> List[str]:
+    """
+    :return: cities of continent, whose name (or name of its last part, e.g. `Louisville` of `Kentucky/Louisville`)
+        starts with prefix
+    """
+    prefix = normalize_city(prefix)
+    return [
+        city for city in timezones.get_tables().cities_by_continent[continent]
+        if normalize_city(city).startswith(prefix) or normalize_city(city).rsplit("/", 1)[-1].startswith(prefix)
+    ]
+
+
+@functools.lru_cache(maxsize=1024)
+def city_keyboard(continent: str, prefix: str = "", page: int = 0) -> Optional[InlineKeyboardMarkup]:
+    """
+    Single page of inline keyboard of cities, cached per (continent, prefix, page)
+
+    :return: keyboard, `None` if no city matches prefix
+    """
+    cities = matching_cities(continent, prefix)
+    if not cities:
+        return None
+    page_size = city_columns * city_rows
+    buttons = [
+        InlineKeyboardButton(city.replace("_", " "), callback_data=f"tz:set:{continent}/{city}")
+        for city in cities[page * page_size:(page + 1) * page_size]
+    ]
+    keyboard = [buttons[i:i + city_columns] for i in range(0, len(buttons), city_columns)]
+    navigation = []
+    if page > 0:
+        navigation.append(
+            InlineKeyboardButton(Strings.previous_page, callback_data=f"tz:page:{continent}:{prefix}:{page - 1}")
+        )
+    if (page + 1) * page_size < len(cities):
+        navigation.append(
+            InlineKeyboardButton(Strings.next_page, callback_data=f"tz:page:{continent}:{prefix}:{page + 1}")
+        )
+    if navigation:
+        keyboard.append(navigation)
+    return InlineKeyboardMarkup(keyboard)
 
 
 class TimezoneStates(Enum):
@@ -50,20 +105,38 @@ class TimezoneStates(Enum):
 
 def continent_select(update: Update, _: CallbackContext):
     """
-    Prompts user to select their continent (or similar, e.g. US or India) using a keyboard.
+    Prompts user to share location, or to select their continent (or similar, e.g. US or India) using a keyboard.
     """
-    # init keyboard
-    keyboard = [
-        [KeyboardButton(continent)] for continent in sorted(structured_timezones.keys())
-    ]
     # reply to user
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
-    update.message.reply_text(
-        Strings.timezone_select, reply_markup=reply_markup
+    Outbox.reply(
+        update.effective_message, Strings.timezone_select, reply_markup=continent_keyboard()
     )
     return TimezoneStates.WAIT_CONTINENT
 
 
+def save_timezone(update: Update, resulting_timezone: str) -> None:
+    """
+    Saves timezone to db
+    """
+    Dao.set_user_timezone(update.effective_user, get_zone(resulting_timezone))
+    if Reminders.job_queue is not None:
+        Reminders.set_user_timezone(update.effective_user.id, resulting_timezone)
+
+
+def location_resolved(update: Update, _: CallbackContext):
+    """
+    Sets timezone nearest to location shared by user
+    """
+    location = update.message.location
+    resulting_timezone = timezones.get_locator().nearest(location.latitude, location.longitude)
+    save_timezone(update, resulting_timezone)
+    # reply to user, hide keyboard
+    Outbox.reply(
+        update.effective_message, Strings.timezone_set(resulting_timezone), reply_markup={"remove_keyboard": True}
+    )
+    return ConversationHandler.END
+
+
 def city_select(update: Update, context: CallbackContext):
     """
     Prompts user to select exact timezone for continent specified earlier
@@ -71,42 +144,74 @@ def city_select(update: Update, context: CallbackContext):
     # get continent selected by user
     selected_continent = update.message.text
     # check the validity of input
-    if selected_continent not in structured_timezones:
+    if selected_continent not in timezones.get_tables().cities_by_continent:
         # reply with failed, send back to `continent_select`
-        update.effective_message.reply_text(Strings.entered_continent_invalid)
+        Outbox.reply(update.effective_message, Strings.entered_continent_invalid)
         return continent_select(update, context)
-    # save continent in context
+    # save continent in context, for searching by prefix
     context.user_data["tz_cont"] = selected_continent
 
-    # init keyboard
-    keyboard = [
-        [KeyboardButton(city)]
-        for city in sorted(structured_timezones[selected_continent])
-    ]
-    # reply to user
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
-    update.message.reply_text(Strings.please_enter_city, reply_markup=reply_markup)
+    # reply with first page of cities
+    Outbox.reply(update.message, Strings.please_enter_city, reply_markup=city_keyboard(selected_continent))
     return TimezoneStates.WAIT_CITY
 
 
-def timezone_confirm(update: Update, context: CallbackContext):
+def city_search(update: Update, context: CallbackContext):
+    """
+    Shows cities starting with text entered by user, or sets timezone if it is an exact city name
+    """
+    continent = context.user_data["tz_cont"]
+    prefix = update.message.text.strip()[:max_prefix_length].replace(":", "")
+    cities = matching_cities(continent, prefix)
+    exact = [city for city in cities if normalize_city(city) == normalize_city(prefix)]
+    if len(exact) == 1:
+        return timezone_confirm(update, context, f"{continent}/{exact[0]}")
+    reply_markup = city_keyboard(continent, prefix)
+    if reply_markup is None:
+        Outbox.reply(update.effective_message, Strings.no_matching_cities)
+    else:
+        Outbox.reply(update.effective_message, Strings.please_enter_city, reply_markup=reply_markup)
+    return TimezoneStates.WAIT_CITY
+
+
+def city_page(update: Update, _: CallbackContext):
+    """
+    Shows another page of cities, outside of conversation, as keyboard state is all in its callback data
+    """
+    query = update.callback_query
+    _, _, continent, prefix, page = query.data.split(":")
+    query.answer()
+    Outbox.submit(
+        update.effective_chat.id,
+        functools.partial(query.edit_message_reply_markup, city_keyboard(continent, prefix, int(page))),
+    )
+
+
+def city_chosen(update: Update, context: CallbackContext):
+    """
+    Handles city selected on keyboard, outside of conversation, which is moved on to the resulting state
+    """
+    query = update.callback_query
+    query.answer()
+    Outbox.submit(update.effective_chat.id, functools.partial(query.edit_message_reply_markup, None))
+    state = timezone_confirm(update, context, query.data[len("tz:set:"):])
+    set_conversation_state(set_timezone_handler.name, update, context, state)
+
+
+def timezone_confirm(update: Update, context: CallbackContext, resulting_timezone: str):
     """
     Handles user specified timezone
     """
-    # get user selected city
-    selected_city = update.message.text
-    # construct timezone string
-    resulting_timezone = f"{context.user_data['tz_cont']}/{selected_city}"
     # check the validity of input
-    if resulting_timezone not in timezones:
+    if resulting_timezone not in timezones.get_tables().timezones:
         # reply with failed, send back to `continent_select`
-        update.effective_message.reply_text(Strings.timezone_invalid)
+        Outbox.reply(update.effective_message, Strings.timezone_invalid)
         return continent_select(update, context)
 
-    # save constructed timezone to db
-    Dao.set_user_timezone(update.effective_user, pytz.timezone(resulting_timezone))
+    save_timezone(update, resulting_timezone)
+    context.user_data.pop("tz_cont", None)
     # reply to user
-    update.effective_message.reply_text(Strings.timezone_set(resulting_timezone))
+    Outbox.reply(update.effective_message, Strings.timezone_set(resulting_timezone))
     return ConversationHandler.END
 
 
@@ -115,10 +220,21 @@ set_timezone_handler = ConversationHandler(
         CommandHandler("timezone", continent_select)
     ],
     states={
-        TimezoneStates.WAIT_CONTINENT: [RegexHandler(r"^\w+$", city_select)],
-        TimezoneStates.WAIT_CITY: [RegexHandler(r"^\w+$", timezone_confirm)],
+        TimezoneStates.WAIT_CONTINENT: [
+            MessageHandler(Filters.location, location_resolved),
+            RegexHandler(r"^\w+$", city_select),
+        ],
+        TimezoneStates.WAIT_CITY: [
+            MessageHandler(Filters.text & ~Filters.command, city_search),
+        ],
     },
     fallbacks=[CommandHandler("cancel", cancel)],
+    conversation_timeout=conversation_timeout,
+    name="timezone",
+    persistent=True,
 )
 
 register_protected_handler(set_timezone_handler)
+# buttons of city keyboard
+register_protected_handler(CallbackQueryHandler(city_page, pattern=r"^tz:page:"))
+register_protected_handler(CallbackQueryHandler(city_chosen, pattern=r"^tz:set:"))
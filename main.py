@@ -1,36 +1,300 @@
 import base64
 import json
 import logging
+import multiprocessing
 import os
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import CallbackContext
 
 import bot
-from utils import FirebaseUtils
+import sharding
+from handlers.content.update_handler import flush_pending_edits
+from utils import FirebaseUtils, Dao, timezones
+from utils.conversation_store import ConversationStore
+from utils.export import Exporter
+from utils.firebase import TransportOptions
+from utils.importer import Importer
+from utils.metrics import Metrics
+from utils.outbox import Outbox
+from utils.reminders import Reminders
+from utils.storage import StorageBackend
+from webhook import WebhookServer
 
 cache_dir = ".cache"
 
 
-def main():
-    if not os.path.exists(cache_dir):
-        os.mkdir(cache_dir)
+def log_cache_stats(_: CallbackContext):
+    """
+    Periodically logs cache hit/miss counters, outbox and db connection pool stats
+    """
+    logging.info(f"Cache stats: {Dao.cache_stats()}")
+    logging.info(f"Outbox stats: {Outbox.stats()}")
+    if FirebaseUtils.pool_stats():
+        logging.info(f"DB pool stats: {FirebaseUtils.pool_stats()}")
+
+
+def setup_metrics(fns_bot: bot.Bot, listen: str, port: int) -> None:
+    """
+    Registers gauges of queues and conversation state, and starts metrics endpoint
+    """
+    dispatcher = fns_bot.updater.dispatcher
+
+    def dispatcher_queue_depth() -> Dict[str, float]:
+        depth = {"updates": dispatcher.update_queue.qsize()}
+        if isinstance(dispatcher, bot.KeyedDispatcher):
+            depth["workers"] = dispatcher.executor.queue_depth()
+        return depth
+
+    Metrics.gauge("libreta_dispatcher_queue_depth", "Updates waiting to be processed", dispatcher_queue_depth, "queue")
+    Metrics.gauge(
+        "libreta_conversation_state",
+        "Users with conversation state and its size in bytes",
+        fns_bot.conversation_store.stats,
+        "kind",
+    )
+    Metrics.gauge(
+        "libreta_journal",
+        "Journaled writes not durable or not in db yet",
+        lambda: Dao.journal.stats() if Dao.journal is not None else {},
+        "kind",
+    )
+    Metrics.gauge("libreta_outbox", "Outbox queue depth, send counters and latency", Outbox.stats, "kind")
+    Metrics.gauge("libreta_db_pool", "Connection pool utilisation of firebase client", FirebaseUtils.pool_stats, "kind")
+    Metrics.start_server(listen, port)
+
+
+def firebase_transport() -> TransportOptions:
+    """
+    Options of HTTP transport of firebase client, by default the pool has a connection per handler worker,
+    and a few more for background writers (e.g. write pipeline, journal, media archive)
+    """
+    defaults = TransportOptions()
+    return TransportOptions(
+        pool_size=int(os.environ.get("FIREBASE_POOL_SIZE", int(os.environ.get("HANDLER_WORKERS", 8)) + 4)),
+        connect_timeout=float(os.environ.get("FIREBASE_CONNECT_TIMEOUT", defaults.connect_timeout)),
+        read_timeout=float(os.environ.get("FIREBASE_READ_TIMEOUT", defaults.read_timeout)),
+        retries=int(os.environ.get("FIREBASE_RETRIES", defaults.retries)),
+        backoff_factor=float(os.environ.get("FIREBASE_BACKOFF_FACTOR", defaults.backoff_factor)),
+        backoff_max=float(os.environ.get("FIREBASE_BACKOFF_MAX", defaults.backoff_max)),
+    )
+
+
+def setup_storage(is_debug: bool, prewarm_connections: int = 0) -> StorageBackend:
+    """
+    Creates storage backend chosen by `STORAGE_BACKEND` env var (`firebase` or `sqlite`) and sets it up for `Dao`.
 
-    is_debug = os.environ.get("DEBUG")
-    level: int
-    if is_debug:
-        level = logging.DEBUG
+    :param is_debug: whether test db is used by default
+    :param prewarm_connections: number of db connections opened ahead of first requests, if backend has any
+    """
+    backend: StorageBackend
+    kind = os.environ.get("STORAGE_BACKEND", "firebase")
+    # only the chosen engine is imported
+    if kind == "firebase":
+        from utils.storage import FirebaseBackend
+
+        credentials = json.loads(base64.b64decode(os.environ.get("FIREBASE_SVC_ACCOUNT")))
+        databaseURL = os.environ.get("databaseURL")
+        FirebaseUtils.setup_firebase(credentials, databaseURL, firebase_transport())
+        # test db, unless specified otherwise
+        default_root = "libreta-test" if is_debug else "libreta"
+        backend = FirebaseBackend(os.environ.get("FIREBASE_ROOT", default_root))
+        if prewarm_connections > 0:
+            FirebaseUtils.prewarm(backend.root, prewarm_connections)
+    elif kind == "sqlite":
+        from utils.storage import SqliteBackend
+
+        backend = SqliteBackend(os.environ.get("SQLITE_PATH", os.path.join(cache_dir, "libreta.sqlite3")))
     else:
-        level = logging.INFO
+        raise ValueError(f"Unknown storage backend: {kind}")
+    Dao.setup(backend)
+    return backend
+
+
+def setup_journal(shard: Tuple[int, int]) -> None:
+    """
+    Sets up journal of shard, first shard also applies journals of shards that no longer exist
+    """
+    index, shards = shard
+    if index == 0:
+        for name in sorted(os.listdir(cache_dir)):
+            if name.startswith("journal-") and int(name[len("journal-"):]) >= shards:
+                Dao.replay_journal(os.path.join(cache_dir, name))
+    Dao.setup_journal(
+        os.path.join(cache_dir, f"journal-{index}"),
+        commit_delay=float(os.environ.get("JOURNAL_COMMIT_DELAY", 0.005)),
+        max_bytes=int(os.environ.get("JOURNAL_MAX_BYTES", 16 << 20)),
+    )
+
+
+def setup_logging() -> None:
+    level = logging.DEBUG if os.environ.get("DEBUG") else logging.INFO
     logging.basicConfig(
-        level=level, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+        level=level, format="%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s"
     )
 
-    credentials = json.loads(base64.b64decode(os.environ.get("FIREBASE_SVC_ACCOUNT")))
-    databaseURL = os.environ.get("databaseURL")
-    FirebaseUtils.setup_firebase(credentials, databaseURL)
+
+def setup(conversations_filename: str, shard: Optional[Tuple[int, int]] = None) -> bot.Bot:
+    """
+    Sets up storage and services, and creates the bot
+
+    :param conversations_filename: file of conversation state
+    :param shard: index of shard and number of shards, if bot serves only a shard of users
+    """
+    timezones.setup_cache(os.path.join(cache_dir, "timezones.json"))
+    setup_storage(bool(os.environ.get("DEBUG")), int(os.environ.get("FIREBASE_PREWARM", 4)))
+    # max time (in seconds) a revoked user may keep access
+    auth_cache_ttl = float(os.environ.get("AUTH_CACHE_TTL", 300))
+    Dao.setup_invited_users_cache(auth_cache_ttl)
+    Dao.setup_profile_cache(
+        int(os.environ.get("PROFILE_CACHE_SIZE", 10000)),
+        float(os.environ.get("PROFILE_CACHE_TTL", 3600)),
+    )
+    Dao.setup_message_cache(
+        int(os.environ.get("MESSAGE_CACHE_SIZE", 10000)),
+        float(os.environ.get("MESSAGE_CACHE_TTL", 3600)),
+    )
+    Dao.setup_write_pipeline(
+        int(os.environ.get("WRITE_BATCH_SIZE", 500)),
+        float(os.environ.get("WRITE_BATCH_DELAY", 0.2)),
+    )
+    if os.environ.get("JOURNAL"):
+        setup_journal(shard or (0, 1))
+    # shared by shards, as every user is served by a single shard
+    Dao.setup_search_index(
+        os.path.join(cache_dir, "search"),
+        max_users=int(os.environ.get("SEARCH_INDEX_USERS", 1000)),
+    )
+
+    Exporter.setup(
+        os.path.join(cache_dir, "exports"),
+        max_concurrent=int(os.environ.get("EXPORT_CONCURRENCY", 2)),
+        page_size=int(os.environ.get("EXPORT_PAGE_SIZE", 100)),
+    )
+
+    Importer.setup(
+        os.path.join(cache_dir, "imports"),
+        max_concurrent=int(os.environ.get("IMPORT_CONCURRENCY", 1)),
+        chunk_size=int(os.environ.get("IMPORT_CHUNK_SIZE", 500)),
+    )
 
     token = os.environ.get("TOKEN")
-    fns_bot = bot.Bot(token)
-    fns_bot.updater.start_polling()
-    fns_bot.updater.idle()
+    conversation_store = ConversationStore(
+        conversations_filename,
+        ttl=float(os.environ.get("CONVERSATION_TTL", 3600)),
+        max_bytes=int(os.environ.get("CONVERSATION_MAX_BYTES", 16 << 20)),
+    )
+    fns_bot = bot.Bot(
+        token,
+        workers=int(os.environ.get("HANDLER_WORKERS", 8)),
+        worker_queue_size=int(os.environ.get("HANDLER_QUEUE_SIZE", 100)),
+        conversation_store=conversation_store,
+    )
+    fns_bot.updater.job_queue.run_repeating(log_cache_stats, interval=3600)
+    dispatcher = fns_bot.updater.dispatcher
+    if isinstance(dispatcher, bot.KeyedDispatcher):
+        # pending edits are saved by handler workers, so they are submitted before workers stop
+        dispatcher.stop_callbacks.append(lambda: flush_pending_edits(dispatcher))
+    Outbox.setup(
+        workers=int(os.environ.get("OUTBOX_WORKERS", 8)),
+        global_rate=float(os.environ.get("OUTBOX_GLOBAL_RATE", 30)),
+        chat_rate=float(os.environ.get("OUTBOX_CHAT_RATE", 1)),
+        chat_burst=float(os.environ.get("OUTBOX_CHAT_BURST", 3)),
+    )
+    # whether user is served by this process
+    owns_user = None if shard is None else lambda user_id: sharding.shard_of(user_id, shard[1]) == shard[0]
+    if os.environ.get("METRICS_PORT"):
+        # every shard has its own port
+        port = int(os.environ.get("METRICS_PORT")) + (shard[0] if shard is not None else 0)
+        setup_metrics(fns_bot, os.environ.get("METRICS_LISTEN", "127.0.0.1"), port)
+    if os.environ.get("REMINDERS"):
+        Reminders.setup(
+            fns_bot.updater.job_queue,
+            hour=int(os.environ.get("REMINDER_HOUR", 21)),
+            window=float(os.environ.get("REMINDER_WINDOW", 30 * 60)),
+            max_per_second=int(os.environ.get("REMINDER_RATE", 20)),
+            owns_user=owns_user,
+        )
+    # imports interrupted by last shutdown
+    Importer.resume(fns_bot.updater.bot, owns_user=owns_user)
+    if os.environ.get("MEDIA_ARCHIVE"):
+        Dao.setup_media_archive(
+            fns_bot.updater.bot,
+            os.path.join(cache_dir, "media"),
+            workers=int(os.environ.get("MEDIA_WORKERS", 2)),
+            byte_budget=int(os.environ.get("MEDIA_BYTE_BUDGET", 1 << 30)),
+        )
+    return fns_bot
+
+
+def shutdown(fns_bot: bot.Bot) -> None:
+    """
+    Called once updater has stopped, flushes pending writes and conversation state
+    """
+    # edits that have been made while workers were stopping
+    flush_pending_edits(fns_bot.updater.dispatcher)
+    Exporter.close()
+    Importer.close()
+    Outbox.close()
+    Dao.close()
+    fns_bot.conversation_store.flush()
+    Metrics.stop_server()
+
+
+def run_shard(shard: int, shards: int, updates: multiprocessing.Queue) -> None:
+    """
+    Runs in a worker process of sharded mode, processes updates of a single shard
+    """
+    sharding.ignore_stop_signals()
+    setup_logging()
+    fns_bot = setup(sharding.conversations_filename(cache_dir, shard), (shard, shards))
+    logging.info(f"Shard {shard} of {shards} is ready.")
+    sharding.ShardWorker(fns_bot.updater, updates).run()
+    shutdown(fns_bot)
+
+
+def main():
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+    setup_logging()
+
+    shards = int(os.environ.get("SHARDS", 1))
+    if shards > 1:
+        # ingest process only polls, all other setup is done by shards
+        ingest = sharding.ShardedPolling(
+            os.environ.get("TOKEN"),
+            shards,
+            run_shard,
+            cache_dir,
+            queue_size=int(os.environ.get("SHARD_QUEUE_SIZE", 1000)),
+        )
+        ingest.start()
+        ingest.idle()
+        return
+
+    # state may have been left by sharded mode
+    sharding.rebalance_conversations(cache_dir, 1)
+    fns_bot = setup(sharding.conversations_filename(cache_dir, 0))
+    ingest_mode = os.environ.get("INGEST_MODE", "polling")
+    if ingest_mode == "polling":
+        fns_bot.updater.start_polling()
+        fns_bot.updater.idle()
+    elif ingest_mode == "webhook":
+        server = WebhookServer(
+            fns_bot.updater,
+            listen=os.environ.get("WEBHOOK_LISTEN", "127.0.0.1"),
+            port=int(os.environ.get("PORT", 8443)),
+            url_path=os.environ.get("WEBHOOK_PATH", ""),
+            webhook_url=os.environ.get("WEBHOOK_URL"),
+            secret_token=os.environ.get("WEBHOOK_SECRET"),
+            max_body_size=int(os.environ.get("WEBHOOK_MAX_BODY_SIZE", 1 << 20)),
+            max_queue_size=int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000)),
+        )
+        server.start()
+        server.idle()
+    else:
+        raise ValueError(f"Unknown ingest mode: {ingest_mode}")
+    shutdown(fns_bot)
 
 
 if __name__ == "__main__":
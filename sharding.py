@@ -0,0 +1,257 @@
+"""
+Sharded mode: a single ingest process polls updates and fans them out to worker processes.
+
+Every worker runs the whole handler set for a partition of users (by `effective_user.id`), so conversation state,
+caches and edit debouncing stay valid in-process, as updates of a user always land on the same shard.
+Each shard keeps its conversation state in its own file. When the number of shards changes, state is moved
+to the new shards before workers are started.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from queue import Empty, Full
+from typing import Callable, Dict, List, Optional
+
+import telegram
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Updater
+
+# runs a shard: (index of shard, number of shards, queue of raw updates)
+ShardTarget = Callable[[int, int, multiprocessing.Queue], None]
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    return user_id % shards
+
+
+def update_key(data: dict) -> int:
+    """
+    Gets user (or chat, if there is no user) of a raw update, without parsing it, same as `bot.KeyedDispatcher`
+    """
+    for value in data.values():
+        if isinstance(value, dict):
+            if "from" in value:
+                return value["from"]["id"]
+            if "chat" in value:
+                return value["chat"]["id"]
+    return 0
+
+
+def conversations_filename(directory: str, shard: int) -> str:
+    return os.path.join(directory, f"conversations-{shard}.jsonl")
+
+
+def rebalance_conversations(directory: str, shards: int) -> None:
+    """
+    Moves conversation state of users to files of their shards, if number of shards has changed.
+    Records are moved as they are, as every file is compacted when loaded.
+
+    :param directory: directory with conversation state files
+    :param shards: new number of shards
+    """
+    filenames = [os.path.join(directory, name) for name in os.listdir(directory)]
+    # state of unsharded mode, and of shards that no longer exist
+    sources = [os.path.join(directory, "conversations.jsonl")]
+    sources += [name for name in filenames if _shard_of_filename(name) is not None]
+    records: Dict[int, List[str]] = {}
+    moved = 0
+    for filename in sources:
+        if not os.path.exists(filename):
+            continue
+        shard = _shard_of_filename(filename)
+        with open(filename) as f:
+            for line in f:
+                try:
+                    user_id = json.loads(line)["user_id"]
+                except (ValueError, KeyError):
+                    continue
+                target = shard_of(user_id, shards)
+                records.setdefault(target, []).append(line)
+                moved += target != shard
+    if moved == 0 and all(_shard_of_filename(name) in range(shards) for name in sources if os.path.exists(name)):
+        return
+    # write all new files before removing old ones, so that a crash does not lose state
+    for shard in range(shards):
+        tmp_filename = f"{conversations_filename(directory, shard)}.tmp"
+        with open(tmp_filename, "w") as f:
+            f.writelines(records.get(shard, []))
+    for filename in sources:
+        if os.path.exists(filename):
+            os.remove(filename)
+    for shard in range(shards):
+        filename = conversations_filename(directory, shard)
+        os.replace(f"{filename}.tmp", filename)
+    logging.info(f"Moved conversation state of {moved} users to {shards} shards.")
+
+
+def _shard_of_filename(filename: str) -> Optional[int]:
+    name = os.path.basename(filename)
+    if name.startswith("conversations-") and name.endswith(".jsonl"):
+        shard = name[len("conversations-"):-len(".jsonl")]
+        if shard.isdigit():
+            return int(shard)
+    return None
+
+
+class ShardWorker(object):
+    """
+    Feeds updates of a shard, received from ingest process, into updater's dispatcher. Runs in a worker process.
+    """
+
+    def __init__(self, updater: Updater, updates: multiprocessing.Queue, drain_timeout: float = 10.0):
+        """
+        :param updater: updater, whose dispatcher will process updates
+        :param updates: raw updates of shard, `None` stops the worker
+        :param drain_timeout: max time (in seconds) to wait for queued updates on shutdown
+        """
+        self.updater = updater
+        self.dispatcher = updater.dispatcher
+        self.updates = updates
+        self.drain_timeout = drain_timeout
+
+    def run(self) -> None:
+        """
+        Processes updates until ingest process stops the worker, then lets dispatcher process queued ones
+        """
+        ingest_pid = os.getppid()
+        self.updater.job_queue.start()
+        dispatcher_ready = threading.Event()
+        threading.Thread(
+            target=self.dispatcher.start, name="dispatcher", kwargs={"ready": dispatcher_ready}
+        ).start()
+        dispatcher_ready.wait()
+        while True:
+            try:
+                data = self.updates.get(timeout=1)
+            except Empty:
+                if os.getppid() != ingest_pid:
+                    logging.error("Ingest process has exited, stopping.")
+                    break
+                continue
+            if data is None:
+                break
+            self.dispatcher.update_queue.put(Update.de_json(data, self.dispatcher.bot))
+        deadline = time.monotonic() + self.drain_timeout
+        while not self.dispatcher.update_queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.updater.stop()
+
+
+class ShardedPolling(object):
+    """
+    Polls updates and routes them to worker processes by user, restarting workers that have died
+    """
+
+    def __init__(
+            self,
+            token: str,
+            shards: int,
+            target: ShardTarget,
+            conversations_directory: str,
+            queue_size: int = 1000,
+            poll_timeout: float = 10,
+            drain_timeout: float = 30,
+    ):
+        """
+        :param token: bot token
+        :param shards: number of worker processes
+        :param target: runs a shard in worker process, has to be a module level function
+        :param conversations_directory: directory with conversation state files of shards
+        :param queue_size: max number of updates waiting for a single shard, polling blocks when it is reached
+        :param poll_timeout: timeout (in seconds) of long polling
+        :param drain_timeout: max time (in seconds) to wait for workers to process queued updates on shutdown
+        """
+        self.bot = telegram.Bot(token)
+        self.shards = shards
+        self.target = target
+        self.conversations_directory = conversations_directory
+        self.poll_timeout = poll_timeout
+        self.drain_timeout = drain_timeout
+        # workers are started afresh, not forked from a process with running threads
+        self._context = multiprocessing.get_context("spawn")
+        self._queues: List[multiprocessing.Queue] = [self._context.Queue(queue_size) for _ in range(shards)]
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * shards
+        self._stop_event = threading.Event()
+
+    def start(self) -> None:
+        """
+        Moves conversation state to current shards and starts worker processes
+        """
+        rebalance_conversations(self.conversations_directory, self.shards)
+        for shard in range(self.shards):
+            self._start_worker(shard)
+        logging.info(f"Started {self.shards} shards.")
+
+    def idle(self, stop_signals=(signal.SIGINT, signal.SIGTERM, signal.SIGABRT)) -> None:
+        """
+        Polls updates until one of the signals is received, then stops. Counterpart of `Updater.idle`.
+        """
+        for sig in stop_signals:
+            signal.signal(sig, lambda signum, frame: self._stop_event.set())
+        offset: Optional[int] = None
+        while not self._stop_event.is_set():
+            self._restart_dead_workers()
+            try:
+                updates = self.bot.get_updates(offset, timeout=self.poll_timeout)
+            except TelegramError as e:
+                logging.warning(f"Polling has failed: {e}")
+                self._stop_event.wait(1)
+                continue
+            for update in updates:
+                data = update.to_dict()
+                # blocks if shard is behind, which slows polling down instead of piling updates up
+                self._queues[shard_of(update_key(data), self.shards)].put(data)
+                offset = update.update_id + 1
+        self.stop(offset)
+
+    def stop(self, offset: Optional[int] = None) -> None:
+        """
+        Lets workers process queued updates and stops them
+
+        :param offset: offset of the next update, confirmed to Telegram so that routed updates are not received again
+        """
+        if offset is not None:
+            try:
+                self.bot.get_updates(offset, timeout=0)
+            except TelegramError as e:
+                logging.warning(f"Could not confirm updates: {e}")
+        deadline = time.monotonic() + self.drain_timeout
+        for shard, queue in enumerate(self._queues):
+            try:
+                # queue of a dead worker may be full
+                queue.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except Full:
+                logging.warning(f"Could not ask shard {shard} to stop, its queue is full.")
+        for shard, process in enumerate(self._processes):
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"Shard {shard} has not stopped in time, terminating it.")
+                process.terminate()
+                process.join()
+        logging.info("All shards have stopped.")
+
+    def _start_worker(self, shard: int) -> None:
+        process = self._context.Process(
+            target=self.target, args=(shard, self.shards, self._queues[shard]), name=f"shard_{shard}"
+        )
+        process.start()
+        self._processes[shard] = process
+
+    def _restart_dead_workers(self) -> None:
+        for shard, process in enumerate(self._processes):
+            if not process.is_alive():
+                logging.error(f"Shard {shard} has exited with code {process.exitcode}, restarting it.")
+                self._start_worker(shard)
+
+
+def ignore_stop_signals() -> None:
+    """
+    Called first in worker processes: ingest process handles signals and stops workers
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
@@ -2,6 +2,8 @@ import datetime
 from textwrap import dedent
 from typing import Union
 
+from utils.stats import UserStats
+
 
 class Strings(object):
     """
@@ -27,18 +29,75 @@ class Strings(object):
     __published = "Saved for"
     cancelled = "Cancelled"
     timezone_invalid = "This timezone is invalid. Please try again or /cancel."
-    please_enter_city = "Please select your city timezone, or /cancel to cancel:"
+    please_enter_city = "Please select your city timezone or type its first letters, or /cancel to cancel:"
+    no_matching_cities = "No city starts with this. Please try again or /cancel."
     entered_continent_invalid = (
         "This continent is invalid. Please try again or /cancel."
     )
-    timezone_select = "Please select a continent, or /cancel to cancel:"
+    timezone_select = "Please share your location or select a continent, or /cancel to cancel:"
+    share_location = "Share location"
     unauthenticated = "Unfortunately, you are not authorized to use this bot"
     __timezone_set = "Your timezone has been set to"
+    export_started = "Preparing your export, it will be sent here once ready."
+    export_in_progress = "Your export is already being prepared."
+    export_busy = "Too many exports are being prepared right now. Please try again later."
+    export_empty = "There is nothing to export yet."
+    export_too_large = "Your export is too large to be sent."
+    export_caption = "Your diary"
+    nothing_to_read = "There are no entries for this period."
+    previous_page = "« Previous"
+    next_page = "Next »"
+    reminder = "You have not written anything today yet. How was your day?"
+    search_usage = "Please add words to search for, e.g. /search holidays"
+    nothing_found = "No entries contain these words."
+    no_stats = "You have not written anything yet."
+    import_usage = (
+        "Please send your diary as a document: either result.json of a chat exported by Telegram Desktop "
+        "(in JSON format, zipped or not) or an archive made by /export. Or /cancel to cancel."
+    )
+    import_started = "Importing your diary, I will let you know once it is done."
+    import_in_progress = "Your diary is already being imported."
+    import_busy = "Too many diaries are being imported right now. Please try again later."
+    import_too_large = "This file is too large, files up to 20 MB can be imported."
+    import_unsupported = "This file can not be imported, it is neither a Telegram chat export nor an /export archive."
+    import_failed = "Import has failed. Please send the file again to continue, already imported entries are kept."
 
     @classmethod
     def timezone_set(cls, resulting_timezone: str) -> str:
         return f"{cls.__timezone_set} {resulting_timezone}."
 
+    @classmethod
+    def reading_page(cls, start_date: datetime.date, end_date: datetime.date, page: int, pages: int) -> str:
+        period = start_date.isoformat() if start_date == end_date else f"{start_date} – {end_date}"
+        return f"{period} (page {page} of {pages})"
+
+    @classmethod
+    def search_results(cls, shown: int, total: int) -> str:
+        return f"Found {total} entries" if shown == total else f"Found {total} entries, showing the latest {shown}"
+
+    @classmethod
+    def stats(cls, stats: UserStats, recent_months: int = 6) -> str:
+        lines = [
+            f"Entries: {stats.entries}",
+            f"Days written: {stats.days} (since {stats.first_date})",
+            f"Last entry: {stats.last_date}",
+            f"Current streak: {stats.current_streak} days",
+            f"Longest streak: {stats.longest_streak} days",
+        ]
+        months = list(stats.months.items())[-recent_months:]
+        if months:
+            lines.append("")
+            lines += [f"{month}: {count} entries" for month, count in months]
+        return "\n".join(lines)
+
+    @classmethod
+    def import_progress(cls, imported: int, skipped: int) -> str:
+        return f"Imported {imported} entries so far ({skipped} messages skipped)…"
+
+    @classmethod
+    def import_done(cls, imported: int, skipped: int) -> str:
+        return f"Import is done: {imported} entries imported, {skipped} other messages skipped."
+
     @classmethod
     def published(cls, message_date: Union[datetime.date, str]):
         date_str: str
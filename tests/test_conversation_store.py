@@ -0,0 +1,65 @@
+"""
+Tests of persisting conversation state and `user_data`
+"""
+import json
+
+from utils.conversation_store import ConversationStore
+
+
+class FakeDispatcher:
+    def __init__(self, store: ConversationStore):
+        # a copy, as `BasePersistence` copies data when it is read and when it is updated
+        self.user_data = store.get_user_data()
+        self.store = store
+        store.set_dispatcher(self)
+
+    def update_persistence(self, user_id: int) -> None:
+        self.store.update_user_data(user_id, self.user_data[user_id])
+
+
+def read_log(filename) -> list:
+    with open(filename) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_changed_user_data_is_flushed(tmp_path):
+    filename = str(tmp_path / "conversations.log")
+    dispatcher = FakeDispatcher(ConversationStore(filename))
+    dispatcher.user_data[5]["album"] = ["a"]
+    dispatcher.update_persistence(5)
+    dispatcher.user_data[5]["album"].append("b")
+    dispatcher.update_persistence(5)
+    dispatcher.store.flush()
+
+    assert dispatcher.store.stats()["bytes"] == len(json.dumps(read_log(filename)[-1]))
+    assert ConversationStore(filename).get_user_data()[5] == {"album": ["a", "b"]}
+
+
+def test_unchanged_user_data_is_not_flushed_again(tmp_path):
+    filename = str(tmp_path / "conversations.log")
+    dispatcher = FakeDispatcher(ConversationStore(filename))
+    dispatcher.user_data[5]["timezone"] = "UTC"
+    dispatcher.update_persistence(5)
+    dispatcher.store.flush()
+    dispatcher.update_persistence(5)
+    dispatcher.store.flush()
+
+    assert len(read_log(filename)) == 1
+
+
+def test_empty_user_data_is_evicted(tmp_path):
+    filename = str(tmp_path / "conversations.log")
+    dispatcher = FakeDispatcher(ConversationStore(filename, ttl=0))
+    dispatcher.user_data[5]["pending_edits"] = {"1": "edit"}
+    dispatcher.update_persistence(5)
+    dispatcher.user_data[5].clear()
+    dispatcher.update_persistence(5)
+    dispatcher.update_persistence(6)
+    dispatcher.store.flush()
+    dispatcher.store.evict()
+    dispatcher.store.flush()
+
+    assert not dispatcher.user_data
+    assert dispatcher.store.stats() == {"users": 0, "bytes": 0}
+    assert [record["user_id"] for record in read_log(filename)] == [5, 5]
+    assert not ConversationStore(filename).get_user_data()
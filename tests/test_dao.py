@@ -0,0 +1,71 @@
+"""
+Tests of editing published entries
+"""
+import datetime
+import threading
+
+import pytest
+from telegram import Chat, Message, User
+
+from utils.dao import Dao
+from utils.journal import WriteJournal
+from utils.storage.sqlite_backend import SqliteBackend
+
+user = User(5, "User", False)
+chat = Chat(5, Chat.PRIVATE)
+today = datetime.date(2021, 7, 29)
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SqliteBackend(str(tmp_path / "libreta.db"))
+    Dao.setup(backend)
+    Dao.setup_message_cache(100, 3600)
+    yield backend
+    backend.close()
+
+
+def message(message_id: int, text: str, media_group_id: str = None) -> Message:
+    date = datetime.datetime(2021, 7, 29, 10, tzinfo=datetime.timezone.utc)
+    return Message(message_id, date, chat, from_user=user, text=text, media_group_id=media_group_id)
+
+
+def test_edit_with_cold_cache_keeps_extra_fields(backend):
+    Dao.publish_album(user, today, [message(3, "first", "g"), message(4, "second", "g")]).result()
+    Dao._record_archived(user.id, today.isoformat(), 3, {"unique": "3/unique.jpg"})
+    Dao.setup_message_cache(100, 3600)
+
+    assert Dao.update_message(user, message(3, "first, edited", "g"))
+
+    stored = backend.get_entry(user.id, today.isoformat(), 3)
+    assert stored["text"] == "first, edited"
+    assert stored["album"] == [{"message_id": 4, "date": stored["date"], "media_group_id": "g", "text": "second"}]
+    assert stored["archive"] == {"unique": "3/unique.jpg"}
+    assert Dao.message_cache.get((user.id, 3)) == (today.isoformat(), stored)
+    assert backend.get_aggregates(user.id).entries == 1
+
+
+def test_edit_of_entry_not_in_db_yet_goes_through_journal(backend, tmp_path):
+    applying = threading.Event()
+    Dao.journal = WriteJournal(
+        str(tmp_path / "journal"),
+        lambda writes: applying.wait() and backend.write_entries(writes),
+        lambda user_id, message_id: False,
+        commit_delay=0,
+    )
+    Dao.journal.start()
+    try:
+        Dao.publish_album(user, today, [message(3, "first", "g"), message(4, "second", "g")]).result()
+        # only the date is known, e.g. once cached entry has expired
+        Dao.message_cache.set((user.id, 3), (today.isoformat(), None))
+
+        assert Dao.update_message(user, message(3, "first, edited", "g"))
+        applying.set()
+    finally:
+        Dao.journal.close()
+        Dao.journal = None
+
+    stored = backend.get_entry(user.id, today.isoformat(), 3)
+    assert stored["text"] == "first, edited"
+    assert [part["text"] for part in stored["album"]] == ["second"]
+    assert backend.get_aggregates(user.id).entries == 1
@@ -0,0 +1,59 @@
+"""
+Tests of importing entries into SQLite storage
+"""
+import datetime
+
+import pytest
+import pytz
+from telegram import User
+
+from utils.dao import Dao
+from utils.importer import telegram_record
+from utils.storage import EntryWrite
+from utils.storage.sqlite_backend import SqliteBackend
+
+user = User(5, "User", False)
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SqliteBackend(str(tmp_path / "libreta.db"))
+    Dao.setup(backend)
+    yield backend
+    backend.close()
+
+
+def backend_write(date: str, message_id: int, entry: dict) -> EntryWrite:
+    return EntryWrite(user.id, date, message_id, entry, is_new=True)
+
+
+def exported_message(message_id: int, text: str) -> dict:
+    return {"id": message_id, "type": "message", "date_unixtime": "1627552800", "from_id": "user5", "text": text}
+
+
+def test_imported_entry_is_read_back_by_day(backend):
+    date, message_id, entry = telegram_record(exported_message(3, "Dear diary"), user.id, 777, pytz.utc)
+    Dao.import_entries(user.id, [backend_write(date, message_id, entry)])
+
+    day = datetime.date.fromisoformat(date)
+    entries = list(Dao.iter_entries(user, day, day))
+    assert [(e.message_id, e.content["text"]) for e in entries] == [(message_id, "Dear diary")]
+    assert message_id < 0
+
+
+def test_imported_and_sent_entries_of_a_day_are_read_in_order(backend):
+    date, message_id, entry = telegram_record(exported_message(3, "Imported"), user.id, 777, pytz.utc)
+    Dao.import_entries(user.id, [backend_write(date, message_id, entry)])
+    backend.write_entries([backend_write(date, 10, {"v": 1, "text": "Sent"})])
+
+    day = datetime.date.fromisoformat(date)
+    assert [e.content["text"] for e in Dao.iter_entries(user, day, day, page_size=1)] == ["Imported", "Sent"]
+
+
+def test_reimport_does_not_count_entries_again(backend):
+    date, message_id, entry = telegram_record(exported_message(3, "Dear diary"), user.id, 777, pytz.utc)
+    for _ in range(2):
+        Dao.import_entries(user.id, [backend_write(date, message_id, entry)])
+
+    assert backend.get_aggregates(user.id).entries == 1
+    assert backend.get_entry_counts(user.id, date[:7]) == {date: 1}
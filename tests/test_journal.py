@@ -0,0 +1,141 @@
+"""
+Tests of `WriteJournal` recovery and compaction
+"""
+import os
+import threading
+from typing import List, Set, Tuple
+
+import pytest
+
+from utils.journal import WriteJournal
+from utils.storage import EntryWrite
+
+
+class FakeDb(object):
+    """
+    Records applied writes, fails while `down`
+    """
+
+    def __init__(self):
+        self.batches: List[List[EntryWrite]] = []
+        self.stored: Set[Tuple[int, int]] = set()
+        self.down = False
+        self.applied = threading.Condition()
+
+    def apply(self, writes: List[EntryWrite]) -> None:
+        if self.down:
+            raise OSError("db is down")
+        with self.applied:
+            self.batches.append(writes)
+            self.stored.update((write.user_id, write.message_id) for write in writes)
+            self.applied.notify_all()
+
+    def is_stored(self, user_id: int, message_id: int) -> bool:
+        return (user_id, message_id) in self.stored
+
+    def writes(self) -> List[Tuple[int, str, bool]]:
+        return [(write.message_id, write.content["text"], write.is_new) for batch in self.batches for write in batch]
+
+
+def entry_write(message_id: int, text: str, is_new: bool = True) -> EntryWrite:
+    return EntryWrite(5, "2021-07-29", message_id, {"text": text}, is_new)
+
+
+def open_journal(directory: str, db: FakeDb, **kwargs) -> WriteJournal:
+    journal = WriteJournal(directory, db.apply, db.is_stored, commit_delay=0, **kwargs)
+    journal.start()
+    return journal
+
+
+def crash(journal: WriteJournal, writes: List[EntryWrite]) -> None:
+    """
+    Makes writes durable, and stops journal before they are applied
+    """
+    down = FakeDb()
+    down.down = True
+    journal.apply = down.apply
+    for write in writes:
+        journal.append([write])[0].result(timeout=5)
+    journal.close(timeout=0)
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path / "journal")
+
+
+def test_replays_writes_after_checkpoint(directory):
+    db = FakeDb()
+    crash(open_journal(directory, db), [entry_write(1, "one"), entry_write(2, "two"), entry_write(3, "three")])
+    # the first write of the batch has been applied, but the rest of the batch has not
+    with open(os.path.join(directory, "checkpoint"), "w") as f:
+        f.write("1")
+
+    open_journal(directory, db).close()
+
+    assert db.writes() == [(2, "two", True), (3, "three", True)]
+
+
+def test_replayed_writes_that_are_stored_are_not_new(directory):
+    db = FakeDb()
+    crash(open_journal(directory, db), [entry_write(1, "one"), entry_write(2, "two"), entry_write(1, "one, edited")])
+    # the batch has been written to db, but the checkpoint has not been saved
+    db.stored.add((5, 1))
+
+    open_journal(directory, db).close()
+
+    assert db.writes() == [(1, "one, edited", False), (2, "two", True)]
+
+
+def test_coalesced_write_stays_new(directory):
+    db = FakeDb()
+    crash(open_journal(directory, db), [entry_write(1, "one"), entry_write(1, "one, edited", is_new=False)])
+
+    open_journal(directory, db).close()
+
+    assert db.writes() == [(1, "one, edited", True)]
+
+
+def test_truncated_last_record_is_dropped(directory):
+    db = FakeDb()
+    crash(open_journal(directory, db), [entry_write(1, "one")])
+    with open(os.path.join(directory, "journal.jsonl"), "a") as f:
+        f.write('{"seq": 2, "user_id": 5, "da')
+
+    journal = open_journal(directory, db)
+    crash(journal, [entry_write(3, "three")])
+    open_journal(directory, db).close()
+
+    # the write after the truncated record is not lost, and is applied once
+    assert db.writes() == [(1, "one", True), (3, "three", True)]
+
+
+def test_compaction_keeps_pending_writes(directory):
+    db = FakeDb()
+    journal = open_journal(directory, db, max_bytes=1)
+    for message_id in range(1, 4):
+        journal.append([entry_write(message_id, "applied")])[1].result(timeout=5)
+    crash(journal, [entry_write(4, "pending"), entry_write(5, "pending")])
+
+    with open(os.path.join(directory, "journal.jsonl")) as f:
+        # the log is compacted after each applied batch, writes appended since are kept
+        assert len(f.readlines()) == 2
+    open_journal(directory, db).close()
+
+    assert db.writes()[3:] == [(4, "pending", True), (5, "pending", True)]
+
+
+def test_pending_write_is_readable_until_applied(directory):
+    db = FakeDb()
+    db.down = True
+    journal = open_journal(directory, db)
+    journal.append([entry_write(1, "one")])[0].result(timeout=5)
+    journal.append([entry_write(1, "one, edited", is_new=False)])[0].result(timeout=5)
+
+    assert journal.get_pending(5, 1).content == {"text": "one, edited"}
+    db.down = False
+    with db.applied:
+        assert db.applied.wait_for(lambda: db.batches, timeout=5)
+    journal.close()
+
+    assert journal.get_pending(5, 1) is None
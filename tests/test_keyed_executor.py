@@ -0,0 +1,85 @@
+"""
+Tests of per-key ordering of `KeyedExecutor` and `KeyedDispatcher`
+"""
+import datetime
+import random
+import threading
+import time
+from queue import Queue
+from typing import Dict, List
+
+import telegram
+from telegram import Chat, Message, Update, User
+from telegram.ext import TypeHandler
+
+from bot import KeyedDispatcher
+from utils.keyed_executor import KeyedExecutor
+
+
+def test_tasks_with_same_key_run_in_order():
+    executor = KeyedExecutor(workers=4)
+    executor.start()
+    runs: Dict[int, List[int]] = {key: [] for key in range(8)}
+
+    def task(key: int, seq: int) -> None:
+        time.sleep(random.random() / 1000)
+        runs[key].append(seq)
+
+    for seq in range(50):
+        for key in range(8):
+            executor.submit(key, task, key, seq)
+    executor.shutdown()
+
+    assert runs == {key: list(range(50)) for key in range(8)}
+
+
+def test_tasks_with_different_keys_run_concurrently():
+    executor = KeyedExecutor(workers=2)
+    executor.start()
+    # each task waits for the other one, so neither completes unless they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    passed: List[int] = []
+
+    def task(key: int) -> None:
+        barrier.wait()
+        passed.append(key)
+
+    # with 2 workers, keys 0 and 1 are mapped to different workers
+    executor.submit(0, task, 0)
+    executor.submit(1, task, 1)
+    executor.shutdown()
+
+    assert sorted(passed) == [0, 1]
+
+
+def test_runs_on_caller_thread_when_not_started():
+    executor = KeyedExecutor(workers=2)
+    threads = []
+    executor.submit(0, lambda: threads.append(threading.current_thread()))
+
+    assert threads == [threading.current_thread()]
+
+
+def test_dispatcher_keeps_order_of_updates_of_each_user():
+    executor = KeyedExecutor(workers=4)
+    dispatcher = KeyedDispatcher(telegram.Bot("123:token"), Queue(), executor)
+    handled: Dict[int, List[int]] = {}
+    lock = threading.Lock()
+
+    def on_update(update: Update, context) -> None:
+        time.sleep(random.random() / 1000)
+        with lock:
+            handled.setdefault(update.effective_user.id, []).append(update.update_id)
+
+    dispatcher.add_handler(TypeHandler(Update, on_update))
+    executor.start()
+    update_ids: Dict[int, List[int]] = {}
+    date = datetime.datetime(2021, 7, 29, tzinfo=datetime.timezone.utc)
+    for update_id in range(200):
+        user = User(update_id % 5, "User", False)
+        message = Message(update_id, date, Chat(user.id, Chat.PRIVATE), from_user=user, text="text")
+        dispatcher.process_update(Update(update_id, message=message))
+        update_ids.setdefault(user.id, []).append(update_id)
+    executor.shutdown()
+
+    assert handled == update_ids
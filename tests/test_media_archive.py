@@ -0,0 +1,180 @@
+"""
+Tests of `MediaArchive` against a local fake of the Bot API file endpoint
+"""
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+import pytest
+from telegram import File
+from telegram.utils.request import Request
+
+from utils.media_archive import MediaArchive
+
+
+class FakeFileServer(ThreadingHTTPServer):
+    """
+    Serves `/file/{file_id}` with content of `files`, counting downloads
+    """
+
+    daemon_threads = True
+
+    def __init__(self, files: Dict[str, bytes]):
+        super().__init__(("127.0.0.1", 0), _FileRequestHandler)
+        self.files = files
+        self.downloads: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def url(self, file_id: str) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/file/{file_id}"
+
+
+class _FileRequestHandler(BaseHTTPRequestHandler):
+    server: FakeFileServer
+
+    def do_GET(self):
+        file_id = self.path.rsplit("/", 1)[-1]
+        with self.server.lock:
+            self.server.downloads[file_id] = self.server.downloads.get(file_id, 0) + 1
+        content = self.server.files.get(file_id)
+        if content is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBot(object):
+    """
+    Resolves file ids to files on `FakeFileServer`, downloaded with a real request object
+    """
+
+    def __init__(self, server: FakeFileServer, known_sizes: bool = True):
+        """
+        :param known_sizes: whether sizes of files are known before they are downloaded
+        """
+        self.server = server
+        self.known_sizes = known_sizes
+        self.request = Request(con_pool_size=4)
+
+    def get_file(self, file_id: str) -> File:
+        content = self.server.files.get(file_id)
+        file_size = len(content) if self.known_sizes and content is not None else None
+        return File(file_id, f"unique_{file_id}", bot=self, file_size=file_size, file_path=self.server.url(file_id))
+
+
+@pytest.fixture
+def server():
+    server = FakeFileServer({"a": b"a" * 1000, "b": b"b" * 3000})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def document_entry(file_id: str) -> dict:
+    return {"v": 1, "document": {"file_id": file_id, "file_unique_id": f"unique_{file_id}"}}
+
+
+def run_archive(server: FakeFileServer, directory: str, entries: List[dict], expected: int, known_sizes: bool = True,
+                **kwargs):
+    """
+    Archives media of entries, waiting until `expected` files have been recorded or given up on
+
+    :return: archive and recorded (message id, {file unique id: location})
+    """
+    recorded: List[Tuple[int, Dict[str, str]]] = []
+    done = threading.Semaphore(0)
+
+    def on_archived(user_id: int, date: str, message_id: int, files: Dict[str, str]):
+        recorded.append((message_id, files))
+        done.release()
+
+    archive = MediaArchive(FakeBot(server, known_sizes), directory, on_archived, **kwargs)
+    archive.start()
+    for message_id, entry in enumerate(entries):
+        archive.submit(1, "2021-07-29", message_id, entry)
+    for _ in range(expected):
+        assert done.acquire(timeout=10)
+    archive.close()
+    return archive, recorded
+
+
+def part_files(directory: str) -> List[str]:
+    return [name for _, _, files in os.walk(directory) for name in files if name.endswith(".part")]
+
+
+def test_archives_by_unique_id(server, tmp_path):
+    archive, recorded = run_archive(server, str(tmp_path), [document_entry("a"), document_entry("b")], 2)
+
+    locations = dict(file for _, files in recorded for file in files.items())
+    assert locations == {"unique_a": archive.location("unique_a"), "unique_b": archive.location("unique_b")}
+    with open(tmp_path / archive.location("unique_b"), "rb") as f:
+        assert f.read() == server.files["b"]
+    assert archive.used_bytes == 4000
+    assert part_files(str(tmp_path)) == []
+
+
+def test_duplicates_are_counted_once(server, tmp_path):
+    entries = [document_entry("a") for _ in range(6)]
+    archive, recorded = run_archive(server, str(tmp_path), entries, 6, workers=3)
+
+    assert len(recorded) == 6
+    assert archive.used_bytes == 1000
+    # files are downloaded at most once per worker that has not found them stored yet
+    assert server.downloads["a"] <= 3
+
+
+def test_skips_files_over_budget(server, tmp_path):
+    archive, recorded = run_archive(server, str(tmp_path), [document_entry("a"), document_entry("b")], 1,
+                                    workers=1, byte_budget=2000)
+
+    assert [files for _, files in recorded] == [{"unique_a": archive.location("unique_a")}]
+    assert not os.path.exists(tmp_path / archive.location("unique_b"))
+    assert archive.used_bytes == 1000
+    # size is known, so file is not downloaded at all
+    assert "b" not in server.downloads
+
+
+def test_stops_download_of_file_of_unknown_size_over_budget(server, tmp_path):
+    archive, recorded = run_archive(server, str(tmp_path), [document_entry("b"), document_entry("a")], 1,
+                                    known_sizes=False, workers=1, byte_budget=2000)
+
+    assert [files for _, files in recorded] == [{"unique_a": archive.location("unique_a")}]
+    assert not os.path.exists(tmp_path / archive.location("unique_b"))
+    assert archive.used_bytes == 1000
+    assert part_files(str(tmp_path)) == []
+
+
+def test_counts_files_archived_by_other_shards(server, tmp_path):
+    recorded = threading.Semaphore(0)
+    archive = MediaArchive(FakeBot(server), str(tmp_path), lambda *args: recorded.release(), 1, byte_budget=4500)
+    archive.rescan_interval = 0
+    archive.start()
+    # another shard archives a file in the meantime
+    with open(tmp_path / "other", "wb") as f:
+        f.write(b"o" * 2000)
+    archive.submit(1, "2021-07-29", 1, document_entry("b"))
+    archive.submit(1, "2021-07-29", 2, document_entry("a"))
+    assert recorded.acquire(timeout=10)
+    archive.close()
+
+    assert not os.path.exists(tmp_path / archive.location("unique_b"))
+    assert archive.used_bytes == 3000
+
+
+def test_failed_download_leaves_no_partial_file(server, tmp_path):
+    archive, recorded = run_archive(server, str(tmp_path), [document_entry("missing"), document_entry("a")], 1,
+                                    workers=1, max_retries=1)
+
+    assert [files for _, files in recorded] == [{"unique_a": archive.location("unique_a")}]
+    assert server.downloads["missing"] == 2
+    assert part_files(str(tmp_path)) == []
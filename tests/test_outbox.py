@@ -0,0 +1,202 @@
+"""
+Tests of `Outbox` rate limiting, priorities and retries, with a fake clock
+"""
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Callable, List
+
+import pytest
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+from utils import outbox
+from utils.outbox import Outbox, Priority, TokenBucket
+
+
+class FakeTime(object):
+    """
+    Stands in for `time` in `utils.outbox`: the clock moves only when advanced, or slept on
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class FakeBot(object):
+    """
+    Records sends, answering each with the next outcome of its chat (an exception to raise or a result)
+    """
+
+    def __init__(self):
+        self.sent: List[tuple] = []
+        self.outcomes = {}
+        self.lock = threading.Lock()
+
+    def send(self, chat_id: int, text: str) -> Callable[[], str]:
+        def fn() -> str:
+            with self.lock:
+                self.sent.append((chat_id, text))
+                outcomes = self.outcomes.get(chat_id)
+                outcome = outcomes.pop(0) if outcomes else None
+            if isinstance(outcome, Exception):
+                raise outcome
+            return text
+
+        return fn
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(outbox, "time", clock)
+    # outbox state is kept by the class
+    monkeypatch.setattr(Outbox, "_ready", [])
+    monkeypatch.setattr(Outbox, "_delayed", [])
+    monkeypatch.setattr(Outbox, "_sequence", itertools.count())
+    monkeypatch.setattr(Outbox, "_retrying", {})
+    monkeypatch.setattr(Outbox, "_held", {})
+    monkeypatch.setattr(Outbox, "_chat_buckets", {})
+    monkeypatch.setattr(Outbox, "_latencies", deque(maxlen=1000))
+    monkeypatch.setattr(Outbox, "_counters", {"sent": 0, "failed": 0, "retried": 0, "rate_limited": 0})
+    yield clock
+    Outbox.close(timeout=0)
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+def advance(clock: FakeTime, seconds: float) -> None:
+    clock.now += seconds
+    with Outbox._condition:
+        Outbox._condition.notify_all()
+
+
+def wait_until(predicate: Callable[[], bool]) -> None:
+    deadline = time.monotonic() + 5
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_token_bucket_allows_bursts_then_rate():
+    bucket = TokenBucket(rate=2, capacity=3)
+    now = bucket.updated_at
+
+    assert [bucket.reserve(now) for _ in range(4)] == [0, 0, 0, 0.5]
+    assert bucket.reserve(now + 0.5) == 0.5
+    bucket.pause(now + 1, 10)
+    assert bucket.reserve(now + 1) == 10.5
+    assert not bucket.is_full(now + 11)
+    assert bucket.is_full(now + 14)
+
+
+def test_sends_to_chat_over_its_limit_are_delayed(clock, bot):
+    Outbox.setup(workers=2, chat_rate=1, chat_burst=2)
+    futures = [Outbox.submit(1, bot.send(1, str(i))) for i in range(4)]
+    other = Outbox.submit(2, bot.send(2, "other"))
+
+    wait_until(lambda: futures[1].done() and other.done())
+    assert not futures[2].done()
+    advance(clock, 1)
+    futures[2].result(timeout=5)
+    assert not futures[3].done()
+    advance(clock, 1)
+
+    assert futures[3].result(timeout=5) == "3"
+    assert [text for chat_id, text in bot.sent if chat_id == 1] == ["0", "1", "2", "3"]
+
+
+def test_global_limit_is_waited_for(clock, bot):
+    Outbox.setup(workers=1, global_rate=2, chat_burst=10)
+    started_at = clock.now
+    futures = [Outbox.submit(chat_id, bot.send(chat_id, "text")) for chat_id in range(4)]
+
+    for future in futures:
+        future.result(timeout=5)
+    # two sends in a burst, then one every half second
+    assert clock.now - started_at == pytest.approx(1)
+
+
+def test_interactive_sends_go_first(clock, bot):
+    Outbox.setup(workers=1)
+    # queued at once, before the outbox thread takes any of them
+    with Outbox._condition:
+        futures = [
+            Outbox.submit(1, bot.send(1, "reminder"), Priority.BACKGROUND),
+            Outbox.submit(2, bot.send(2, "export"), Priority.BACKGROUND),
+            Outbox.submit(3, bot.send(3, "reply"), Priority.INTERACTIVE),
+        ]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert [text for _, text in bot.sent] == ["reply", "reminder", "export"]
+
+
+def test_retry_after_pauses_chat_and_keeps_its_order(clock, bot):
+    Outbox.setup(workers=2)
+    bot.outcomes[1] = [RetryAfter(5)]
+    first = Outbox.submit(1, bot.send(1, "first"))
+    wait_until(lambda: Outbox.stats()["rate_limited"] == 1)
+    second = Outbox.submit(1, bot.send(1, "second"))
+    other = Outbox.submit(2, bot.send(2, "other"))
+
+    assert other.result(timeout=5) == "other"
+    advance(clock, 5)
+    # chat is paused for 5 seconds and then refilled at its rate, later send does not take a token meanwhile
+    assert not first.done() and not second.done()
+    advance(clock, 1)
+    assert first.result(timeout=5) == "first"
+    assert not second.done()
+    advance(clock, 1)
+
+    assert second.result(timeout=5) == "second"
+    assert [text for chat_id, text in bot.sent if chat_id == 1] == ["first", "first", "second"]
+
+
+def test_network_errors_are_retried_with_backoff(clock, bot):
+    Outbox.setup(workers=1)
+    bot.outcomes[1] = [NetworkError("reset"), NetworkError("reset")]
+    future = Outbox.submit(1, bot.send(1, "text"))
+    wait_until(lambda: Outbox.stats()["retried"] == 1)
+    advance(clock, 1)
+    wait_until(lambda: Outbox.stats()["retried"] == 2)
+    advance(clock, 1)
+    assert not future.done()
+    advance(clock, 1)
+
+    assert future.result(timeout=5) == "text"
+    assert len(bot.sent) == 3
+
+
+def test_gives_up_after_max_retries(clock, bot):
+    Outbox.setup(workers=1, max_retries=2)
+    bot.outcomes[1] = [NetworkError("reset")] * 3
+    future = Outbox.submit(1, bot.send(1, "text"))
+    for attempt in range(2):
+        wait_until(lambda: Outbox.stats()["retried"] == attempt + 1)
+        advance(clock, 2 ** attempt)
+
+    with pytest.raises(NetworkError):
+        future.result(timeout=5)
+    assert len(bot.sent) == 3
+
+
+def test_timed_out_send_is_not_retried(clock, bot):
+    Outbox.setup(workers=1)
+    bot.outcomes[1] = [TimedOut()]
+    failed = Outbox.submit(1, bot.send(1, "first"))
+    sent = Outbox.submit(1, bot.send(1, "second"))
+
+    with pytest.raises(TimedOut):
+        failed.result(timeout=5)
+    assert sent.result(timeout=5) == "second"
+    assert Outbox.stats()["retried"] == 0
@@ -0,0 +1,113 @@
+"""
+Tests of `WritePipeline` batching and failure handling, against a fake backend
+"""
+import threading
+from typing import Any, Dict, Hashable, List, Set
+
+import pytest
+
+from utils.write_pipeline import WritePipeline
+
+
+class FakeBackend(object):
+    """
+    Records flushed batches, fails batches with a bad key or all of them while `down`
+    """
+
+    def __init__(self, bad_keys: Set[Hashable] = frozenset()):
+        self.batches: List[Dict[Hashable, Any]] = []
+        self.bad_keys = bad_keys
+        self.down = False
+        self.attempts = 0
+        self.lock = threading.Lock()
+
+    def flush(self, batch: Dict[Hashable, Any]) -> None:
+        with self.lock:
+            self.attempts += 1
+            if self.down:
+                raise ConnectionError("db is down")
+            if self.bad_keys & batch.keys():
+                raise ValueError("bad update")
+            self.batches.append(batch)
+
+
+def by_user(key: tuple) -> int:
+    return key[0]
+
+
+@pytest.fixture
+def backend():
+    return FakeBackend()
+
+
+def test_updates_are_merged_into_one_flush_on_close(backend):
+    pipeline = WritePipeline(backend.flush, max_delay=60, merge=lambda pending, value: pending + value)
+    pipeline.start()
+    futures = [pipeline.submit({"a": 1}), pipeline.submit({"a": 2, "b": 3})]
+    assert not any(future.done() for future in futures)
+    pipeline.close()
+
+    assert backend.batches == [{"a": 3, "b": 3}]
+    assert [future.result(timeout=0) for future in futures] == [None, None]
+
+
+def test_flushes_once_batch_is_full(backend):
+    pipeline = WritePipeline(backend.flush, max_batch_size=2, max_delay=60)
+    pipeline.start()
+    first = pipeline.submit({"a": 1})
+    second = pipeline.submit({"b": 2})
+    second.result(timeout=5)
+
+    assert first.done()
+    assert backend.batches == [{"a": 1, "b": 2}]
+    pipeline.close()
+
+
+def test_flushes_after_max_delay(backend):
+    pipeline = WritePipeline(backend.flush, max_delay=0.05)
+    pipeline.start()
+    pipeline.submit({"a": 1}).result(timeout=5)
+
+    assert backend.batches == [{"a": 1}]
+    pipeline.close()
+
+
+def test_failed_batch_is_written_by_group():
+    backend = FakeBackend(bad_keys={(2, 20)})
+    pipeline = WritePipeline(backend.flush, max_delay=60, group=by_user)
+    futures = {
+        key: pipeline.submit({key: "value"}) for key in [(1, 10), (2, 20), (2, 21), (3, 30)]
+    }
+    both = pipeline.submit({(1, 11): "value", (2, 22): "value"})
+    pipeline.close()
+
+    assert backend.batches == [{(1, 10): "value", (1, 11): "value"}, {(3, 30): "value"}]
+    assert futures[1, 10].result(timeout=0) is None
+    assert futures[3, 30].result(timeout=0) is None
+    for future in (futures[2, 20], futures[2, 21], both):
+        with pytest.raises(ValueError):
+            future.result(timeout=0)
+
+
+def test_gives_up_after_max_failed_groups(backend):
+    backend.down = True
+    pipeline = WritePipeline(backend.flush, max_delay=60, group=by_user)
+    futures = [pipeline.submit({(user_id, 1): "value"}) for user_id in range(10)]
+    pipeline.close()
+
+    # the whole batch, and then groups until `max_failed_groups` have failed in a row
+    assert backend.attempts == 1 + WritePipeline.max_failed_groups
+    for future in futures:
+        with pytest.raises(ConnectionError):
+            future.result(timeout=0)
+
+
+def test_close_flushes_pending_updates_when_not_started(backend):
+    pipeline = WritePipeline(backend.flush, max_delay=60)
+    future = pipeline.submit({"a": 1})
+    pipeline.close()
+
+    assert future.result(timeout=0) is None
+    assert backend.batches == [{"a": 1}]
+    with pytest.raises(RuntimeError):
+        pipeline.submit({"b": 2})
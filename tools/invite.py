@@ -0,0 +1,25 @@
+"""
+Invites (or revokes) users of the bot.
+
+Usage: `python -m tools.invite [--revoke] USER_ID...`, storage is configured by the same env vars as `main.py`.
+"""
+import argparse
+import os
+
+from main import setup_storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Invite users to the bot")
+    parser.add_argument("user_ids", metavar="USER_ID", type=int, nargs="+", help="telegram user id")
+    parser.add_argument("--revoke", action="store_true", help="revoke access instead")
+    args = parser.parse_args()
+
+    backend = setup_storage(bool(os.environ.get("DEBUG")))
+    for user_id in args.user_ids:
+        backend.set_user_invited(user_id, not args.revoke)
+    backend.close()
+
+
+if __name__ == "__main__":
+    main()
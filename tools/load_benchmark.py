@@ -0,0 +1,392 @@
+"""
+Measures throughput and latency of update processing, offline.
+
+The real `Bot` dispatcher with all registered handlers is fed synthetic update streams at a target rate.
+Bot API requests are answered locally and `firebase_admin.db` is replaced by an in-memory database,
+both with configurable latency, so results only depend on the code, the machine and the given latencies.
+Every scenario runs in a fresh process.
+
+Latency of an update is the time from it being queued until all of its handlers have returned. Edits are saved
+after a debounce by a job, which is not included.
+
+Usage: `python -m tools.load_benchmark [--scenarios entry,edit,...] [--users N] [--rate R] [--output FILE]
+[--baseline FILE] [--save-baseline]`, exits with status 1 if a scenario has regressed against the baseline.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+token = "123456:benchmark"
+
+
+class FakeDatabase(object):
+    """
+    In-memory stand-in for `firebase_admin.db`, supporting what `FirebaseBackend` uses
+    """
+
+    # types used in annotations of `FirebaseBackend`
+    Reference = object
+    Event = object
+
+    def __init__(self, latency: float):
+        """
+        :param latency: time (in seconds) every request takes
+        """
+        self.latency = latency
+        self.data: Dict[str, Any] = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def reference(self, path: str = "") -> "FakeReference":
+        return FakeReference(self, [part for part in path.split("/") if part])
+
+    def request(self, fn: Callable[[], Any]) -> Any:
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            return fn()
+
+    def get_node(self, parts: List[str]) -> Any:
+        node: Any = self.data
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def set_node(self, parts: List[str], value: Any) -> None:
+        if isinstance(value, dict) and ".sv" in value:
+            # server value, only increments are supported
+            current = self.get_node(parts)
+            value = (current if isinstance(current, int) else 0) + value[".sv"]["increment"]
+        node = self.data
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = json.loads(json.dumps(value))
+
+
+class FakeReference(object):
+    def __init__(self, database: FakeDatabase, parts: List[str]):
+        self.database = database
+        self.parts = parts
+
+    def get(self, shallow: bool = False) -> Any:
+        def read():
+            node = self.database.get_node(self.parts)
+            if shallow and isinstance(node, dict):
+                return {key: True for key in node}
+            return json.loads(json.dumps(node))
+
+        return self.database.request(read)
+
+    def set(self, value: Any) -> None:
+        self.database.request(lambda: self.database.set_node(self.parts, value))
+
+    def update(self, values: Dict[str, Any]) -> None:
+        def write():
+            for path, value in values.items():
+                self.database.set_node(self.parts + [part for part in path.split("/") if part], value)
+
+        self.database.request(write)
+
+    def listen(self, callback: Callable) -> Any:
+        raise NotImplementedError("Streaming is not supported")
+
+    def order_by_key(self) -> "FakeQuery":
+        return FakeQuery(self)
+
+
+class FakeQuery(object):
+    def __init__(self, reference: FakeReference):
+        self.reference = reference
+        self.start: Optional[str] = None
+        self.end: Optional[str] = None
+        self.limit: Optional[int] = None
+
+    def start_at(self, start: str) -> "FakeQuery":
+        self.start = start
+        return self
+
+    def end_at(self, end: str) -> "FakeQuery":
+        self.end = end
+        return self
+
+    def limit_to_first(self, limit: int) -> "FakeQuery":
+        self.limit = limit
+        return self
+
+    def get(self) -> Dict[str, Any]:
+        node = self.reference.get()
+        if not isinstance(node, dict):
+            return {}
+        keys = [
+            key for key in sorted(node)
+            if (self.start is None or key >= self.start) and (self.end is None or key <= self.end)
+        ]
+        return {key: node[key] for key in keys[:self.limit]}
+
+
+class SyntheticUser(object):
+    """
+    Builds updates sent by a single user
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.message_id = 0
+
+    def message(self, text: Optional[str] = None, **fields) -> dict:
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": {"id": self.user_id, "is_bot": False, "first_name": f"User {self.user_id}"},
+            **fields,
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+
+    def photo(self, media_group_id: Optional[str] = None) -> dict:
+        file_id = f"photo-{self.user_id}-{self.message_id + 1}"
+        fields: Dict[str, Any] = {
+            "photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 600}],
+            "caption": "Photo",
+        }
+        if media_group_id is not None:
+            fields["media_group_id"] = media_group_id
+        return self.message(**fields)
+
+    def edit(self, update: dict, text: str) -> dict:
+        edited = dict(update["message"], text=text, edit_date=int(time.time()))
+        return {"edited_message": edited}
+
+
+def entry_scenario(user: SyntheticUser) -> List[dict]:
+    entry = user.message("Today I have benchmarked the bot")
+    return [entry, user.message("Yes")]
+
+
+def cancelled_entry_scenario(user: SyntheticUser) -> List[dict]:
+    return [user.message("Never mind"), user.message("No")]
+
+
+def customdate_scenario(user: SyntheticUser) -> List[dict]:
+    return [user.message("/customdate"), user.message("2024-01-02"), user.message("Written for another day")]
+
+
+def edit_scenario(user: SyntheticUser) -> List[dict]:
+    entry = user.message("First version")
+    return [entry, user.message("Yes")] + [user.edit(entry, f"Version {i}") for i in range(2, 5)]
+
+
+def album_scenario(user: SyntheticUser) -> List[dict]:
+    media_group_id = f"album-{user.user_id}"
+    return [user.photo(media_group_id) for _ in range(3)] + [user.message("Yes")]
+
+
+def timezone_scenario(user: SyntheticUser) -> List[dict]:
+    return [user.message("/timezone"), user.message("Europe"), user.message("Paris")]
+
+
+scenarios: Dict[str, Callable[[SyntheticUser], List[dict]]] = {
+    "entry": entry_scenario,
+    "cancelled_entry": cancelled_entry_scenario,
+    "customdate": customdate_scenario,
+    "edit": edit_scenario,
+    "album": album_scenario,
+    "timezone": timezone_scenario,
+}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_child(scenario: str, users: int, rate: float, workers: int, db_latency: float, telegram_latency: float):
+    """
+    Runs in a fresh process: replays scenario of every user through the bot, prints results
+    """
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    from telegram.utils.request import Request
+
+    import bot
+    from utils import Dao
+    from utils.outbox import Outbox
+    from utils.storage import FirebaseBackend
+    from utils.storage import firebase_backend
+
+    database = FakeDatabase(db_latency)
+    firebase_backend.db = database
+    first_user_id = 1000
+    database.data["benchmark"] = {"invited_users": {str(first_user_id + i): True for i in range(users)}}
+
+    class LocalRequest(Request):
+        """
+        Answers Bot API requests without network
+        """
+
+        def post(self, url, data, timeout=None):
+            time.sleep(telegram_latency)
+            method = url.rsplit("/", 1)[-1]
+            if method == "getMe":
+                return {"id": 1, "is_bot": True, "first_name": "Libreta", "username": "libreta_bot"}
+            if method == "sendMessage":
+                chat = {"id": data["chat_id"], "type": "private"}
+                return {"message_id": 1, "date": int(time.time()), "chat": chat, "text": data["text"]}
+            return True
+
+    Dao.setup(FirebaseBackend("benchmark"))
+    Dao.setup_invited_users_cache(300)
+    Dao.setup_write_pipeline(500, 0.2)
+    Outbox.setup(workers=8)
+    request = LocalRequest(con_pool_size=workers + 8)
+    fns_bot = bot.Bot(token, workers=workers, worker_queue_size=10000, request=request)
+    dispatcher = fns_bot.updater.dispatcher
+
+    # build update stream, updates of different users interleaved
+    streams = [scenarios[scenario](SyntheticUser(first_user_id + i)) for i in range(users)]
+    stream = []
+    for i in range(max(len(updates) for updates in streams)):
+        stream += [updates[i] for updates in streams if i < len(updates)]
+    for update_id, update in enumerate(stream):
+        update["update_id"] = update_id
+
+    queued_at: Dict[int, float] = {}
+    latencies: List[float] = []
+    errors = []
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def on_processed(update: Update, _):
+        latency = time.perf_counter() - queued_at[update.update_id]
+        with lock:
+            latencies.append(latency)
+            if len(latencies) == len(stream):
+                done.set()
+
+    # runs after handlers of default group
+    dispatcher.add_handler(TypeHandler(Update, on_processed), group=1)
+    dispatcher.add_error_handler(lambda _, context: errors.append(repr(context.error)))
+    fns_bot.updater.job_queue.start()
+    threading.Thread(target=dispatcher.start, name="dispatcher", daemon=True).start()
+    while not dispatcher.running:
+        time.sleep(0.01)
+
+    started_at = time.perf_counter()
+    for i, data in enumerate(stream):
+        if rate > 0:
+            delay = started_at + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        update = Update.de_json(data, dispatcher.bot)
+        queued_at[update.update_id] = time.perf_counter()
+        dispatcher.update_queue.put(update)
+    done.wait(300)
+    seconds = time.perf_counter() - started_at
+
+    fns_bot.updater.stop()
+    Outbox.close()
+    Dao.close()
+    latencies.sort()
+    print(json.dumps({
+        "updates": len(latencies),
+        "errors": len(errors),
+        "seconds": seconds,
+        "updates_per_second": len(latencies) / seconds,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "db_requests": database.requests,
+    }))
+
+
+def run_scenario(scenario: str, args: argparse.Namespace) -> dict:
+    output = subprocess.run(
+        [
+            sys.executable, "-m", "tools.load_benchmark", "--child", scenario,
+            "--users", str(args.users),
+            "--rate", str(args.rate),
+            "--workers", str(args.workers),
+            "--db-latency", str(args.db_latency),
+            "--telegram-latency", str(args.telegram_latency),
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def regressions(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """
+    :return: descriptions of scenarios, that are slower than baseline by more than `tolerance` (a fraction)
+    """
+    found = []
+    for scenario, result in results.items():
+        expected = baseline.get(scenario)
+        if expected is None:
+            continue
+        if result["updates_per_second"] < expected["updates_per_second"] * (1 - tolerance):
+            found.append(f"{scenario}: {result['updates_per_second']:.1f} updates/s, "
+                         f"baseline {expected['updates_per_second']:.1f}")
+        if result["p95"] > expected["p95"] * (1 + tolerance):
+            found.append(f"{scenario}: p95 {result['p95'] * 1000:.1f}ms, baseline {expected['p95'] * 1000:.1f}ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure update throughput and latency of the bot")
+    parser.add_argument("--scenarios", default=",".join(scenarios), help="comma separated scenarios to run")
+    parser.add_argument("--users", type=int, default=50, help="number of simulated users")
+    parser.add_argument("--rate", type=float, default=200, help="updates per second, 0 to send all at once")
+    parser.add_argument("--workers", type=int, default=8, help="number of handler workers")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="latency (in seconds) of db requests")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="latency (in seconds) of Bot API")
+    parser.add_argument("--output", help="file to write results to, as JSON")
+    parser.add_argument("--baseline", default=os.path.join(".cache", "load_benchmark_baseline.json"),
+                        help="file with baseline results")
+    parser.add_argument("--save-baseline", action="store_true", help="replace baseline with these results")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against baseline")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        run_child(args.child, args.users, args.rate, args.workers, args.db_latency, args.telegram_latency)
+        return
+
+    results = {}
+    for scenario in args.scenarios.split(","):
+        results[scenario] = run_scenario(scenario, args)
+        print(json.dumps({"scenario": scenario, **results[scenario]}))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Rewrites legacy diary entries (raw `Message.to_dict()` payloads) into the compact schema of `utils.entry_schema`.
+
+Entries are streamed user by user, page by page, and written back in chunks, so memory use does not depend on db size.
+Already compact entries are skipped, so the migration may be safely interrupted and run again.
+
+Usage: `python -m tools.migrate_entries [--chunk-size N] [--dry-run]`,
+storage is configured by the same env vars as `main.py`.
+"""
+import argparse
+import logging
+import os
+from typing import List
+
+from main import setup_storage
+from utils import entry_schema
+from utils.storage import EntryWrite
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate diary entries to compact schema")
+    parser.add_argument("--chunk-size", type=int, default=500, help="number of entries written at once")
+    parser.add_argument("--page-size", type=int, default=100, help="number of dates read at once")
+    parser.add_argument("--dry-run", action="store_true", help="only count entries to be migrated")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    backend = setup_storage(bool(os.environ.get("DEBUG")))
+    chunk: List[EntryWrite] = []
+    total = migrated = 0
+
+    def write_chunk():
+        if chunk and not args.dry_run:
+            backend.write_entries(chunk)
+        chunk.clear()
+
+    for user_id in backend.iter_user_ids():
+        for entry in backend.iter_entries(user_id, page_size=args.page_size):
+            total += 1
+            if entry_schema.is_compact(entry.content):
+                continue
+            chunk.append(entry._replace(content=entry_schema.compact_dict(entry.content)))
+            migrated += 1
+            if len(chunk) >= args.chunk_size:
+                write_chunk()
+                logging.info(f"Migrated {migrated} of {total} entries read so far.")
+    write_chunk()
+    logging.info(f"Done: {migrated} of {total} entries {'to be ' if args.dry_run else ''}migrated.")
+    backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Recounts month index (date -> number of entries) of users, e.g. for entries published before the index existed.
+
+The index of a user is overwritten as a whole, so it should be run while the bot is stopped.
+
+Usage: `python -m tools.rebuild_month_index [USER_ID...]` (all users by default),
+storage is configured by the same env vars as `main.py`.
+"""
+import argparse
+import logging
+import os
+
+from main import setup_storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild month index of entries")
+    parser.add_argument("user_ids", metavar="USER_ID", type=int, nargs="*", help="telegram user id")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    backend = setup_storage(bool(os.environ.get("DEBUG")))
+    user_ids = args.user_ids or backend.iter_user_ids()
+    count = 0
+    for user_id in user_ids:
+        backend.rebuild_month_index(user_id)
+        count += 1
+    logging.info(f"Rebuilt month index of {count} users.")
+    backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Rebuilds search index of users from their entries in db, e.g. to index entries published before the index existed.
+Entries are streamed page by page, so that no user is read at once.
+
+Users not indexed this way are indexed on their first search instead. Index files are replaced,
+so it should be run while the bot is stopped.
+
+Usage: `python -m tools.rebuild_search_index [USER_ID...]` (all users by default),
+storage is configured by the same env vars as `main.py`.
+"""
+import argparse
+import logging
+import os
+
+from main import cache_dir, setup_storage
+from utils.search_index import SearchIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild search index of entries")
+    parser.add_argument("user_ids", metavar="USER_ID", type=int, nargs="*", help="telegram user id")
+    parser.add_argument("--page-size", type=int, default=100, help="number of dates read at once")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    backend = setup_storage(bool(os.environ.get("DEBUG")))
+    # indexes are saved as soon as they are evicted, so only a few users are kept in memory
+    index = SearchIndex(os.path.join(cache_dir, "search"), max_users=1)
+    os.makedirs(index.directory, exist_ok=True)
+    user_ids = args.user_ids or backend.iter_user_ids()
+    users, entries = 0, 0
+    for user_id in user_ids:
+        entries += index.rebuild(user_id, backend.iter_entries(user_id, page_size=args.page_size))
+        users += 1
+    index.close()
+    logging.info(f"Indexed {entries} entries of {users} users.")
+    backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+Computes aggregates behind `/stats` of users from their entries, e.g. for entries published before aggregates existed.
+Entries of a user are streamed in a single pass.
+
+The aggregates of a user are overwritten as a whole, so it should be run while the bot is stopped.
+
+Usage: `python -m tools.rebuild_stats [USER_ID...]` (all users by default),
+storage is configured by the same env vars as `main.py`.
+"""
+import argparse
+import logging
+import os
+
+from main import setup_storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild aggregates of entries")
+    parser.add_argument("user_ids", metavar="USER_ID", type=int, nargs="*", help="telegram user id")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    backend = setup_storage(bool(os.environ.get("DEBUG")))
+    user_ids = args.user_ids or backend.iter_user_ids()
+    count = 0
+    for user_id in user_ids:
+        backend.rebuild_aggregates(user_id)
+        count += 1
+    logging.info(f"Rebuilt aggregates of {count} users.")
+    backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Measures cold start of the bot: time to import `main`, and time from process start until the first update is answered.
+
+Every run is a fresh process with a SQLite backend in a temporary directory and Bot API requests answered locally,
+so results only depend on the code and the machine. Medians are printed as JSON, so that CI can track them.
+
+Usage: `python -m tools.startup_benchmark [--runs N] [--output FILE] [--max-import S] [--max-first-update S]`,
+exits with status 1 if a budget is exceeded.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+token = "123456:benchmark"
+first_update = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 1, "type": "private"},
+        "from": {"id": 1, "is_bot": False, "first_name": "Benchmark"},
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    },
+}
+
+
+def run_child(started_at: float) -> None:
+    """
+    Runs in a fresh process: starts the bot, processes `first_update`, prints timings
+    """
+    import_started_at = time.perf_counter()
+    import main
+    import_seconds = time.perf_counter() - import_started_at
+
+    from telegram import Update
+    from telegram.utils.request import Request
+
+    import bot
+
+    replied = threading.Event()
+
+    class LocalRequest(Request):
+        """
+        Answers Bot API requests without network
+        """
+
+        def post(self, url, data, timeout=None):
+            method = url.rsplit("/", 1)[-1]
+            if method == "getMe":
+                return {"id": 1, "is_bot": True, "first_name": "Libreta", "username": "libreta_bot"}
+            if method == "sendMessage":
+                replied.set()
+                return {"message_id": 2, "date": 0, "chat": {"id": data["chat_id"], "type": "private"}, "text": ""}
+            return True
+
+    main.setup_storage(False)
+    fns_bot = bot.Bot(token, request=LocalRequest())
+    dispatcher = fns_bot.updater.dispatcher
+    dispatcher.process_update(Update.de_json(first_update, dispatcher.bot))
+    replied.wait(30)
+    print(json.dumps({"import": import_seconds, "first_update": time.time() - started_at}))
+
+
+def run_once() -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, STORAGE_BACKEND="sqlite", SQLITE_PATH=os.path.join(directory, "benchmark.sqlite3"))
+        started_at = time.time()
+        output = subprocess.run(
+            [sys.executable, "-m", "tools.startup_benchmark", "--child", str(started_at)],
+            env=env,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure startup time of the bot")
+    parser.add_argument("--runs", type=int, default=5, help="number of measured runs")
+    parser.add_argument("--output", help="file to write results to, as JSON")
+    parser.add_argument("--max-import", type=float, help="budget (in seconds) of importing main")
+    parser.add_argument("--max-first-update", type=float, help="budget (in seconds) of answering first update")
+    parser.add_argument("--child", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        run_child(args.child)
+        return
+
+    runs = [run_once() for _ in range(args.runs)]
+    results = {
+        "runs": args.runs,
+        "import": statistics.median(run["import"] for run in runs),
+        "first_update": statistics.median(run["first_update"] for run in runs),
+    }
+    print(json.dumps(results))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f)
+    over_budget = (args.max_import is not None and results["import"] > args.max_import) or (
+        args.max_first_update is not None and results["first_update"] > args.max_first_update
+    )
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ from telegram.ext import CallbackContext, MessageHandler, Filters
 
 from strings import Strings
 from utils import Dao
+from utils.outbox import Outbox
 
 content_filters = (Filters.text & (~Filters.command)) | Filters.photo | Filters.document
 
@@ -57,12 +58,12 @@ def save_message_content_by_date(
 
     :param user_date: Date that will be associated with content
     """
-    # upload to db
+    # upload to db, wait until it is written
     message_id = update.effective_message.message_id
-    Dao.publish(update.effective_user, user_date, update.effective_message)
+    Dao.publish(update.effective_user, user_date, update.effective_message).result()
     # reply to user
-    update.effective_message.reply_text(
-        Strings.published(user_date), reply_to_message_id=message_id
+    Outbox.reply(
+        update.effective_message, Strings.published(user_date), reply_to_message_id=message_id
     )
 
 
@@ -70,5 +71,5 @@ def prompt_content_input(update: Update, _: CallbackContext):
     """
     Prompts user to enter content
     """
-    update.effective_message.reply_text(Strings.please_enter_content)
+    Outbox.reply(update.effective_message, Strings.please_enter_content)
     return ContentEnums.AWAITING_CONTENT
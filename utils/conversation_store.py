@@ -0,0 +1,244 @@
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, OrderedDict
+from enum import Enum
+from typing import Any, DefaultDict, Dict, Optional, Set, Tuple
+
+from telegram.ext import BasePersistence, Dispatcher
+from telegram.ext.utils.types import ConversationDict
+
+
+def _encode_state(state: object) -> Any:
+    """
+    Makes conversation state JSON-serializable. States are usually members of an `Enum`.
+    """
+    if isinstance(state, Enum):
+        return {"enum": f"{type(state).__module__}:{type(state).__qualname__}", "name": state.name}
+    return state
+
+
+def _decode_state(state: Any) -> object:
+    if isinstance(state, dict) and "enum" in state:
+        module, qualname = state["enum"].split(":")
+        enum_cls = importlib.import_module(module)
+        for part in qualname.split("."):
+            enum_cls = getattr(enum_cls, part)
+        return enum_cls[state["name"]]
+    return state
+
+
+class ConversationStore(BasePersistence):
+    """
+    Bounded, persistent store of conversation states and `user_data`.
+
+    State is kept per user: state of users idle for longer than `ttl` is evicted,
+    and least recently active users are evicted when total (JSON) size of state exceeds `max_bytes`.
+
+    State is persisted to an append-only log, one record per changed user. Records are written in batches by `flush`,
+    and the log is compacted on startup (and whenever it grows too large), so a restart resumes pending conversations.
+    """
+
+    def __init__(self, filename: Optional[str], ttl: float = 3600, max_bytes: int = 16 << 20):
+        """
+        :param filename: path to log file, `None` to keep state in memory only
+        :param ttl: time (in seconds) after which state of an idle user is evicted
+        :param max_bytes: max total size of state
+        """
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.filename = filename
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.dispatcher: Optional[Dispatcher] = None
+        self._conversations: Dict[str, ConversationDict] = {}
+        self._user_data: DefaultDict[int, dict] = defaultdict(dict)
+        # user id -> (conversation name, key) of user's conversations
+        self._user_keys: DefaultDict[int, Set[Tuple[str, tuple]]] = defaultdict(set)
+        # user id -> (wall clock) time of last activity, least recently active first
+        self._activity: "OrderedDict[int, float]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._total_size = 0
+        self._dirty: Set[int] = set()
+        self._log_records = 0
+        self._lock = threading.RLock()
+        self._load()
+
+    def set_dispatcher(self, dispatcher: Dispatcher) -> None:
+        """
+        Dispatcher keeps its own copy of `user_data`, it is needed to evict from it as well
+        """
+        self.dispatcher = dispatcher
+
+    # BasePersistence API
+
+    def get_user_data(self) -> DefaultDict[int, dict]:
+        return self._user_data
+
+    def get_chat_data(self) -> DefaultDict[int, dict]:
+        return defaultdict(dict)
+
+    def get_bot_data(self) -> dict:
+        return {}
+
+    def get_conversations(self, name: str) -> ConversationDict:
+        with self._lock:
+            return self._conversations.setdefault(name, {})
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        if isinstance(new_state, tuple):
+            # state of a still running async handler, keep the old one
+            new_state = new_state[0]
+        with self._lock:
+            # the dict is shared with `ConversationHandler`, so it has usually been updated already
+            conversations = self._conversations.setdefault(name, {})
+            # conversations are keyed by (chat id, user id) by default
+            user_id = key[-1]
+            if new_state is None:
+                conversations.pop(key, None)
+                self._user_keys[user_id].discard((name, key))
+            else:
+                conversations[key] = new_state
+                self._user_keys[user_id].add((name, key))
+            self._touch(user_id)
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        with self._lock:
+            # `BasePersistence` passes a copy of dispatcher's `user_data`, so it is compared with the stored one
+            if self._user_data.get(user_id, {}) == data:
+                if user_id not in self._activity:
+                    # dispatcher creates empty `user_data` of every user it sees, it is evicted along with state
+                    self._activity[user_id] = time.time()
+                return
+            self._user_data[user_id] = data
+            self._touch(user_id)
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    def update_bot_data(self, data: dict) -> None:
+        pass
+
+    def flush(self) -> None:
+        """
+        Appends records of users, whose state has changed since last flush, to the log
+        """
+        with self._lock:
+            records = [self._record(user_id) for user_id in self._dirty]
+            self._dirty.clear()
+            if not records or self.filename is None:
+                return
+            with open(self.filename, "a") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+            self._log_records += len(records)
+            if self._log_records > 4 * max(len(self._sizes), 256):
+                self._compact()
+        logging.debug(f"Flushed conversation state of {len(records)} users.")
+
+    # eviction
+
+    def evict(self) -> int:
+        """
+        Evicts state of idle users, and of least recently active users if over memory cap.
+
+        :return: number of users evicted
+        """
+        now = time.time()
+        evicted = 0
+        with self._lock:
+            while self._activity:
+                user_id, last_active = next(iter(self._activity.items()))
+                if now - last_active <= self.ttl and self._total_size <= self.max_bytes:
+                    break
+                self._drop(user_id)
+                evicted += 1
+        if evicted:
+            logging.info(f"Evicted conversation state of {evicted} users.")
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: number of users with state and total size of state in bytes
+        """
+        return {"users": len(self._activity), "bytes": self._total_size}
+
+    # internals
+
+    def _touch(self, user_id: int, active_at: Optional[float] = None) -> None:
+        self._activity[user_id] = time.time() if active_at is None else active_at
+        self._activity.move_to_end(user_id)
+        self._dirty.add(user_id)
+        size = len(json.dumps(self._record(user_id)))
+        self._total_size += size - self._sizes.get(user_id, 0)
+        self._sizes[user_id] = size
+
+    def _drop(self, user_id: int) -> None:
+        self._activity.pop(user_id, None)
+        if user_id in self._sizes:
+            # users with no state (e.g. empty `user_data`) are never written to the log
+            self._dirty.add(user_id)
+        self._total_size -= self._sizes.pop(user_id, 0)
+        self._user_data.pop(user_id, None)
+        if self.dispatcher is not None:
+            self.dispatcher.user_data.pop(user_id, None)
+        for name, key in self._user_keys.pop(user_id, ()):
+            self._conversations[name].pop(key, None)
+
+    def _record(self, user_id: int) -> dict:
+        """
+        :return: JSON-serializable state of a single user
+        """
+        conversations: Dict[str, list] = {}
+        for name, key in self._user_keys.get(user_id, ()):
+            state = self._conversations[name].get(key)
+            if state is not None:
+                conversations.setdefault(name, []).append([list(key), _encode_state(state)])
+        return {
+            "user_id": user_id,
+            "active_at": self._activity.get(user_id),
+            "user_data": self._user_data.get(user_id, {}),
+            "conversations": conversations,
+        }
+
+    def _apply(self, record: dict) -> None:
+        user_id = record["user_id"]
+        self._drop(user_id)
+        for name, states in record["conversations"].items():
+            for key, state in states:
+                self._conversations.setdefault(name, {})[tuple(key)] = _decode_state(state)
+                self._user_keys[user_id].add((name, tuple(key)))
+        if record["user_data"]:
+            self._user_data[user_id] = record["user_data"]
+        if record["user_data"] or record["conversations"]:
+            self._touch(user_id, record["active_at"])
+
+    def _load(self) -> None:
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        with self._lock:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError, AttributeError) as e:
+                        # e.g. truncated last line after a crash, or a state that no longer exists
+                        logging.warning(f"Skipping conversation state record: {e}")
+            # least recently active first
+            self._activity = OrderedDict(sorted(self._activity.items(), key=lambda item: item[1]))
+            self._compact()
+        logging.info(f"Loaded conversation state of {len(self._activity)} users.")
+
+    def _compact(self) -> None:
+        """
+        Rewrites log to contain only a single record per user with state
+        """
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            for user_id in self._activity:
+                if user_id in self._sizes:
+                    f.write(json.dumps(self._record(user_id)) + "\n")
+        os.replace(tmp_filename, self.filename)
+        self._log_records = len(self._sizes)
+        self._dirty.clear()
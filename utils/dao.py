@@ -1,29 +1,209 @@
 import datetime
+import functools
 import logging
-import os
+import shutil
+from concurrent.futures import Future
 from datetime import date
-from typing import Optional, Union
+from typing import Optional, Union, Dict, Any, Iterator, List, Tuple
 
 import pytz
-from firebase_admin import db
-from telegram import User, Message
+from telegram import Bot, User, Message
 
-# get db root, depending on whether app is running in production
-db_root: str
-if os.environ.get("DEBUG") is None:
-    db_root = "libreta"  # production db
-else:
-    db_root = "libreta-test"  # test db
+from utils import entry_schema
+from utils.cache import TTLCache
+from utils.invited_users import InvitedUsersCache
+from utils.journal import WriteJournal
+from utils.media_archive import MediaArchive
+from utils.metrics import instrument_method
+from utils.published_dates import PublishedDates
+from utils.search_index import SearchIndex
+from utils.stats import UserStats, summarize
+from utils.storage import StorageBackend, EntryWrite
+from utils.write_pipeline import WritePipeline
+
+
+@functools.lru_cache(maxsize=None)
+def get_zone(tz_name: str) -> datetime.tzinfo:
+    """
+    Gets timezone object by its name. Zone objects are shared between all users.
+    """
+    return pytz.timezone(tz_name)
 
 
 class Dao(object):
     """
-    Data Access Object for realtime database.
+    Data Access Object for diary storage.
 
     Implements API for saving content, checking user authorization status, etc.
+    Actual storage is delegated to a `StorageBackend`, set by `setup`.
     """
 
-    root = db_root
+    backend: Optional[StorageBackend] = None
+    invited_users: Optional[InvitedUsersCache] = None
+    # user id -> user profile (e.g. `{"timezone": "Europe/Paris"}`)
+    profile_cache = TTLCache(max_size=10000, ttl=3600)
+    # (user id, message id) -> (ISO date, compact entry), date is `None` for messages that are not diary content,
+    # entry is `None` if only date is known
+    message_cache = TTLCache(max_size=10000, ttl=3600)
+
+    write_pipeline: Optional[WritePipeline] = None
+    journal: Optional[WriteJournal] = None
+    media_archive: Optional[MediaArchive] = None
+    search_index: Optional[SearchIndex] = None
+    # users who have published recently, by date
+    published_dates = PublishedDates()
+
+    @classmethod
+    def setup(cls, backend: StorageBackend) -> None:
+        """
+        Sets storage backend, has to be called before any other method.
+        """
+        # record calls of every backend method in metrics
+        for method_name in sorted(StorageBackend.__abstractmethods__):
+            instrument_method(backend, method_name)
+        cls.backend = backend
+
+    @classmethod
+    def setup_write_pipeline(cls, max_batch_size: int, max_delay: float) -> None:
+        """
+        Makes `publish` batch writes of all users into periodic backend writes.
+
+        :param max_batch_size: number of pending entries that triggers a flush
+        :param max_delay: max time (in seconds) a write may wait before being flushed
+        """
+        pipeline = WritePipeline(
+            cls._write, max_batch_size, max_delay, merge=cls._merge_writes, group=lambda key: key[0]
+        )
+        pipeline.start()
+        cls.write_pipeline = pipeline
+
+    @classmethod
+    def setup_journal(cls, directory: str, commit_delay: float, max_bytes: int) -> None:
+        """
+        Makes `publish` complete once content is in a local journal, from where it is applied to db in background.
+        Takes over batching from write pipeline.
+
+        :param directory: directory of journal
+        :param commit_delay: time (in seconds) writes are collected for, to be made durable together
+        :param max_bytes: size of journal that triggers trimming of writes applied to db
+        """
+        journal = cls._create_journal(directory, commit_delay, max_bytes)
+        journal.start()
+        cls.journal = journal
+
+    @classmethod
+    def replay_journal(cls, directory: str) -> bool:
+        """
+        Applies writes left in a journal that is no longer used (e.g. of a shard that no longer exists)
+
+        :return: `True` if all writes have been applied, and journal removed
+        """
+        journal = cls._create_journal(directory, 0, 1 << 30)
+        journal.start()
+        journal.close(timeout=60)
+        if journal.stats()["unapplied"] > 0:
+            return False
+        shutil.rmtree(directory)
+        return True
+
+    @classmethod
+    def _create_journal(cls, directory: str, commit_delay: float, max_bytes: int) -> WriteJournal:
+        return WriteJournal(
+            directory,
+            cls.backend.write_entries,
+            lambda user_id, message_id: cls.backend.get_message_date(user_id, message_id) is not None,
+            commit_delay=commit_delay,
+            max_bytes=max_bytes,
+        )
+
+    @classmethod
+    def setup_media_archive(cls, bot: Bot, directory: str, workers: int, byte_budget: int) -> None:
+        """
+        Makes published photos and documents be archived in background into a local store.
+
+        :param bot: bot, used to download files
+        :param directory: root of the store
+        :param workers: max number of concurrent downloads
+        :param byte_budget: max total size (in bytes) of the store
+        """
+        archive = MediaArchive(bot, directory, cls._record_archived, workers, byte_budget)
+        archive.start()
+        cls.media_archive = archive
+
+    @classmethod
+    def setup_search_index(cls, directory: str, max_users: int) -> None:
+        """
+        Makes published and edited content be indexed for `search`.
+
+        :param directory: directory of index files
+        :param max_users: max number of user indexes kept in memory
+        """
+        index = SearchIndex(directory, max_users)
+        index.start()
+        cls.search_index = index
+
+    @classmethod
+    def close(cls) -> None:
+        """
+        Flushes pending writes and releases db resources. Called on shutdown.
+        """
+        if cls.write_pipeline is not None:
+            cls.write_pipeline.close()
+            cls.write_pipeline = None
+        if cls.journal is not None:
+            cls.journal.close()
+            cls.journal = None
+        if cls.media_archive is not None:
+            cls.media_archive.close()
+            cls.media_archive = None
+        if cls.search_index is not None:
+            cls.search_index.close()
+            cls.search_index = None
+        if cls.invited_users is not None:
+            cls.invited_users.stop()
+        cls.backend.close()
+
+    @classmethod
+    def setup_profile_cache(cls, max_size: int, ttl: float) -> None:
+        """
+        Replaces user profile cache with one of given capacity.
+
+        :param max_size: max number of cached profiles
+        :param ttl: time (in seconds) after which a profile is read from db again
+        """
+        cls.profile_cache = TTLCache(max_size, ttl)
+
+    @classmethod
+    def setup_message_cache(cls, max_size: int, ttl: float) -> None:
+        """
+        Replaces cache of recently published messages with one of given capacity.
+
+        :param max_size: max number of cached messages
+        :param ttl: time (in seconds) after which a message is read from db again
+        """
+        cls.message_cache = TTLCache(max_size, ttl)
+
+    @classmethod
+    def cache_stats(cls) -> Dict[str, Dict[str, int]]:
+        """
+        :return: hit/miss counters of caches, by cache name
+        """
+        return {
+            "profiles": cls.profile_cache.stats(),
+            "messages": cls.message_cache.stats(),
+            "zones": get_zone.cache_info()._asdict(),
+        }
+
+    @classmethod
+    def setup_invited_users_cache(cls, max_staleness: float) -> None:
+        """
+        Makes authorization checks use an in-memory set of invited users, instead of querying db every time.
+
+        :param max_staleness: upper bound (in seconds) of how long a revoked user may keep access
+        """
+        cache = InvitedUsersCache(cls.backend, max_staleness)
+        cache.start()
+        cls.invited_users = cache
 
     @classmethod
     def is_user_authorized(cls, user: Optional[User]) -> bool:
@@ -35,7 +215,9 @@ class Dao(object):
         """
         if user is None:
             return False
-        return db.reference(f"{cls.root}/invited_users/{user.id}").get() is not None
+        if cls.invited_users is not None:
+            return cls.invited_users.contains(user.id)
+        return cls.backend.is_user_invited(user.id)
 
     @classmethod
     def has_published_on_date(cls, user: User, date: date) -> bool:
@@ -48,50 +230,238 @@ class Dao(object):
         :param user:
         :return:
         """
-        date_str = date.__str__()
-        return (
-            db.reference(f"{cls.root}/users/{user.id}/by_date/{date_str}").get()
-            is not None
-        )
+        return cls.backend.has_entries_on(user.id, date.__str__())
 
     @classmethod
-    def publish(cls, user: User, today: date, message: Message):
-        content = message.to_dict()
-        message_id = message.message_id
+    def publish(cls, user: User, today: date, message: Message, is_edit: bool = False) -> Future:
         """
         Uploads content to the database.
 
+        Content and its `message_date` index are written atomically.
+        If journal is set up, content is considered written once it is durable in the journal.
+        Otherwise, if write pipeline is set up, the write is batched with other pending writes.
+        Once content has been written, it is recorded in `published_dates` and in search index (if set up),
+        and its media is archived (if set up).
+
         :param user: User that provided content
         :param today: Date to be associated with following content
-        :param unique_message_id: Message id of content. If such content record exists, it will be overridden.
-        :param content: User content as dict.
+        :param message: Message with content. If such content record exists, it will be overridden.
+        :param is_edit: whether content has been published before, so that it is not counted again by month index
+        :return: future, that completes once content has been written
+        """
+        return cls._publish_entry(user, today, message.message_id, entry_schema.compact_entry(message), is_edit)
+
+    @classmethod
+    def publish_album(cls, user: User, today: date, messages: List[Message]) -> Future:
+        """
+        Uploads parts of an album as a single entry, keyed by its first message, see `publish`.
+
+        :param messages: parts of album, in order
         """
+        return cls._publish_entry(user, today, messages[0].message_id, entry_schema.album_entry(messages), False)
+
+    @classmethod
+    def _publish_entry(cls, user: User, today: date, message_id: int, entry: Dict[str, Any], is_edit: bool) -> Future:
         date_str = today.strftime("%Y-%m-%d")
-        db.reference(
-            f"{cls.root}/users/{user.id}/by_date/{date_str}/{message_id}"
-        ).update(content)
-        db.reference(
-            f"{cls.root}/users/{user.id}/message_date"
-        ).update({message_id: date_str})
+        updates = {(user.id, message_id): EntryWrite(user.id, date_str, message_id, entry, is_new=not is_edit)}
+        future: Future
+        # media is archived once entry is in db, as archived files are recorded in it
+        in_db: Optional[Future] = None
+        if cls.journal is not None:
+            future, in_db = cls.journal.append(list(updates.values()))
+        elif cls.write_pipeline is not None:
+            future = cls.write_pipeline.submit(updates)
+        else:
+            # no pipeline, write right away
+            future = Future()
+            try:
+                cls._write(updates)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+        archive = cls.media_archive
+
+        def on_written(written: Future) -> None:
+            # nothing to record, if content has not been written
+            if written.exception() is not None:
+                return
+            cls.message_cache.set((user.id, message_id), (date_str, entry))
+            if cls.search_index is not None:
+                cls.search_index.update(user.id, date_str, message_id, entry)
+            if not is_edit:
+                cls.published_dates.record(user.id, date_str)
+
+        def on_stored(stored: Future) -> None:
+            has_media = any("photo" in part or "document" in part for part in entry_schema.entry_parts(entry))
+            if stored.exception() is None and archive is not None and has_media:
+                archive.submit(user.id, date_str, message_id, entry)
+
+        future.add_done_callback(on_written)
+        (in_db or future).add_done_callback(on_stored)
+        return future
+
+    @classmethod
+    def import_entries(cls, user_id: int, writes: List[EntryWrite]) -> None:
+        """
+        Writes a chunk of imported entries of user in one backend write, bypassing journal and write pipeline.
+
+        Entries that are stored already (e.g. written before an interrupted import has been resumed) are not counted
+        again by month index. They are looked up by a single range read over dates of the chunk, as imported entries
+        come in date order.
+
+        :param user_id: importing user
+        :param writes: entries, all of them new
+        """
+        dates = [write.date for write in writes]
+        stored = {(entry.date, entry.message_id) for entry in cls.backend.iter_entries(user_id, min(dates), max(dates))}
+        writes = [write._replace(is_new=(write.date, write.message_id) not in stored) for write in writes]
+        cls.backend.write_entries(writes)
+        if cls.search_index is not None:
+            for write in writes:
+                cls.search_index.update(user_id, write.date, write.message_id, write.content)
+
+    @staticmethod
+    def _merge_writes(pending: EntryWrite, write: EntryWrite) -> EntryWrite:
+        """
+        Merges writes of the same entry, the later one wins. Entry stays new, if the pending write is, so that
+        it is still counted by month index and aggregates.
+        """
+        return write._replace(is_new=True) if pending.is_new else write
+
+    @classmethod
+    def _write(cls, updates: Dict[Any, EntryWrite]) -> None:
+        """
+        Writes entries by (user id, message id) in one backend write
+        """
+        cls.backend.write_entries(list(updates.values()))
+
+    @classmethod
+    def _record_archived(cls, user_id: int, date_str: str, message_id: int, files: Dict[str, str]) -> None:
+        """
+        Records locations of archived files of an entry
+        """
+        fields = {f"archive/{file_unique_id}": location for file_unique_id, location in files.items()}
+        cls.backend.update_entry(user_id, date_str, message_id, fields)
+
+    @classmethod
+    def iter_entries(
+            cls, user: User, start_date: Optional[date] = None, end_date: Optional[date] = None, page_size: int = 100
+    ) -> Iterator[EntryWrite]:
+        """
+        Streams entries of user ordered by date, reading them from db page by page
+
+        :param user: User whose entries they are
+        :param start_date: first date (inclusive), `None` to start from the very first entry
+        :param end_date: last date (inclusive), `None` to read up to the very last entry
+        :param page_size: number of dates read at once
+        """
+        return cls.backend.iter_entries(
+            user.id,
+            start_date and start_date.isoformat(),
+            end_date and end_date.isoformat(),
+            page_size,
+        )
+
+    @classmethod
+    def search(cls, user: User, query: str, limit: int, offset: int = 0) -> Tuple[int, List[EntryWrite]]:
+        """
+        Finds entries containing all words of query (the last one as a prefix), using search index.
+        User is indexed from db first, if not all of his entries are indexed yet.
+
+        :param user: User whose entries they are
+        :param query: words to be found
+        :param limit: max number of entries returned
+        :param offset: number of matching entries skipped, for paging
+        :return: number of all matching entries, and entries of requested page, newest first
+        """
+        if not cls.search_index.is_complete(user.id):
+            count = cls.search_index.rebuild(user.id, cls.backend.iter_entries(user.id))
+            logging.info(f"Indexed {count} entries of user {user.id} for search.")
+        refs = cls.search_index.search(user.id, query)
+        entries = []
+        for date_str, message_id in refs[offset:offset + limit]:
+            # only matching entries are read, recently published ones may not be in db yet
+            cached = cls.message_cache.get((user.id, message_id))
+            if cached is not None and cached[1] is not None:
+                content = cached[1]
+            else:
+                content = cls.backend.get_entry(user.id, date_str, message_id)
+            if content is not None:
+                entries.append(EntryWrite(user.id, date_str, message_id, content))
+        return len(refs), entries
+
+    @classmethod
+    def get_entry_counts(cls, user: User, start_date: date, end_date: date) -> Dict[str, int]:
+        """
+        Counts entries by date using month index, without reading the entries
+
+        :param user: User whose entries they are
+        :param start_date: first date (inclusive)
+        :param end_date: last date (inclusive)
+        :return: ISO date -> number of entries, for dates with entries, in date order
+        """
+        counts: Dict[str, int] = {}
+        month = start_date.replace(day=1)
+        while month <= end_date:
+            counts.update(cls.backend.get_entry_counts(user.id, month.strftime("%Y-%m")))
+            month = (month + datetime.timedelta(days=31)).replace(day=1)
+        start, end = start_date.isoformat(), end_date.isoformat()
+        return {day: counts[day] for day in sorted(counts) if start <= day <= end and counts[day] > 0}
+
+    @classmethod
+    def get_stats(cls, user: User, today: date) -> UserStats:
+        """
+        Gets writing statistics of user in a single read of aggregates, kept up to date by every entry write
+
+        :param user: User whose entries they are
+        :param today: today at user's, current streak is counted up to
+        """
+        return summarize(cls.backend.get_aggregates(user.id), today)
 
     @classmethod
     def update_message(cls, user: User, edited_message: Message) -> bool:
         """
-        Updates content in db for message
+        Updates content in db for message.
+
+        Date and stored entry of message are looked up in `message_cache` first, then in db,
+        so that only changed fields are written and fields not part of the schema (e.g. `archive`) are kept.
 
         :param user: User that has the message
         :param edited_message: message
         :return: `True` if updated successfully, `False` if this message is not diary content
         """
         message_id = edited_message.message_id
-        date_str = db.reference(
-            f"{cls.root}/users/{user.id}/message_date/{message_id}"
-        ).get()
-        if not isinstance(date_str, str):
+        key = (user.id, message_id)
+        cached = cls.message_cache.get(key)
+        if cached is None:
+            # also cache that message is not diary content, as most edits are of such messages
+            cached = (cls.backend.get_message_date(user.id, message_id), None)
+            cls.message_cache.set(key, cached)
+        date_str, stored_entry = cached
+        if date_str is None:
             logging.debug(f"No upload date for message id {message_id} and user {user.id}.")
             return False
-        today = datetime.date.fromisoformat(date_str)
-        cls.publish(user, today, edited_message)
+        pending = cls.journal.get_pending(user.id, message_id) if cls.journal is not None else None
+        if stored_entry is None and pending is not None:
+            stored_entry = pending.content
+        elif stored_entry is None:
+            stored_entry = cls.backend.get_entry(user.id, date_str, message_id)
+        if stored_entry is None:
+            # stored entry is missing, rewrite it as a whole
+            cls.publish(user, datetime.date.fromisoformat(date_str), edited_message, is_edit=True).result()
+            return True
+        entry = entry_schema.keep_extra_fields(entry_schema.compact_entry(edited_message), stored_entry)
+        if pending is not None:
+            # entry is not in db yet, so fields cannot be written alone
+            cls._publish_entry(user, datetime.date.fromisoformat(date_str), message_id, entry, is_edit=True).result()
+            return True
+        fields = entry_schema.diff_entries(stored_entry, entry)
+        if fields:
+            cls.backend.update_entry(user.id, date_str, message_id, fields)
+            if cls.search_index is not None:
+                cls.search_index.update(user.id, date_str, message_id, entry)
+        cls.message_cache.set(key, (date_str, entry))
         return True
 
     @classmethod
@@ -99,9 +469,7 @@ class Dao(object):
         """
         Saves timezone for given user
         """
-        db.reference(f"{cls.root}/users/{user.id}").update(
-            {"timezone": timezone.__str__()}
-        )
+        cls.update_user_profile(user, {"timezone": timezone.__str__()})
 
     @classmethod
     def get_user_timezone(cls, user: User) -> datetime.tzinfo:
@@ -111,8 +479,36 @@ class Dao(object):
         :param user: User whose timezone it is
         :return: timezone (if not previously saved, returns `UTC`)
         """
-        tz_name = db.reference(f"{cls.root}/users/{user.id}/timezone").get()
+        profile = cls.get_user_profile(user)
+        tz_name = profile.get("timezone")
         if tz_name is None:
             return pytz.UTC
         else:
-            return pytz.timezone(tz_name)
+            return get_zone(tz_name)
+
+    @classmethod
+    def get_user_profile(cls, user: User) -> dict:
+        """
+        Gets user profile, preferably from cache
+
+        :param user: User whose profile it is
+        :return: dict with user settings, e.g. `timezone` (`None` if not set)
+        """
+        profile = cls.profile_cache.get(user.id)
+        if profile is None:
+            profile = cls.backend.get_profile(user.id)
+            cls.profile_cache.set(user.id, profile)
+        return profile
+
+    @classmethod
+    def update_user_profile(cls, user: User, fields: Dict[str, Any]) -> None:
+        """
+        Saves given profile fields, writing through to profile cache
+
+        :param user: User whose profile it is
+        :param fields: fields to be set
+        """
+        profile = dict(cls.get_user_profile(user))
+        profile.update(fields)
+        cls.backend.update_profile(user.id, fields)
+        cls.profile_cache.set(user.id, profile)
@@ -0,0 +1,146 @@
+"""
+Compact schema of diary entries.
+
+Instead of a raw `Message.to_dict()` (with repeated `from` and `chat` objects, empty lists, service flags etc.),
+only content-bearing fields are stored, along with schema version `v`:
+
+    {"v": 1, "message_id": 42, "date": 1627560000, "text": "...", "entities": [...]}
+
+Entries without `v` are legacy raw `to_dict()` payloads, they are still readable.
+
+Once media of an entry is archived (see `utils.media_archive`), `archive` maps its file unique ids to their location.
+
+An album (media group) is stored as a single entry: its first part is the entry itself, and `album` lists compact
+entries (without `v`) of the other parts.
+"""
+from typing import Any, Dict, List
+
+from telegram import Bot, Chat, Message, User
+
+schema_version = 1
+
+# fields of `Message.to_dict()` that are kept
+entry_fields = (
+    "message_id",
+    "date",
+    "edit_date",
+    "media_group_id",
+    "text",
+    "entities",
+    "caption",
+    "caption_entities",
+    "photo",
+    "document",
+)
+# document fields that are kept (e.g. thumbnail is dropped)
+document_fields = ("file_id", "file_unique_id", "file_name", "mime_type", "file_size")
+
+
+def is_compact(entry: Dict[str, Any]) -> bool:
+    return "v" in entry
+
+
+def compact_dict(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Converts a raw `Message.to_dict()` payload to a compact entry.
+
+    :param data: message as dict
+    :return: compact entry
+    """
+    entry: Dict[str, Any] = {"v": schema_version}
+    for key in entry_fields:
+        value = data.get(key)
+        # skip empty lists and missing values
+        if value is not None and value != []:
+            entry[key] = value
+    if "document" in entry:
+        entry["document"] = {key: entry["document"][key] for key in document_fields if key in entry["document"]}
+    return entry
+
+
+def compact_entry(message: Message) -> Dict[str, Any]:
+    """
+    :param message: content message
+    :return: compact entry of message
+    """
+    return compact_dict(message.to_dict())
+
+
+def album_entry(messages: List[Message]) -> Dict[str, Any]:
+    """
+    :param messages: parts of an album, in order
+    :return: compact entry of the whole album
+    """
+    entry = compact_entry(messages[0])
+    if len(messages) > 1:
+        entry["album"] = [
+            {key: value for key, value in compact_entry(message).items() if key != "v"} for message in messages[1:]
+        ]
+    return entry
+
+
+def entry_parts(entry: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    :return: entry itself, followed by other parts of album (if entry is one)
+    """
+    return [entry] + entry.get("album", [])
+
+
+def keep_extra_fields(new: Dict[str, Any], old: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    :return: new entry with fields of old one that are not part of the schema (e.g. `album` and `archive`)
+    """
+    extra = {key: value for key, value in old.items() if key != "v" and key not in entry_fields}
+    return {**extra, **new}
+
+
+def diff_entries(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compares two compact entries of the same message, fields that are not part of the schema (e.g. `archive`) are kept.
+
+    :param old: stored entry
+    :param new: entry of edited message
+    :return: changed fields -> new value (`None` if field has been removed), as accepted by `update_entry`
+    """
+    return {
+        key: new.get(key)
+        for key in ("v",) + entry_fields
+        if new.get(key) != old.get(key)
+    }
+
+
+def entry_text(entry: Dict[str, Any]) -> str:
+    """
+    Renders an entry (compact or legacy) as plain text, media is shown as placeholders.
+
+    :param entry: stored entry
+    :return: text of entry, e.g. `[photo]` followed by caption
+    """
+    parts = []
+    for part in entry_parts(entry):
+        if part.get("photo"):
+            parts.append("[photo]")
+        if part.get("document"):
+            parts.append(f"[document: {part['document'].get('file_name', 'file')}]")
+        text = part.get("text") or part.get("caption")
+        if text:
+            parts.append(text)
+    return "\n".join(parts)
+
+
+def restore_message(entry: Dict[str, Any], bot: Bot, user: User, chat: Chat) -> Message:
+    """
+    Restores message from an entry (compact or legacy).
+
+    :param entry: stored entry
+    :param bot: bot, that message will be bound to
+    :param user: user, who sent the message
+    :param chat: chat, that message was sent to
+    :return: message with content of the original one
+    """
+    if not is_compact(entry):
+        return Message.de_json(dict(entry), bot)
+    data = {key: value for key, value in entry.items() if key != "v"}
+    data["from"] = user.to_dict()
+    data["chat"] = chat.to_dict()
+    return Message.de_json(data, bot)
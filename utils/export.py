@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional, Set
+
+from utils import entry_schema
+from utils.storage import EntryWrite
+
+
+def write_export(entries: Iterable[EntryWrite], path: str) -> int:
+    """
+    Writes entries into a zip archive with `entries.jsonl` (one entry per line) and `diary.md` (entries by date).
+
+    Entries are streamed into the archive one by one, so memory use does not depend on the number of entries.
+
+    :param entries: entries ordered by date
+    :param path: path of archive to be written
+    :return: number of entries written
+    """
+    count = 0
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive, tempfile.TemporaryFile(
+            "w+", dir=os.path.dirname(path)
+    ) as markdown:
+        # only one archive member can be written at a time, so Markdown is buffered in a temporary file
+        with archive.open("entries.jsonl", "w", force_zip64=True) as jsonl:
+            last_date: Optional[str] = None
+            for entry in entries:
+                record = {"date": entry.date, "message_id": entry.message_id, "entry": entry.content}
+                jsonl.write((json.dumps(record, ensure_ascii=False) + "\n").encode())
+                if entry.date != last_date:
+                    markdown.write(f"# {entry.date}\n\n")
+                    last_date = entry.date
+                markdown.write(entry_schema.entry_text(entry.content) + "\n\n")
+                count += 1
+        markdown.seek(0)
+        with archive.open("diary.md", "w", force_zip64=True) as md:
+            for line in markdown:
+                md.write(line.encode())
+    return count
+
+
+class Exporter(object):
+    """
+    Runs exports of user diaries on a bounded pool of threads, separate from handler workers,
+    so that long exports can not starve normal traffic.
+
+    Every user can run a single export at a time.
+    """
+
+    directory: str = tempfile.gettempdir()
+    page_size: int = 100
+    max_concurrent: int = 2
+    _executor: Optional[ThreadPoolExecutor] = None
+    _running_users: Set[int] = set()
+    _lock = threading.Lock()
+
+    @classmethod
+    def setup(cls, directory: str, max_concurrent: int, page_size: int) -> None:
+        """
+        :param directory: directory, where archives are written before being sent
+        :param max_concurrent: max number of exports run at the same time, further exports are rejected
+        :param page_size: number of dates read from db at once
+        """
+        os.makedirs(directory, exist_ok=True)
+        cls.directory = directory
+        cls.max_concurrent = max_concurrent
+        cls.page_size = page_size
+
+    @classmethod
+    def is_running(cls, user_id: int) -> bool:
+        return user_id in cls._running_users
+
+    @classmethod
+    def try_start(cls, user_id: int, export: Callable[[str], None]) -> bool:
+        """
+        Starts export of user in background, unless user is already exporting or all export slots are taken.
+
+        :param user_id: user whose diary it is
+        :param export: writes archive to given path and sends it, path is removed afterwards
+        :return: `True` if export has been started
+        """
+        with cls._lock:
+            if user_id in cls._running_users or len(cls._running_users) >= cls.max_concurrent:
+                return False
+            cls._running_users.add(user_id)
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(cls.max_concurrent, thread_name_prefix="export")
+        cls._executor.submit(cls._run, user_id, export)
+        return True
+
+    @classmethod
+    def close(cls) -> None:
+        """
+        Waits for running exports to complete
+        """
+        if cls._executor is not None:
+            cls._executor.shutdown()
+            cls._executor = None
+
+    @classmethod
+    def _run(cls, user_id: int, export: Callable[[str], None]) -> None:
+        path = os.path.join(cls.directory, f"export_{user_id}.zip")
+        try:
+            export(path)
+        except Exception as e:
+            logging.error(f"Export of user {user_id} has failed: {e}")
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+            with cls._lock:
+                cls._running_users.discard(user_id)
@@ -1,7 +1,24 @@
-from typing import Union
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, NamedTuple, Optional, Union
 
-import firebase_admin
-from firebase_admin import credentials
+
+class TransportOptions(NamedTuple):
+    """
+    Options of HTTP transport of firebase client
+    """
+
+    # max number of connections kept open, should match the number of threads using db
+    pool_size: int = 10
+    # timeouts (in seconds) of opening a connection and of waiting for response
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    # max number of retries of a request on transient errors
+    retries: int = 3
+    # retries wait for a random time up to `backoff_factor * 2 ** retry`, at most `backoff_max` seconds
+    backoff_factor: float = 0.5
+    backoff_max: float = 10.0
 
 
 class FirebaseUtils(object):
@@ -9,13 +26,99 @@ class FirebaseUtils(object):
     Utilities for firebase
     """
 
+    # `requests.adapters.HTTPAdapter` of db client, if transport has been set up
+    _adapter: Optional[Any] = None
+
     @classmethod
-    def setup_firebase(cls, certificate: Union[dict, str], databaseURL: str) -> None:
+    def setup_firebase(
+            cls, certificate: Union[dict, str], databaseURL: str, transport: Optional[TransportOptions] = None
+    ) -> None:
         """
         Initializes firebase
 
         :param certificate: Credentials as a dict or path to json file
         :param databaseURL: Realtime database url
+        :param transport: options of HTTP transport, client defaults if not given
         """
+        # imported here, as `firebase_admin` takes long to import and is not needed with other backends
+        import firebase_admin
+        from firebase_admin import credentials
+        from utils.firebase_transport import create_adapter
+
         cert = credentials.Certificate(certificate)
-        firebase_admin.initialize_app(cert, {"databaseURL": databaseURL})
+        options = {"databaseURL": databaseURL}
+        if transport is not None:
+            # passed as is to `requests`
+            options["httpTimeout"] = (transport.connect_timeout, transport.read_timeout)
+        firebase_admin.initialize_app(cert, options)
+        if transport is None:
+            return
+        session = cls._db_session()
+        if session is None:
+            return
+        cls._adapter = create_adapter(transport)
+        session.mount("https://", cls._adapter)
+        session.mount("http://", cls._adapter)
+
+    @staticmethod
+    def _db_session() -> Optional[Any]:
+        """
+        :return: `requests.Session` of db client of default app, `None` if client does not expose it
+        """
+        import firebase_admin
+        from firebase_admin import db
+        from requests import Session
+
+        # not a public API of `firebase_admin`, all references share the client (and its session) of default app
+        client = getattr(db.reference(), "_client", None)
+        session = getattr(client, "session", None)
+        if not isinstance(session, Session):
+            logging.error(
+                f"Could not set up db transport, as firebase_admin {firebase_admin.__version__} does not expose "
+                f"session of db client. Client defaults are used instead."
+            )
+            return None
+        return session
+
+    @classmethod
+    def prewarm(cls, path: str, connections: int) -> None:
+        """
+        Opens connections (and obtains access token) ahead of first requests, so that no user waits for them
+
+        :param path: path of a small node, read shallowly once per connection
+        :param connections: number of connections opened, by concurrent requests
+        """
+        from firebase_admin import db
+
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(connections, thread_name_prefix="firebase_prewarm") as executor:
+            futures = [executor.submit(db.reference(path).get, shallow=True) for _ in range(connections)]
+            wait(futures)
+        failed = [future.exception() for future in futures if future.exception() is not None]
+        if failed:
+            logging.warning(f"Could not prewarm {len(failed)} of {connections} db connections: {failed[0]}")
+        else:
+            logging.info(f"Prewarmed {connections} db connections in {time.perf_counter() - started_at:.2f}s.")
+
+    @classmethod
+    def pool_stats(cls) -> Dict[str, int]:
+        """
+        :return: connection pool utilisation: connections in use, idle open connections, max size of pool,
+            and number of connections opened and requests made so far
+        """
+        if cls._adapter is None:
+            return {}
+        stats = {"in_use": 0, "idle": 0, "max_size": 0, "opened": 0, "requests": 0}
+        pools = cls._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            # queue holds idle connections, and `None` for connections that have not been opened yet
+            queued = list(pool.pool.queue)
+            stats["in_use"] += pool.pool.maxsize - len(queued)
+            stats["idle"] += sum(1 for connection in queued if connection is not None)
+            stats["max_size"] += pool.pool.maxsize
+            stats["opened"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+        return stats
@@ -0,0 +1,36 @@
+"""
+HTTP transport of firebase client, imported only once firebase is set up.
+"""
+import random
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.firebase import TransportOptions
+
+
+class JitteredRetry(Retry):
+    """
+    Retry with "full jitter" backoff: a random time up to the exponential backoff,
+    so that requests that have failed together are not retried together
+    """
+
+    def get_backoff_time(self) -> float:
+        return random.uniform(0, super().get_backoff_time())
+
+
+def create_adapter(options: TransportOptions) -> HTTPAdapter:
+    """
+    :return: adapter with a connection pool and retries, as given by options
+    """
+    retry = JitteredRetry(
+        total=options.retries,
+        # only idempotent methods are retried on read errors and error statuses (the default `allowed_methods`),
+        # as multi-path updates (`PATCH`) with increments may have been applied already
+        status_forcelist=(500, 502, 503, 504),
+        backoff_factor=options.backoff_factor,
+        backoff_max=options.backoff_max,
+        raise_on_status=False,
+    )
+    # a single host is used, so a single pool
+    return HTTPAdapter(pool_connections=1, pool_maxsize=options.pool_size, max_retries=retry)
@@ -0,0 +1,422 @@
+"""
+Bulk import of diaries, from a Telegram Desktop chat export (`result.json`, e.g. of "Saved Messages" or of a chat
+with another diary bot, possibly zipped) or from an archive made by `/export`.
+
+Files are parsed incrementally, so memory use does not depend on their size, and entries are written in chunks,
+a single backend write each. Progress is checkpointed after every chunk, so an import that has been interrupted
+continues where it has stopped once the bot is started again.
+"""
+import datetime
+import functools
+import io
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+
+import pytz
+from telegram import Bot
+
+from strings import Strings
+from utils.dao import Dao, get_zone
+from utils.outbox import Outbox, Priority
+from utils.storage import EntryWrite
+
+# ISO date, message id and compact entry, `None` for records that are not imported (e.g. service messages)
+ImportRecord = Optional[Tuple[str, int, Dict[str, Any]]]
+
+# answers to confirmation of entries, in a chat with a diary bot (this one or alike)
+confirmation_answers = frozenset(answer.casefold() for answer in (Strings.Yes, Strings.No))
+
+
+class ImportFormatError(ValueError):
+    """
+    File is neither a Telegram chat export nor an archive made by `/export`
+    """
+
+
+def iter_json_array(
+        f: TextIO, key: str, fields: Optional[Dict[str, Any]] = None, read_size: int = 1 << 16
+) -> Iterator[Any]:
+    """
+    Streams items of an array in a JSON object (e.g. `messages` of `result.json`) without reading the whole file.
+    The array has to be the value of a top-level `key` of the object.
+
+    :param f: JSON file
+    :param key: key of the array
+    :param fields: if given, top-level fields preceding the array (e.g. `id` of exported chat) are stored into it,
+        before the first item is returned
+    :param read_size: number of characters read at once
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+
+    def fill() -> None:
+        nonlocal buffer, position
+        chunk = f.read(read_size)
+        if not chunk:
+            raise ImportFormatError("File has been cut off")
+        # drop what has been decoded already
+        buffer, position = buffer[position:] + chunk, 0
+
+    def skip(separators: str = " \t\r\n") -> str:
+        """
+        :return: next character that is not a separator
+        """
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in separators:
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            fill()
+
+    def decode() -> Any:
+        nonlocal position
+        # values may not start with whitespace
+        skip()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # value is not complete yet
+                fill()
+                continue
+            if end == len(buffer):
+                # a number may go on in next read
+                fill()
+                continue
+            position = end
+            return value
+
+    # read fields up to the array
+    if skip() != "{":
+        raise ImportFormatError("File is not a JSON object")
+    position += 1
+    while True:
+        if skip(" \t\r\n,") == "}":
+            raise ImportFormatError(f"No {key} in file")
+        name = decode()
+        if not isinstance(name, str) or skip() != ":":
+            raise ImportFormatError("File is not a JSON object")
+        position += 1
+        if name == key:
+            break
+        value = decode()
+        if fields is not None:
+            fields[name] = value
+    if skip() != "[":
+        raise ImportFormatError(f"{key} is not an array")
+    position += 1
+
+    while skip(" \t\r\n,") != "]":
+        yield decode()
+
+
+def telegram_text(text: Any) -> str:
+    """
+    :param text: text of exported message, either a string or a list of strings and formatted parts
+    :return: plain text
+    """
+    if isinstance(text, str):
+        return text
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+
+
+def imported_message_id(chat_id: int, message_id: int) -> int:
+    """
+    :param chat_id: id of exported chat, as message ids are unique only within a chat
+    :param message_id: id of exported message
+    :return: negative id, so that imported entries do not overwrite entries sent to the bot, nor those imported from
+        other chats. It fits into 63 bits, with a 31-bit hash of chat followed by 31-bit message id.
+    """
+    namespace = zlib.crc32(str(chat_id).encode()) & 0x7FFFFFFF
+    return -((namespace << 31) | int(message_id))
+
+
+def is_bot_command(message: Dict[str, Any], text: str) -> bool:
+    """
+    :return: whether message starts with a bot command, e.g. `/start` or `/customdate 2021-07-29`
+    """
+    entities = message.get("text_entities")
+    if entities is None and isinstance(message.get("text"), list):
+        entities = [part for part in message["text"] if isinstance(part, dict)]
+    return any(
+        entity.get("type") == "bot_command" and text.startswith(entity.get("text") or "/")
+        for entity in entities or ()
+    )
+
+
+def telegram_record(message: Dict[str, Any], user_id: int, chat_id: int, zone: pytz.BaseTzInfo) -> ImportRecord:
+    """
+    Converts a message of Telegram Desktop export to an entry, dated by its time at user's timezone.
+    Media files are not part of `result.json`, so only text and captions are imported.
+
+    In a chat with a diary bot, commands and bare answers to confirmations are not diary content and are skipped.
+
+    :param chat_id: id of exported chat, entries get ids by `imported_message_id`
+    """
+    if message.get("type") != "message":
+        return None
+    # in a chat with another bot, only messages of user are diary content
+    if message.get("from_id", f"user{user_id}") != f"user{user_id}":
+        return None
+    text = telegram_text(message.get("text", ""))
+    if not text.strip() or text.strip().casefold() in confirmation_answers or is_bot_command(message, text):
+        return None
+    if "date_unixtime" in message:
+        timestamp = int(message["date_unixtime"])
+        date = datetime.datetime.fromtimestamp(timestamp, zone).date()
+    else:
+        # older exports only have time at exporting computer
+        local = datetime.datetime.fromisoformat(message["date"])
+        timestamp = int(zone.localize(local).timestamp())
+        date = local.date()
+    message_id = imported_message_id(chat_id, message["id"])
+    entry: Dict[str, Any] = {"v": 1, "message_id": message_id, "date": timestamp}
+    if "edited_unixtime" in message:
+        entry["edit_date"] = int(message["edited_unixtime"])
+    has_media = "photo" in message or "file" in message
+    entry["caption" if has_media else "text"] = text
+    return date.isoformat(), message_id, entry
+
+
+def export_record(line: str) -> ImportRecord:
+    """
+    Reads a line of `entries.jsonl` of an archive made by `/export`, entry is imported as it is
+    """
+    record = json.loads(line)
+    return record["date"], int(record["message_id"]), record["entry"]
+
+
+def iter_records(path: str, user_id: int, zone: pytz.BaseTzInfo) -> Iterator[ImportRecord]:
+    """
+    Streams records of an import file, in the order they are stored in
+
+    :param path: `result.json`, a zip archive with `result.json` or an archive made by `/export`
+    :param user_id: importing user
+    :param zone: timezone of user
+    """
+    # top-level fields of Telegram export, e.g. `id` of chat
+    fields: Dict[str, Any] = {}
+    if not zipfile.is_zipfile(path):
+        with open(path, encoding="utf-8") as f:
+            for message in iter_json_array(f, "messages", fields):
+                yield telegram_record(message, user_id, fields.get("id", 0), zone)
+        return
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+        if "entries.jsonl" in names:
+            with archive.open("entries.jsonl") as member:
+                for line in io.TextIOWrapper(member, encoding="utf-8"):
+                    if line.strip():
+                        yield export_record(line)
+            return
+        result = next((name for name in names if os.path.basename(name) == "result.json"), None)
+        if result is None:
+            raise ImportFormatError("Archive has neither entries.jsonl nor result.json")
+        with archive.open(result) as member:
+            for message in iter_json_array(io.TextIOWrapper(member, encoding="utf-8"), "messages", fields):
+                yield telegram_record(message, user_id, fields.get("id", 0), zone)
+
+
+class Importer(object):
+    """
+    Runs imports on a bounded pool of threads, separate from handler workers, like `Exporter`.
+
+    Every import has a checkpoint (`{user_id}.json`) with the number of records of the file that have been handled,
+    next to the downloaded file (`{user_id}.import`). Both are removed once import has completed.
+    """
+
+    directory: str = ".cache/imports"
+    chunk_size: int = 500
+    max_concurrent: int = 1
+    # time (in seconds) between progress reports
+    progress_interval: float = 10
+    _executor: Optional[ThreadPoolExecutor] = None
+    _running_users: Set[int] = set()
+    _lock = threading.Lock()
+
+    @classmethod
+    def setup(cls, directory: str, max_concurrent: int, chunk_size: int) -> None:
+        """
+        :param directory: directory of downloaded files and checkpoints
+        :param max_concurrent: max number of imports run at the same time, further imports are rejected
+        :param chunk_size: number of entries written at once
+        """
+        os.makedirs(directory, exist_ok=True)
+        cls.directory = directory
+        cls.max_concurrent = max_concurrent
+        cls.chunk_size = chunk_size
+
+    @classmethod
+    def is_running(cls, user_id: int) -> bool:
+        return user_id in cls._running_users
+
+    @classmethod
+    def try_start(cls, bot: Bot, user_id: int, tz_name: str, file_id: str) -> bool:
+        """
+        Starts import of a document sent by user in background, unless user is already importing
+        or all import slots are taken. Progress is reported to user.
+
+        :param bot: bot, used to download the document and to report progress
+        :param user_id: importing user
+        :param tz_name: timezone of user, by which messages are dated
+        :param file_id: id of the document
+        :return: `True` if import has been started
+        """
+        with cls._lock:
+            if user_id in cls._running_users or len(cls._running_users) >= cls.max_concurrent:
+                return False
+            cls._running_users.add(user_id)
+        checkpoint = {"user_id": user_id, "tz_name": tz_name, "file_id": file_id, "position": 0, "imported": 0,
+                      "skipped": 0}
+        cls._save_checkpoint(checkpoint)
+        cls._submit(bot, checkpoint)
+        return True
+
+    @classmethod
+    def resume(cls, bot: Bot, owns_user: Optional[Callable[[int], bool]] = None) -> None:
+        """
+        Continues imports that have been interrupted by a shutdown, called on startup
+
+        :param owns_user: if given, only imports of users it returns `True` for are continued (in sharded mode)
+        """
+        for name in sorted(os.listdir(cls.directory)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(cls.directory, name)) as f:
+                checkpoint = json.load(f)
+            user_id = checkpoint["user_id"]
+            if owns_user is not None and not owns_user(user_id):
+                continue
+            with cls._lock:
+                cls._running_users.add(user_id)
+            logging.info(f"Resuming import of user {user_id} from record {checkpoint['position']}.")
+            cls._submit(bot, checkpoint)
+
+    @classmethod
+    def close(cls) -> None:
+        """
+        Stops imports after their current chunk, they are resumed on next start
+        """
+        if cls._executor is not None:
+            executor, cls._executor = cls._executor, None
+            executor.shutdown(cancel_futures=True)
+
+    @classmethod
+    def _submit(cls, bot: Bot, checkpoint: Dict[str, Any]) -> None:
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(cls.max_concurrent, thread_name_prefix="import")
+            executor = cls._executor
+        executor.submit(cls._run, bot, checkpoint)
+
+    @classmethod
+    def _run(cls, bot: Bot, checkpoint: Dict[str, Any]) -> None:
+        user_id = checkpoint["user_id"]
+        path = os.path.join(cls.directory, f"{user_id}.import")
+        completed = False
+        try:
+            if not os.path.exists(path):
+                bot.get_file(checkpoint["file_id"]).download(custom_path=f"{path}.part")
+                os.replace(f"{path}.part", path)
+            completed = cls._import(bot, path, checkpoint)
+        except (ImportFormatError, ValueError, KeyError) as e:
+            logging.info(f"Import of user {user_id} has an unsupported file: {e}")
+            Outbox.send_message(bot, user_id, Strings.import_unsupported)
+            completed = True
+        except Exception as e:
+            logging.error(f"Import of user {user_id} has failed: {e}")
+            Outbox.send_message(bot, user_id, Strings.import_failed)
+            completed = True
+        finally:
+            if completed:
+                for filename in (path, cls._checkpoint_filename(user_id)):
+                    if os.path.exists(filename):
+                        os.remove(filename)
+            with cls._lock:
+                cls._running_users.discard(user_id)
+
+    @classmethod
+    def _import(cls, bot: Bot, path: str, checkpoint: Dict[str, Any]) -> bool:
+        """
+        :return: `True` if all records have been imported, `False` if import has been stopped by shutdown
+        """
+        user_id = checkpoint["user_id"]
+        records = iter_records(path, user_id, get_zone(checkpoint["tz_name"]))
+        # records before checkpoint have been handled
+        for _ in range(checkpoint["position"]):
+            next(records, None)
+        progress = cls._progress_reporter(bot, user_id)
+        chunk: List[EntryWrite] = []
+        position = checkpoint["position"]
+        for record in records:
+            position += 1
+            if record is None:
+                checkpoint["skipped"] += 1
+            else:
+                date, message_id, entry = record
+                chunk.append(EntryWrite(user_id, date, message_id, entry, is_new=True))
+            if len(chunk) >= cls.chunk_size:
+                cls._write_chunk(chunk, checkpoint, position)
+                chunk = []
+                progress(checkpoint)
+                if cls._executor is None:
+                    # shutting down, the rest is imported on next start
+                    return False
+        cls._write_chunk(chunk, checkpoint, position)
+        Outbox.send_message(bot, user_id, Strings.import_done(checkpoint["imported"], checkpoint["skipped"]))
+        logging.info(f"Imported {checkpoint['imported']} entries of user {user_id}.")
+        return True
+
+    @classmethod
+    def _write_chunk(cls, chunk: List[EntryWrite], checkpoint: Dict[str, Any], position: int) -> None:
+        if chunk:
+            Dao.import_entries(checkpoint["user_id"], chunk)
+        checkpoint["imported"] += len(chunk)
+        checkpoint["position"] = position
+        cls._save_checkpoint(checkpoint)
+
+    @classmethod
+    def _progress_reporter(cls, bot: Bot, user_id: int) -> Callable[[Dict[str, Any]], None]:
+        """
+        :return: function that reports progress at most every `progress_interval`, by editing a single message
+        """
+        message_id: Optional[int] = None
+        reported_at = time.monotonic()
+
+        def report(checkpoint: Dict[str, Any]) -> None:
+            nonlocal message_id, reported_at
+            if time.monotonic() - reported_at < cls.progress_interval:
+                return
+            reported_at = time.monotonic()
+            text = Strings.import_progress(checkpoint["imported"], checkpoint["skipped"])
+            try:
+                if message_id is None:
+                    message_id = Outbox.send_message(bot, user_id, text).result().message_id
+                else:
+                    edit = functools.partial(bot.edit_message_text, text, chat_id=user_id, message_id=message_id)
+                    Outbox.submit(user_id, edit, Priority.BACKGROUND)
+            except Exception as e:
+                # progress is not worth failing import for
+                logging.warning(f"Could not report import progress to user {user_id}: {e}")
+
+        return report
+
+    @classmethod
+    def _checkpoint_filename(cls, user_id: int) -> str:
+        return os.path.join(cls.directory, f"{user_id}.json")
+
+    @classmethod
+    def _save_checkpoint(cls, checkpoint: Dict[str, Any]) -> None:
+        filename = cls._checkpoint_filename(checkpoint["user_id"])
+        with open(f"{filename}.tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(f"{filename}.tmp", filename)
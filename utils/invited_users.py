@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional, Set
+
+from utils.storage import StorageBackend
+
+
+class InvitedUsersCache(object):
+    """
+    In-memory set of invited user ids.
+
+    The set is loaded once at startup and kept current by a streaming listener on `invited_users` (if backend supports it).
+    As listeners may silently die (e.g. network failures), the whole set is also reloaded in background
+    whenever it is older than `max_staleness` seconds, which bounds how long a revoked user keeps access.
+    Authorization checks never wait for db: if a reload fails, the last loaded set is served until the next one.
+    """
+
+    def __init__(self, backend: StorageBackend, max_staleness: float = 300.0):
+        """
+        :param backend: storage backend with invited users
+        :param max_staleness: max age (in seconds) of the set before it is reloaded from db
+        """
+        self.backend = backend
+        self.max_staleness = max_staleness
+        self._user_ids: Set[str] = set()
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._unsubscribe: Optional[Callable[[], None]] = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="invited_users", daemon=True)
+
+    def start(self) -> None:
+        """
+        Loads invited users and subscribes to their changes
+        """
+        self.reload()
+        self._unsubscribe = self.backend.listen_invited_users(self._on_change)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops reloading and closes the streaming listener, if any
+        """
+        self._stopped.set()
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+
+    def reload(self) -> None:
+        """
+        Replaces cached set with the one stored in db
+        """
+        user_ids = self.backend.get_invited_user_ids()
+        with self._lock:
+            self._user_ids = user_ids
+            self._loaded_at = time.monotonic()
+        logging.debug(f"Loaded {len(user_ids)} invited users.")
+
+    def contains(self, user_id: int) -> bool:
+        """
+        Checks whether user with given id is invited.
+
+        :param user_id: telegram user id
+        :return: True if user is present in `invited_users`
+        """
+        return str(user_id) in self._user_ids
+
+    def _run(self) -> None:
+        """
+        Reloads the set once it is older than `max_staleness`, i.e. when listener has not replaced it meanwhile
+        """
+        while True:
+            with self._lock:
+                age = time.monotonic() - self._loaded_at if self._loaded_at is not None else self.max_staleness
+            if self._stopped.wait(max(self.max_staleness - age, 0)):
+                return
+            with self._lock:
+                is_stale = self._loaded_at is None or time.monotonic() - self._loaded_at >= self.max_staleness
+            if not is_stale:
+                continue
+            try:
+                self.reload()
+            except Exception as e:
+                logging.warning(f"Could not reload invited users, keeping the loaded set: {e}")
+                # retry after a while, rather than immediately
+                if self._stopped.wait(min(self.max_staleness, 30.0)):
+                    return
+
+    def _on_change(self, user_ids: Optional[Set[str]], changes: Dict[str, bool]) -> None:
+        """
+        Applies streamed change of `invited_users` to cached set
+        """
+        with self._lock:
+            if user_ids is not None:
+                self._user_ids = user_ids
+                self._loaded_at = time.monotonic()
+            for user_id, is_invited in changes.items():
+                if is_invited:
+                    self._user_ids.add(user_id)
+                else:
+                    self._user_ids.discard(user_id)
@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from utils.storage import EntryWrite
+
+# (user id, message id)
+EntryKey = Tuple[int, int]
+
+
+class _Record(object):
+    __slots__ = ("seq", "write", "durable", "applied")
+
+    def __init__(self, seq: int, write: EntryWrite):
+        self.seq = seq
+        self.write = write
+        self.durable: Future = Future()
+        self.applied: Future = Future()
+
+
+class WriteJournal(object):
+    """
+    Durable local journal of entry writes, applied to db in background.
+
+    Writes are appended to a log file and fsynced in groups, so that many writes share a single fsync.
+    Once a write is durable it may be acknowledged, even if db is slow or unreachable: a replayer applies durable
+    writes to db in order (retrying until it succeeds) and records the last applied one in a checkpoint file.
+    The applied prefix of the log is trimmed once the log grows over `max_bytes`.
+
+    On startup, writes after the checkpoint are replayed. Writing an entry is idempotent except for month index,
+    so replayed new entries, that may have been applied before the checkpoint was saved, are checked first.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            apply: Callable[[List[EntryWrite]], None],
+            is_stored: Callable[[int, int], bool],
+            max_batch_size: int = 500,
+            commit_delay: float = 0.005,
+            max_bytes: int = 16 << 20,
+    ):
+        """
+        :param directory: directory of log and checkpoint files
+        :param apply: writes entries to db
+        :param is_stored: checks whether entry (by user id and message id) is in db already
+        :param max_batch_size: max number of entries applied at once
+        :param commit_delay: time (in seconds) appends are collected for, before being fsynced together
+        :param max_bytes: size of log that triggers trimming of its applied prefix
+        """
+        self.directory = directory
+        self.log_filename = os.path.join(directory, "journal.jsonl")
+        self.checkpoint_filename = os.path.join(directory, "checkpoint")
+        self.apply = apply
+        self.is_stored = is_stored
+        self.max_batch_size = max_batch_size
+        self.commit_delay = commit_delay
+        self.max_bytes = max_bytes
+        self._cond = threading.Condition()
+        # appended, not yet fsynced
+        self._uncommitted: List[_Record] = []
+        # being fsynced
+        self._committing: List[_Record] = []
+        # fsynced, not yet applied, in order
+        self._unapplied: Deque[_Record] = deque()
+        # entry -> number of its writes that are not applied yet
+        self._pending: Dict[EntryKey, int] = {}
+        self._next_seq = 1
+        self._applied_seq = 0
+        self._closed = False
+        # set once replayer has to stop, even if not all writes have been applied
+        self._stopping = False
+        self._compacted_size = 0
+        self._log = None
+        self._log_lock = threading.Lock()
+        self._committer = threading.Thread(target=self._commit_loop, name="journal_commit", daemon=True)
+        self._replayer = threading.Thread(target=self._replay_loop, name="journal_replay", daemon=True)
+
+    def start(self) -> None:
+        """
+        Recovers writes, that have not been applied before last shutdown, and starts applying them
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+        self._log = open(self.log_filename, "a")
+        self._committer.start()
+        self._replayer.start()
+
+    def append(self, writes: List[EntryWrite]) -> Tuple[Future, Future]:
+        """
+        Schedules entries to be written
+
+        :return: future that completes once writes are durable, and future that completes once they are in db
+        """
+        durable: Future = Future()
+        applied: Future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Journal has been closed")
+            records = []
+            for write in writes:
+                records.append(_Record(self._next_seq, write))
+                self._next_seq += 1
+                key = (write.user_id, write.message_id)
+                self._pending[key] = self._pending.get(key, 0) + 1
+            self._uncommitted += records
+            self._cond.notify_all()
+        # complete when the last record does, as records are handled in order
+        _chain(records[-1].durable, durable)
+        _chain(records[-1].applied, applied)
+        return durable, applied
+
+    def get_pending(self, user_id: int, message_id: int) -> Optional[EntryWrite]:
+        """
+        :return: last write of entry, that is not in db yet, `None` if there is none
+        """
+        with self._cond:
+            if (user_id, message_id) not in self._pending:
+                return None
+            for record in reversed(list(self._unapplied) + self._committing + self._uncommitted):
+                if record.write.user_id == user_id and record.write.message_id == message_id:
+                    return record.write
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {"uncommitted": len(self._uncommitted), "unapplied": len(self._unapplied)}
+
+    def close(self, timeout: float = 10) -> None:
+        """
+        Makes appended writes durable, and applies them to db waiting at most `timeout`.
+        Writes that have not been applied are replayed on next start.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._committer.join()
+        with self._cond:
+            while self._unapplied and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            if self._unapplied:
+                logging.warning(f"{len(self._unapplied)} journaled writes are left to be applied on next start.")
+            self._stopping = True
+            self._cond.notify_all()
+        self._replayer.join()
+        self._log.close()
+
+    # internals
+
+    def _commit_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._uncommitted and not self._closed:
+                    self._cond.wait()
+                if not self._uncommitted:
+                    return
+            if not self._closed:
+                # let concurrent appends join the group
+                time.sleep(self.commit_delay)
+            with self._cond:
+                batch, self._uncommitted = self._uncommitted, []
+                self._committing = batch
+            try:
+                with self._log_lock:
+                    self._log.writelines(_encode(record) for record in batch)
+                    self._log.flush()
+                    os.fsync(self._log.fileno())
+            except OSError as e:
+                logging.error(f"Could not journal {len(batch)} writes: {e}")
+                with self._cond:
+                    self._committing = []
+                    self._release(batch)
+                for record in batch:
+                    record.durable.set_exception(e)
+                    record.applied.set_exception(e)
+                continue
+            with self._cond:
+                self._committing = []
+                self._unapplied.extend(batch)
+                self._cond.notify_all()
+            for record in batch:
+                record.durable.set_result(None)
+
+    def _replay_loop(self) -> None:
+        delay = 1.0
+        while True:
+            with self._cond:
+                while not self._unapplied and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                batch = [self._unapplied[i] for i in range(min(self.max_batch_size, len(self._unapplied)))]
+            try:
+                self.apply(_coalesce(batch))
+            except Exception as e:
+                logging.error(f"Could not apply {len(batch)} journaled writes, retrying in {delay}s: {e}")
+                with self._cond:
+                    self._cond.wait_for(lambda: self._stopping, delay)
+                delay = min(delay * 2, 60)
+                continue
+            delay = 1.0
+            with self._cond:
+                for _ in batch:
+                    self._unapplied.popleft()
+                self._applied_seq = batch[-1].seq
+                self._release(batch)
+                self._cond.notify_all()
+            self._save_checkpoint()
+            for record in batch:
+                record.applied.set_result(None)
+            # unapplied writes are kept, so log is not rewritten again until it has grown enough
+            if os.path.getsize(self.log_filename) > max(self.max_bytes, 2 * self._compacted_size):
+                self._compact()
+
+    def _release(self, records: List[_Record]) -> None:
+        for record in records:
+            key = (record.write.user_id, record.write.message_id)
+            self._pending[key] -= 1
+            if self._pending[key] == 0:
+                del self._pending[key]
+
+    def _save_checkpoint(self) -> None:
+        tmp_filename = f"{self.checkpoint_filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            f.write(str(self._applied_seq))
+        os.replace(tmp_filename, self.checkpoint_filename)
+
+    def _compact(self) -> None:
+        """
+        Rewrites log to contain only writes that have not been applied yet
+        """
+        with self._log_lock:
+            self._log.close()
+            tmp_filename = f"{self.log_filename}.tmp"
+            with open(self.log_filename) as src, open(tmp_filename, "w") as dst:
+                for line in src:
+                    record = _decode(line)
+                    if record is not None and record.seq > self._applied_seq:
+                        dst.write(line)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp_filename, self.log_filename)
+            self._compacted_size = os.path.getsize(self.log_filename)
+            self._log = open(self.log_filename, "a")
+        logging.info(f"Compacted journal up to write {self._applied_seq}.")
+
+    def _recover(self) -> None:
+        if os.path.exists(self.checkpoint_filename):
+            with open(self.checkpoint_filename) as f:
+                self._applied_seq = int(f.read() or 0)
+        if not os.path.exists(self.log_filename):
+            return
+        records: List[_Record] = []
+        with open(self.log_filename, "rb+") as f:
+            complete_size = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # last line truncated by a crash has not been acknowledged, new appends must not continue it
+                    f.truncate(complete_size)
+                    break
+                complete_size += len(line)
+                record = _decode(line)
+                if record is None:
+                    continue
+                self._next_seq = max(self._next_seq, record.seq + 1)
+                if record.seq > self._applied_seq:
+                    records.append(record)
+        for record in records:
+            write = record.write
+            if write.is_new and self.is_stored(write.user_id, write.message_id):
+                # has been applied, but checkpoint has not been saved
+                record.write = write._replace(is_new=False)
+            key = (write.user_id, write.message_id)
+            self._pending[key] = self._pending.get(key, 0) + 1
+            record.durable.set_result(None)
+        self._unapplied.extend(records)
+        if records:
+            logging.info(f"Recovered {len(records)} journaled writes to be applied.")
+
+
+def _encode(record: _Record) -> str:
+    return json.dumps({"seq": record.seq, **record.write._asdict()}) + "\n"
+
+
+def _decode(line: Union[str, bytes]) -> Optional[_Record]:
+    try:
+        data = json.loads(line)
+        seq = data.pop("seq")
+        return _Record(seq, EntryWrite(**data))
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _coalesce(records: List[_Record]) -> List[EntryWrite]:
+    """
+    Merges writes of the same entry, the last one wins. Entry stays new, if any of its writes is.
+    """
+    writes: Dict[EntryKey, EntryWrite] = {}
+    for record in records:
+        write = record.write
+        key = (write.user_id, write.message_id)
+        if key in writes and writes[key].is_new:
+            write = write._replace(is_new=True)
+        writes[key] = write
+    return list(writes.values())
+
+
+def _chain(source: Future, target: Future) -> None:
+    def copy(done: Future) -> None:
+        if done.exception() is not None:
+            target.set_exception(done.exception())
+        else:
+            target.set_result(None)
+
+    source.add_done_callback(copy)
@@ -0,0 +1,71 @@
+import logging
+import threading
+from queue import Queue
+from typing import Callable, Hashable, List
+
+
+class KeyedExecutor(object):
+    """
+    Worker pool, that runs tasks with different keys in parallel,
+    but tasks with the same key strictly in submission order.
+
+    Every worker has its own queue, and a key is always mapped to the same worker.
+    """
+
+    def __init__(self, workers: int, queue_size: int = 100, name: str = "keyed_executor"):
+        """
+        :param workers: number of worker threads
+        :param queue_size: max number of tasks waiting for a single worker, `submit` blocks when it is full
+        :param name: prefix of worker thread names
+        """
+        self._queues: List[Queue] = [Queue(queue_size) for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(queue,), name=f"{name}_{i}", daemon=True)
+            for i, queue in enumerate(self._queues)
+        ]
+        self._started = False
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+        self._started = True
+
+    def submit(self, key: Hashable, fn: Callable, *args) -> None:
+        """
+        Schedules `fn(*args)` to be run after all previously submitted tasks with same key.
+        If executor is not running (e.g. has been shut down), `fn` is run right away on caller's thread.
+        """
+        if not self._started:
+            fn(*args)
+            return
+        self._queues[hash(key) % len(self._queues)].put((fn, args))
+
+    def queue_depth(self) -> int:
+        """
+        :return: total number of tasks waiting for workers
+        """
+        return sum(queue.qsize() for queue in self._queues)
+
+    def shutdown(self) -> None:
+        """
+        Runs all submitted tasks and stops workers
+        """
+        if not self._started:
+            return
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._started = False
+
+    @staticmethod
+    def _run(queue: Queue) -> None:
+        while True:
+            task = queue.get()
+            if task is None:
+                return
+            fn, args = task
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception("Uncaught error in executor task")
@@ -0,0 +1,211 @@
+import logging
+import os
+import threading
+import time
+from queue import Queue, Full, Empty
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import NetworkError
+
+from utils import entry_schema
+
+# (user id, date, message id, file id, file unique id, file size)
+ArchiveJob = Tuple[int, str, int, str, str, Optional[int]]
+
+
+class MediaArchive(object):
+    """
+    Background pipeline, that archives photos and documents of diary entries into a local store.
+
+    Files are stored by their `file_unique_id` (same content has same id), so duplicates are downloaded only once.
+    Downloads are streamed by a bounded number of workers with bot's connection pool (e.g. proxy), retried on failure,
+    and skipped once store size reaches `byte_budget`.
+    Store may be shared by shards, each counting only its own downloads, so its size is re-measured every
+    `rescan_interval` seconds. Store may exceed the budget by what other shards download in between.
+    After a file is archived, its location (relative to store) is recorded by `on_archived`.
+    """
+
+    # size of chunks files are streamed in
+    chunk_size = 64 << 10
+    rescan_interval = 60
+
+    def __init__(
+            self,
+            bot: Bot,
+            directory: str,
+            on_archived: Callable[[int, str, int, Dict[str, str]], None],
+            workers: int = 2,
+            byte_budget: int = 1 << 30,
+            max_retries: int = 3,
+            queue_size: int = 1000,
+    ):
+        """
+        :param bot: bot, used to resolve file ids
+        :param directory: root of the store
+        :param on_archived: called with (user id, date, message id, {file unique id: location})
+        :param workers: max number of concurrent downloads
+        :param byte_budget: max total size (in bytes) of the store
+        :param max_retries: max number of retries of a failed download
+        :param queue_size: max number of files waiting to be archived, further files are dropped
+        """
+        self.bot = bot
+        self.directory = directory
+        self.on_archived = on_archived
+        self.byte_budget = byte_budget
+        self.max_retries = max_retries
+        self.used_bytes = 0
+        self._queue: Queue = Queue(queue_size)
+        self._lock = threading.Lock()
+        self._scanned_at = 0.0
+        self._stopped = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"media_archive_{i}", daemon=True) for i in range(workers)
+        ]
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._scanned_at = time.monotonic()
+        self.used_bytes = self._store_size()
+        for thread in self._threads:
+            thread.start()
+
+    def close(self) -> None:
+        """
+        Lets workers finish current downloads, files still waiting are dropped
+        """
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        if not self._queue.empty():
+            logging.warning(f"Dropped {self._queue.qsize()} files waiting to be archived.")
+
+    def submit(self, user_id: int, date: str, message_id: int, entry: dict) -> None:
+        """
+        Schedules media of a (compact) entry to be archived. Never blocks.
+        """
+        for job in self._jobs(user_id, date, message_id, entry):
+            try:
+                self._queue.put_nowait(job)
+            except Full:
+                logging.warning(f"Media archive queue is full, dropping file {job[4]}.")
+
+    def location(self, file_unique_id: str) -> str:
+        """
+        :return: location of file relative to store
+        """
+        return os.path.join(file_unique_id[:2], file_unique_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {"queue_size": self._queue.qsize(), "used_bytes": self.used_bytes}
+
+    @staticmethod
+    def _jobs(user_id: int, date: str, message_id: int, entry: dict) -> List[ArchiveJob]:
+        files = []
+        for part in entry_schema.entry_parts(entry):
+            if part.get("photo"):
+                # only the largest size is archived
+                files.append(part["photo"][-1])
+            if part.get("document"):
+                files.append(part["document"])
+        return [
+            (user_id, date, message_id, f["file_id"], f["file_unique_id"], f.get("file_size"))
+            for f in files
+        ]
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                job = self._queue.get(timeout=1)
+            except Empty:
+                continue
+            self._archive(job)
+
+    def _archive(self, job: ArchiveJob) -> None:
+        user_id, date, message_id, file_id, file_unique_id, file_size = job
+        location = self.location(file_unique_id)
+        path = os.path.join(self.directory, location)
+        if not os.path.exists(path):
+            self._rescan()
+            if file_size is not None and not self._fits(file_size):
+                logging.warning(f"Media archive is over budget, skipping file {file_unique_id}.")
+                return
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if not self._download(file_id, path):
+                        logging.warning(f"Media archive is over budget, skipping file {file_unique_id}.")
+                        return
+                    break
+                except Exception as e:
+                    logging.warning(f"Failed to archive file {file_unique_id} (attempt {attempt + 1}): {e}")
+                    if attempt == self.max_retries or self._stopped.wait(2 ** attempt):
+                        return
+        try:
+            self.on_archived(user_id, date, message_id, {file_unique_id: location})
+        except Exception as e:
+            logging.error(f"Failed to record archived file {file_unique_id}: {e}")
+
+    def _download(self, file_id: str, path: str) -> bool:
+        """
+        Streams file to a temporary file next to `path`, and moves it to `path` once complete
+
+        :return: `False` if file does not fit into byte budget
+        """
+        file = self.bot.get_file(file_id)
+        if file.file_size is not None and not self._fits(file.file_size):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # same file may be downloaded by two workers (or shards) at once
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        # `File.download` would read the whole file into memory first
+        response = self.bot.request._con_pool.request("GET", file.file_path, preload_content=False)
+        try:
+            if not 200 <= response.status <= 299:
+                raise NetworkError(f"Download failed ({response.status})")
+            size = 0
+            with open(tmp_path, "wb") as f:
+                for chunk in response.stream(self.chunk_size):
+                    size += len(chunk)
+                    # size is not always known upfront
+                    if not self._fits(size):
+                        return False
+                    f.write(chunk)
+            response.release_conn()
+            # file is moved under the lock, so that a file downloaded twice is counted once
+            with self._lock:
+                if os.path.exists(path):
+                    return True
+                if not self._fits(size):
+                    return False
+                os.replace(tmp_path, path)
+                self.used_bytes += size
+            return True
+        finally:
+            # unless response has been read completely, its connection is closed before it is returned to pool
+            response.close()
+            response.release_conn()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _fits(self, size: int) -> bool:
+        return self.used_bytes + size <= self.byte_budget
+
+    def _rescan(self) -> None:
+        """
+        Re-measures store size, if it has not been measured for `rescan_interval`, to count files of other shards
+        """
+        with self._lock:
+            if time.monotonic() - self._scanned_at < self.rescan_interval:
+                return
+            self._scanned_at = time.monotonic()
+        size = self._store_size()
+        with self._lock:
+            self.used_bytes = size
+
+    def _store_size(self) -> int:
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".part"):
+                    total += os.path.getsize(os.path.join(root, name))
+        return total
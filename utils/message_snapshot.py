@@ -0,0 +1,35 @@
+from typing import Any, Dict
+
+from telegram import Message, Bot, User, Chat
+
+from utils import entry_schema
+
+
+def snapshot_message(message: Message) -> Dict[str, Any]:
+    """
+    Creates a compact reference to message, to be kept in conversation state instead of a full `to_dict()`.
+
+    This is a compact entry (see `utils.entry_schema`) plus id and type of `chat`.
+
+    :param message: content message
+    :return: JSON-serializable snapshot
+    """
+    snapshot = entry_schema.compact_entry(message)
+    snapshot["chat"] = {"id": message.chat.id, "type": message.chat.type}
+    return snapshot
+
+
+def restore_message(snapshot: Dict[str, Any], bot: Bot, user: User) -> Message:
+    """
+    Restores message from its snapshot.
+
+    :param snapshot: result of `snapshot_message`
+    :param bot: bot, that message will be bound to
+    :param user: user, who sent the message
+    :return: message with content of the original one
+    """
+    entry = dict(snapshot)
+    chat = Chat.de_json(entry.pop("chat"), bot)
+    # snapshots taken before `entry_schema` have the same fields, but no version
+    entry.setdefault("v", entry_schema.schema_version)
+    return entry_schema.restore_message(entry, bot, user, chat)
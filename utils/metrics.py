@@ -0,0 +1,231 @@
+"""
+In-process metrics, exposed in Prometheus text format on a local HTTP endpoint.
+
+Recording is a lock and a few additions, so metrics are always on. Gauges are callbacks, evaluated only when scraped.
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# upper bounds (in seconds) of latency histogram buckets
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+GaugeValue = Union[float, Dict[str, float]]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter(object):
+    """
+    Monotonic counter, per combination of label values
+    """
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets, per combination of label values
+    """
+
+    def __init__(
+            self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = latency_buckets
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> (count per bucket, with +Inf last; sum)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(label_values) or self._values.setdefault(
+                label_values, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[i] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted(
+                (label_values, list(counts), total[0]) for label_values, (counts, total) in self._values.items()
+            )
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labels + ("le",), label_values + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(object):
+    """
+    Value read from a callback when scraped. Callback returns either a value, or values by label value.
+    """
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], GaugeValue], label: Optional[str] = None):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.label = label
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.read()
+        except Exception as e:
+            logging.debug(f"Could not read gauge {self.name}: {e}")
+            return lines
+        if isinstance(value, dict):
+            for label_value, item in sorted(value.items()):
+                lines.append(f"{self.name}{_format_labels((self.label,), (label_value,))} {item}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Metrics(object):
+    """
+    Registry of all metrics of the bot
+    """
+
+    handler_calls = Counter("libreta_handler_calls_total", "Handler calls by outcome", ("handler", "outcome"))
+    handler_latency = Histogram("libreta_handler_seconds", "Handler latency", ("handler",))
+    storage_calls = Counter("libreta_storage_calls_total", "Storage calls by outcome", ("method", "outcome"))
+    storage_latency = Histogram("libreta_storage_seconds", "Storage call latency", ("method",))
+    _metrics: List[Union[Counter, Histogram, Gauge]] = [handler_calls, handler_latency, storage_calls, storage_latency]
+    _server: Optional["_HTTPServer"] = None
+
+    @classmethod
+    def gauge(cls, name: str, help_text: str, read: Callable[[], GaugeValue], label: Optional[str] = None) -> None:
+        """
+        Registers a gauge
+
+        :param name: name of gauge
+        :param help_text: description of gauge
+        :param read: returns current value, or values by `label`
+        :param label: name of label, if `read` returns a dict
+        """
+        cls._metrics.append(Gauge(name, help_text, read, label))
+
+    @classmethod
+    def render(cls) -> str:
+        """
+        :return: all metrics in Prometheus text format
+        """
+        lines = []
+        for metric in cls._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def start_server(cls, listen: str, port: int) -> None:
+        """
+        Serves metrics on `http://{listen}:{port}/metrics`
+        """
+        cls._server = _HTTPServer((listen, port), _MetricsRequestHandler)
+        threading.Thread(target=cls._server.serve_forever, name="metrics", daemon=True).start()
+        logging.info(f"Serving metrics on {listen}:{port}/metrics")
+
+    @classmethod
+    def stop_server(cls) -> None:
+        if cls._server is not None:
+            cls._server.shutdown()
+            cls._server.server_close()
+            cls._server = None
+
+
+def instrument_handler_callback(name: str, callback: Callable) -> Callable:
+    """
+    Wraps handler callback, so that its calls and latency are recorded under `name`
+    """
+
+    @functools.wraps(callback)
+    def instrumented(*args, **kwargs):
+        started_at = time.perf_counter()
+        outcome = "error"
+        try:
+            result = callback(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            Metrics.handler_latency.observe(time.perf_counter() - started_at, name)
+            Metrics.handler_calls.inc(name, outcome)
+
+    return instrumented
+
+
+def instrument_method(obj: object, method_name: str) -> None:
+    """
+    Replaces method of object with one whose calls, errors and latency are recorded under `method_name`
+    """
+    method = getattr(obj, method_name)
+
+    @functools.wraps(method)
+    def instrumented(*args, **kwargs):
+        started_at = time.perf_counter()
+        outcome = "error"
+        try:
+            result = method(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            Metrics.storage_latency.observe(time.perf_counter() - started_at, method_name)
+            Metrics.storage_calls.inc(method_name, outcome)
+
+    setattr(obj, method_name, instrumented)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        payload = Metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
@@ -0,0 +1,329 @@
+"""
+Outbound queue of Bot API sends, that keeps the bot within Telegram flood limits.
+"""
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from enum import IntEnum
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from telegram import Bot, Message
+from telegram.error import RetryAfter, TimedOut, NetworkError
+
+from utils.keyed_executor import KeyedExecutor
+
+
+class Priority(IntEnum):
+    """
+    Lower value is sent first
+    """
+
+    # replies to users, who are waiting for them
+    INTERACTIVE = 0
+    # e.g. reminders and exports
+    BACKGROUND = 1
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` sends per second on average, and bursts of up to `capacity` sends
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self, now: float) -> float:
+        """
+        Takes a token, possibly one that is yet to be refilled.
+
+        :return: time (in seconds) until the token is available
+        """
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+        self.tokens -= 1
+        # bucket may be paused
+        return max(0.0, self.updated_at - now) + max(0.0, -self.tokens / self.rate)
+
+    def pause(self, now: float, seconds: float) -> None:
+        """
+        Makes bucket empty for given time, e.g. after Telegram has asked to retry later
+        """
+        self.tokens = 0
+        self.updated_at = max(self.updated_at, now + seconds)
+
+    def is_full(self, now: float) -> bool:
+        return now >= self.updated_at and self.tokens + (now - self.updated_at) * self.rate >= self.capacity
+
+
+class _Send(object):
+    __slots__ = ("chat_id", "fn", "priority", "sequence", "future", "enqueued_at", "attempts", "has_token")
+
+    def __init__(self, chat_id: int, fn: Callable[[], Any], priority: Priority):
+        self.chat_id = chat_id
+        self.fn = fn
+        self.priority = priority
+        # order of submission, kept by retries
+        self.sequence = 0
+        self.future: Future = Future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        # whether a token of chat bucket has been reserved
+        self.has_token = False
+
+
+class Outbox(object):
+    """
+    Queue of outbound sends, with per-chat and global token buckets.
+
+    Interactive replies are sent before background sends. Sends to a chat are made in order, and sends to different
+    chats in parallel. When Telegram answers with `retry_after`, the chat is paused for that long and the send
+    is retried, as it is on network errors (with backoff). Later sends to the chat are held back until the retried
+    one has been sent (or given up on), so that they do not overtake it.
+
+    If not set up, sends are made right away by the calling thread.
+    """
+
+    _executor: Optional[KeyedExecutor] = None
+    _thread: Optional[threading.Thread] = None
+    _condition = threading.Condition()
+    _running = False
+    # heap of (priority, sequence number, send), sends that may be sent now
+    _ready: List[tuple] = []
+    # heap of (time it may be sent at, priority, sequence number, send)
+    _delayed: List[tuple] = []
+    _sequence = itertools.count()
+    # chat id -> send that is being retried, and sends to the chat that are held back until it is done
+    _retrying: Dict[int, _Send] = {}
+    _held: Dict[int, List[_Send]] = {}
+    _global_bucket = TokenBucket(30, 30)
+    _chat_buckets: Dict[int, TokenBucket] = {}
+    chat_rate: float = 1
+    chat_burst: float = 3
+    max_retries: int = 5
+    # enqueue -> sent latencies (in seconds) of recent sends
+    _latencies: Deque[float] = deque(maxlen=1000)
+    _counters = {"sent": 0, "failed": 0, "retried": 0, "rate_limited": 0}
+
+    @classmethod
+    def setup(
+            cls,
+            workers: int,
+            global_rate: float = 30,
+            chat_rate: float = 1,
+            chat_burst: float = 3,
+            max_retries: int = 5,
+    ) -> None:
+        """
+        :param workers: number of threads making requests
+        :param global_rate: max number of sends per second, in total
+        :param chat_rate: max number of sends per second, to a single chat
+        :param chat_burst: number of sends to a chat that may be made at once
+        :param max_retries: max number of retries of a send
+        """
+        cls._global_bucket = TokenBucket(global_rate, global_rate)
+        cls.chat_rate = chat_rate
+        cls.chat_burst = chat_burst
+        cls.max_retries = max_retries
+        cls._executor = KeyedExecutor(workers, name="outbox_worker")
+        cls._executor.start()
+        cls._running = True
+        cls._thread = threading.Thread(target=cls._run, name="outbox", daemon=True)
+        cls._thread.start()
+
+    @classmethod
+    def close(cls, timeout: float = 10) -> None:
+        """
+        Sends queued messages (waiting at most `timeout`) and stops
+        """
+        if cls._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        with cls._condition:
+            while (cls._ready or cls._delayed or cls._held) and time.monotonic() < deadline:
+                cls._condition.wait(0.1)
+            held = sum(len(sends) for sends in cls._held.values())
+            if cls._ready or cls._delayed or held:
+                logging.warning(f"Dropping {len(cls._ready) + len(cls._delayed) + held} queued messages.")
+            cls._running = False
+            cls._condition.notify_all()
+        cls._thread.join()
+        # sends that fail from now on are not retried
+        cls._thread = None
+        cls._executor.shutdown()
+        cls._executor = None
+
+    @classmethod
+    def submit(cls, chat_id: int, fn: Callable[[], Any], priority: Priority = Priority.INTERACTIVE) -> Future:
+        """
+        Queues a send
+
+        :param chat_id: chat that is sent to
+        :param fn: makes the request
+        :param priority: priority of send
+        :return: future with result of `fn`
+        """
+        send = _Send(chat_id, fn, priority)
+        if cls._thread is None:
+            cls._deliver(send)
+            return send.future
+        with cls._condition:
+            send.sequence = next(cls._sequence)
+            heapq.heappush(cls._ready, (priority, send.sequence, send))
+            cls._condition.notify_all()
+        return send.future
+
+    @classmethod
+    def reply(cls, message: Message, text: str, **kwargs) -> Future:
+        """
+        Queues an interactive reply to message, see `Message.reply_text`
+        """
+        return cls.submit(message.chat_id, functools.partial(message.reply_text, text, **kwargs))
+
+    @classmethod
+    def send_message(
+            cls, bot: Bot, chat_id: int, text: str, priority: Priority = Priority.BACKGROUND, **kwargs
+    ) -> Future:
+        """
+        Queues a message, see `Bot.send_message`
+        """
+        return cls.submit(chat_id, functools.partial(bot.send_message, chat_id, text, **kwargs), priority)
+
+    @classmethod
+    def stats(cls) -> Dict[str, float]:
+        """
+        :return: queue depth, counters, and latency percentiles (in seconds) of recent sends
+        """
+        latencies = sorted(cls._latencies)
+        stats: Dict[str, float] = {"ready": len(cls._ready), "delayed": len(cls._delayed), **cls._counters}
+        if latencies:
+            stats["latency_p50"] = latencies[len(latencies) // 2]
+            stats["latency_p95"] = latencies[int(len(latencies) * 0.95)]
+        return stats
+
+    @classmethod
+    def _run(cls) -> None:
+        while True:
+            with cls._condition:
+                now = time.monotonic()
+                while cls._delayed and cls._delayed[0][0] <= now:
+                    _, priority, sequence, send = heapq.heappop(cls._delayed)
+                    heapq.heappush(cls._ready, (priority, sequence, send))
+                if not cls._ready:
+                    if not cls._running:
+                        return
+                    cls._condition.wait(min(cls._delayed[0][0] - now, 1) if cls._delayed else 1)
+                    continue
+                priority, sequence, send = heapq.heappop(cls._ready)
+                retrying = cls._retrying.get(send.chat_id)
+                if retrying is not None and retrying is not send:
+                    # held back before it takes a token of chat, so that it does not delay the retried send
+                    cls._held.setdefault(send.chat_id, []).append(send)
+                    continue
+                if not send.has_token:
+                    bucket = cls._chat_buckets.get(send.chat_id)
+                    if bucket is None:
+                        bucket = cls._chat_buckets[send.chat_id] = TokenBucket(cls.chat_rate, cls.chat_burst)
+                    wait = bucket.reserve(now)
+                    send.has_token = True
+                    if wait > 0:
+                        # chat is over its limit, other chats do not have to wait
+                        heapq.heappush(cls._delayed, (now + wait, priority, sequence, send))
+                        continue
+                global_wait = cls._global_bucket.reserve(now)
+                if len(cls._chat_buckets) > 10000:
+                    cls._forget_idle_chats(now)
+            if global_wait > 0:
+                time.sleep(global_wait)
+            cls._executor.submit(send.chat_id, cls._deliver, send)
+
+    @classmethod
+    def _deliver(cls, send: _Send) -> None:
+        with cls._condition:
+            retrying = cls._retrying.get(send.chat_id)
+            if retrying is not None and retrying is not send:
+                # an earlier send to chat is being retried, this one waits for it
+                cls._held.setdefault(send.chat_id, []).append(send)
+                return
+        try:
+            result = send.fn()
+        except RetryAfter as e:
+            cls._count("rate_limited")
+            logging.warning(f"Rate limited sending to chat {send.chat_id}, retrying in {e.retry_after}s.")
+            cls._retry(send, e.retry_after, pause_chat=True)
+        except TimedOut as e:
+            # request may have reached Telegram, retrying could send it twice
+            cls._fail(send, e)
+        except NetworkError as e:
+            cls._retry(send, 2 ** send.attempts, error=e)
+        except Exception as e:
+            cls._fail(send, e)
+        else:
+            cls._count("sent")
+            cls._latencies.append(time.monotonic() - send.enqueued_at)
+            send.future.set_result(result)
+            cls._release_chat(send)
+
+    @classmethod
+    def _retry(cls, send: _Send, delay: float, pause_chat: bool = False, error: Optional[Exception] = None) -> None:
+        send.attempts += 1
+        if cls._thread is None or send.attempts > cls.max_retries:
+            cls._fail(send, error or RuntimeError(f"Gave up sending to chat {send.chat_id}"))
+            return
+        cls._count("retried")
+        with cls._condition:
+            now = time.monotonic()
+            if pause_chat and send.chat_id in cls._chat_buckets:
+                cls._chat_buckets[send.chat_id].pause(now, delay)
+            send.has_token = False
+            cls._retrying[send.chat_id] = send
+            heapq.heappush(cls._delayed, (now + delay, send.priority, send.sequence, send))
+            cls._condition.notify_all()
+
+    @classmethod
+    def _release_chat(cls, send: _Send) -> None:
+        """
+        Queues sends held back by given send again, in their original order, once it has been sent or given up on
+        """
+        with cls._condition:
+            if cls._retrying.get(send.chat_id) is not send:
+                return
+            del cls._retrying[send.chat_id]
+            held = cls._held.pop(send.chat_id, [])
+            if cls._thread is not None:
+                for held_send in held:
+                    held_send.has_token = False
+                    heapq.heappush(cls._ready, (held_send.priority, held_send.sequence, held_send))
+                cls._condition.notify_all()
+                return
+        # outbox has been closed meanwhile
+        for held_send in held:
+            cls._deliver(held_send)
+
+    @classmethod
+    def _fail(cls, send: _Send, error: Exception) -> None:
+        cls._count("failed")
+        logging.error(f"Failed to send to chat {send.chat_id}: {error}")
+        send.future.set_exception(error)
+        cls._release_chat(send)
+
+    @classmethod
+    def _count(cls, counter: str) -> None:
+        with cls._condition:
+            cls._counters[counter] += 1
+
+    @classmethod
+    def _forget_idle_chats(cls, now: float) -> None:
+        """
+        Drops buckets of chats that have not been sent to recently, as they are full anyway
+        """
+        for chat_id in [chat_id for chat_id, bucket in cls._chat_buckets.items() if bucket.is_full(now)]:
+            del cls._chat_buckets[chat_id]
@@ -0,0 +1,36 @@
+import threading
+import time
+from typing import Dict, Set
+
+
+class PublishedDates(object):
+    """
+    In-memory record of which users have published content on recent dates, fed by `Dao.publish`.
+
+    Lets reminders skip users who have already written, without a db read per user.
+    Only publishes made since `tracked_since` are known.
+    """
+
+    def __init__(self, max_dates: int = 3):
+        """
+        :param max_dates: number of most recent dates that are kept
+        """
+        self.max_dates = max_dates
+        # wall clock time since which publishes are recorded
+        self.tracked_since = time.time()
+        # ISO date -> ids of users who have published on that date
+        self._users_by_date: Dict[str, Set[int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, user_id: int, date: str) -> None:
+        with self._lock:
+            users = self._users_by_date.get(date)
+            if users is None:
+                users = self._users_by_date[date] = set()
+                # ISO dates sort chronologically
+                for old_date in sorted(self._users_by_date)[:-self.max_dates]:
+                    del self._users_by_date[old_date]
+            users.add(user_id)
+
+    def contains(self, user_id: int, date: str) -> bool:
+        return user_id in self._users_by_date.get(date, ())
@@ -0,0 +1,152 @@
+"""
+Daily reminders for users who have not written anything yet today.
+"""
+import datetime
+import heapq
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from telegram.ext import CallbackContext, JobQueue
+
+from strings import Strings
+from utils.dao import Dao, get_zone
+from utils.outbox import Outbox
+
+
+class Reminders(object):
+    """
+    Reminds users in the evening (at their local time) if they have not published anything that day.
+
+    Users are grouped by timezone and every timezone has a single daily job. Who has already written is looked up in
+    `Dao.published_dates`, so there are no db reads per user, except on the first day after a restart.
+    Reminders are spread over `window` and sent at no more than `max_per_second`, so they do not come in bursts.
+    """
+
+    hour: int = 21
+    window: float = 30 * 60
+    max_per_second: int = 20
+    job_queue: Optional[JobQueue] = None
+    # whether user is reminded by this process, in sharded mode
+    owns_user: Optional[Callable[[int], bool]] = None
+    # timezone name -> ids of users in that timezone
+    _users_by_zone: Dict[str, Set[int]] = {}
+    _user_zones: Dict[int, str] = {}
+    # heap of (time to be sent at, user id, ISO date at user's)
+    _pending: List[Tuple[float, int, str]] = []
+    _lock = threading.Lock()
+
+    @classmethod
+    def setup(
+            cls,
+            job_queue: JobQueue,
+            hour: int,
+            window: float,
+            max_per_second: int,
+            owns_user: Optional[Callable[[int], bool]] = None,
+    ) -> None:
+        """
+        :param job_queue: job queue reminders are scheduled on
+        :param hour: local hour reminders are sent at
+        :param window: time (in seconds) reminders of a timezone are spread over
+        :param max_per_second: max number of reminders sent per second
+        :param owns_user: if given, only users it returns `True` for are reminded
+        """
+        cls.job_queue = job_queue
+        cls.owns_user = owns_user
+        cls.hour = hour
+        cls.window = window
+        cls.max_per_second = max_per_second
+        # pick up newly invited users and timezone changes made elsewhere, two db reads each time
+        job_queue.run_repeating(cls._reload, interval=6 * 3600, first=0)
+        job_queue.run_repeating(cls._send_due, interval=1)
+
+    @classmethod
+    def set_user_timezone(cls, user_id: int, tz_name: str) -> None:
+        """
+        Moves user to timezone, called whenever user changes it
+        """
+        with cls._lock:
+            cls._assign(user_id, tz_name)
+
+    @classmethod
+    def stats(cls) -> Dict[str, int]:
+        return {"users": len(cls._user_zones), "zones": len(cls._users_by_zone), "pending": len(cls._pending)}
+
+    @classmethod
+    def _assign(cls, user_id: int, tz_name: str) -> None:
+        old_zone = cls._user_zones.get(user_id)
+        if old_zone == tz_name:
+            return
+        if old_zone is not None:
+            cls._users_by_zone[old_zone].discard(user_id)
+        cls._user_zones[user_id] = tz_name
+        if tz_name not in cls._users_by_zone:
+            cls._users_by_zone[tz_name] = set()
+            cls.job_queue.run_daily(
+                cls._remind_zone,
+                datetime.time(cls.hour, tzinfo=get_zone(tz_name)),
+                context=tz_name,
+                name=f"reminders_{tz_name}",
+            )
+        cls._users_by_zone[tz_name].add(user_id)
+
+    @classmethod
+    def _reload(cls, _: CallbackContext) -> None:
+        invited_user_ids = Dao.backend.get_invited_user_ids()
+        timezones = Dao.backend.get_user_timezones()
+        with cls._lock:
+            for user_id in invited_user_ids:
+                if cls.owns_user is not None and not cls.owns_user(int(user_id)):
+                    continue
+                # same default as `Dao.get_user_timezone`
+                cls._assign(int(user_id), timezones.get(int(user_id), "UTC"))
+        logging.info(f"Reminders are scheduled for {len(cls._user_zones)} users in {len(cls._users_by_zone)} zones.")
+
+    @classmethod
+    def _remind_zone(cls, context: CallbackContext) -> None:
+        """
+        Queues reminders of users in a timezone, spread over `window`
+        """
+        tz_name = context.job.context
+        today = datetime.datetime.now(get_zone(tz_name)).date().isoformat()
+        with cls._lock:
+            user_ids = [
+                user_id for user_id in cls._users_by_zone[tz_name]
+                if not Dao.published_dates.contains(user_id, today)
+            ]
+            now = time.time()
+            for i, user_id in enumerate(user_ids):
+                heapq.heappush(cls._pending, (now + i * cls.window / len(user_ids), user_id, today))
+        logging.debug(f"Queued {len(user_ids)} reminders in {tz_name}.")
+
+    @classmethod
+    def _send_due(cls, context: CallbackContext) -> None:
+        """
+        Sends reminders that are due, at most `max_per_second` per run
+        """
+        now = time.time()
+        due = []
+        with cls._lock:
+            while cls._pending and cls._pending[0][0] <= now and len(due) < cls.max_per_second:
+                due.append(heapq.heappop(cls._pending))
+        for _, user_id, date in due:
+            if not cls._should_remind(user_id, date):
+                continue
+            # chat with user has the same id as user
+            Outbox.send_message(context.bot, user_id, Strings.reminder)
+
+    @classmethod
+    def _should_remind(cls, user_id: int, date: str) -> bool:
+        if Dao.invited_users is not None and not Dao.invited_users.contains(user_id):
+            return False
+        # user may have written since reminder was queued
+        if Dao.published_dates.contains(user_id, date):
+            return False
+        zone = get_zone(cls._user_zones.get(user_id, "UTC"))
+        local_midnight = zone.localize(datetime.datetime.fromisoformat(date))
+        if Dao.published_dates.tracked_since > local_midnight.timestamp():
+            # publishes made before a restart are not known, db has to be checked
+            return not Dao.backend.has_entries_on(user_id, date)
+        return True
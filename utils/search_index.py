@@ -0,0 +1,260 @@
+"""
+Full-text search over diary entries, answered from a local per-user inverted index.
+
+Index of a user maps every token (case-folded word of text, captions and document names) to entries containing it,
+by (ISO date, message id). It is kept up to date by `Dao` on every publish and edit, so a search reads from db
+only the entries it shows.
+
+Every user has a file under the index directory with tokens of each entry, from which postings are rebuilt
+when the user is loaded. Only recently searched or written users are kept in memory, changed ones are saved
+in background. Users whose index is not `complete` (e.g. who had entries before the index existed) are indexed
+from db on their first search, or offline by `tools.rebuild_search_index`.
+"""
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from utils import entry_schema
+from utils.storage import EntryWrite
+
+# (ISO date, message id)
+EntryRef = Tuple[str, int]
+
+token_pattern = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    :return: distinct case-folded words of text, in order of appearance
+    """
+    return list(dict.fromkeys(token_pattern.findall(text.casefold())))
+
+
+def entry_tokens(entry: Dict[str, Any]) -> List[str]:
+    """
+    :return: distinct tokens of text, captions and document names of every part of an entry
+    """
+    texts = []
+    for part in entry_schema.entry_parts(entry):
+        texts.append(part.get("text") or part.get("caption") or "")
+        if part.get("document"):
+            texts.append(part["document"].get("file_name", ""))
+    return tokenize(" ".join(texts))
+
+
+class _UserIndex(object):
+    __slots__ = ("complete", "entries", "postings")
+
+    def __init__(self, complete: bool = False):
+        # whether all entries of user are indexed
+        self.complete = complete
+        # entry -> its tokens, to remove stale postings when entry changes
+        self.entries: Dict[EntryRef, List[str]] = {}
+        # token -> entries containing it
+        self.postings: Dict[str, Set[EntryRef]] = {}
+
+    def set(self, ref: EntryRef, tokens: List[str]) -> None:
+        for token in self.entries.pop(ref, ()):
+            refs = self.postings[token]
+            refs.discard(ref)
+            if not refs:
+                del self.postings[token]
+        self.entries[ref] = tokens
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(ref)
+
+    def match(self, tokens: List[str]) -> List[EntryRef]:
+        """
+        :param tokens: all of them have to be in entry, the last one may be a prefix (as query is being typed)
+        :return: matching entries, newest first
+        """
+        *words, last = tokens
+        matches: Optional[Set[EntryRef]] = None
+        # rarest words first, so that intersection shrinks fast
+        for word in sorted(words, key=lambda w: len(self.postings.get(w, ()))):
+            refs = self.postings.get(word, set())
+            matches = set(refs) if matches is None else matches & refs
+            if not matches:
+                return []
+        prefixed: Set[EntryRef] = set()
+        for token, refs in self.postings.items():
+            if token.startswith(last):
+                prefixed |= refs if matches is None else refs & matches
+        return sorted(prefixed, reverse=True)
+
+    def dumps(self) -> str:
+        entries = {f"{date}/{message_id}": " ".join(tokens) for (date, message_id), tokens in self.entries.items()}
+        return json.dumps({"complete": self.complete, "entries": entries}, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def loads(cls, data: str) -> "_UserIndex":
+        raw = json.loads(data)
+        index = cls(raw.get("complete", False))
+        for key, tokens in raw.get("entries", {}).items():
+            date, _, message_id = key.partition("/")
+            index.set((date, int(message_id)), tokens.split())
+        return index
+
+
+class SearchIndex(object):
+    """
+    Inverted indexes of users, persisted as one file per user
+    """
+
+    def __init__(self, directory: str, max_users: int = 1000, flush_interval: float = 5.0):
+        """
+        :param directory: directory of index files
+        :param max_users: max number of user indexes kept in memory
+        :param flush_interval: time (in seconds) between saving batches of changed indexes
+        """
+        self.directory = directory
+        self.max_users = max_users
+        self.flush_interval = flush_interval
+        # user id -> index, least recently used first
+        self._users: "OrderedDict[int, _UserIndex]" = OrderedDict()
+        self._dirty: Set[int] = set()
+        # user id -> changes made while user is being rebuilt from db, re-applied to the rebuilt index
+        self._rebuilding: Dict[int, List[Tuple[EntryRef, List[str]]]] = {}
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="search_index", daemon=True)
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """
+        Saves changed indexes and stops saving in background
+        """
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+
+    def update(self, user_id: int, date: str, message_id: int, entry: Dict[str, Any], merge: bool = False) -> None:
+        """
+        Indexes new or changed entry
+
+        :param merge: whether tokens are added to those indexed before, instead of replacing them,
+            when entry is only partially known (e.g. a single edited part of album)
+        """
+        ref = (date, message_id)
+        tokens = entry_tokens(entry)
+        with self._lock:
+            index = self._get(user_id)
+            if merge:
+                tokens = list(dict.fromkeys(index.entries.get(ref, []) + tokens))
+            index.set(ref, tokens)
+            self._dirty.add(user_id)
+            if user_id in self._rebuilding:
+                self._rebuilding[user_id].append((ref, tokens))
+
+    def is_complete(self, user_id: int) -> bool:
+        with self._lock:
+            return self._get(user_id).complete
+
+    def search(self, user_id: int, query: str) -> List[EntryRef]:
+        """
+        :return: entries of user matching all words of query, newest first
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self._lock:
+            return self._get(user_id).match(tokens)
+
+    def rebuild(self, user_id: int, entries: Iterable[EntryWrite]) -> int:
+        """
+        Replaces index of user with one built from given entries, which are read without holding the index.
+        Changes made meanwhile are applied to the new index as well.
+
+        :param entries: all entries of user, e.g. streamed from db
+        :return: number of indexed entries
+        """
+        with self._lock:
+            self._rebuilding[user_id] = []
+        try:
+            index = _UserIndex(complete=True)
+            for entry in entries:
+                index.set((entry.date, entry.message_id), entry_tokens(entry.content))
+        except Exception:
+            with self._lock:
+                del self._rebuilding[user_id]
+            raise
+        with self._lock:
+            for ref, tokens in self._rebuilding.pop(user_id):
+                index.set(ref, tokens)
+            # entries are never removed, so those missing in db have not been written there yet (e.g. are journaled)
+            for ref, tokens in self._get(user_id).entries.items():
+                if ref not in index.entries:
+                    index.set(ref, tokens)
+            self._users[user_id] = index
+            self._users.move_to_end(user_id)
+            self._dirty.add(user_id)
+            self._evict()
+        return len(index.entries)
+
+    def flush(self) -> None:
+        """
+        Saves indexes that have changed since last flush
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            for user_id in dirty:
+                if user_id in self._users:
+                    self._save(user_id, self._users[user_id])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"users": len(self._users), "dirty": len(self._dirty)}
+
+    # internals
+
+    def _filename(self, user_id: int) -> str:
+        return os.path.join(self.directory, f"{user_id}.json")
+
+    def _get(self, user_id: int) -> _UserIndex:
+        index = self._users.get(user_id)
+        if index is None:
+            index = self._load(user_id)
+            self._users[user_id] = index
+            self._evict()
+        self._users.move_to_end(user_id)
+        return index
+
+    def _evict(self) -> None:
+        while len(self._users) > self.max_users:
+            user_id, index = self._users.popitem(last=False)
+            if user_id in self._dirty:
+                self._dirty.discard(user_id)
+                self._save(user_id, index)
+
+    def _load(self, user_id: int) -> _UserIndex:
+        try:
+            with open(self._filename(user_id), encoding="utf-8") as f:
+                return _UserIndex.loads(f.read())
+        except FileNotFoundError:
+            return _UserIndex()
+        except (OSError, ValueError) as e:
+            # index is derived data, it will be rebuilt from db
+            logging.warning(f"Could not load search index of user {user_id}: {e}")
+            return _UserIndex()
+
+    def _save(self, user_id: int, index: _UserIndex) -> None:
+        filename = self._filename(user_id)
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_filename, "w", encoding="utf-8") as f:
+                f.write(index.dumps())
+            os.replace(tmp_filename, filename)
+        except OSError as e:
+            logging.error(f"Could not save search index of user {user_id}: {e}")
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
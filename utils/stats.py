@@ -0,0 +1,69 @@
+"""
+Writing statistics of a user, derived from aggregates that backends keep up to date on every entry write.
+
+Aggregates are the number of entries, entries by month and the set of days with entries. Writing a day is
+idempotent, so aggregates stay correct when entries are rewritten (e.g. edited or replayed). Streaks are derived
+from the set of days when read, as they may change by entries published for past dates.
+"""
+import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from utils.storage import Aggregates, EntryWrite
+
+
+class UserStats(NamedTuple):
+    entries: int
+    days: int
+    first_date: Optional[str]
+    last_date: Optional[str]
+    current_streak: int
+    longest_streak: int
+    # month -> number of entries, in month order
+    months: Dict[str, int]
+
+
+def aggregate(entries: Iterable[EntryWrite]) -> Aggregates:
+    """
+    Computes aggregates from entries of a user in a single pass, e.g. to backfill them
+    """
+    months: Dict[str, int] = {}
+    days = set()
+    for entry in entries:
+        months[entry.date[:7]] = months.get(entry.date[:7], 0) + 1
+        days.add(entry.date)
+    return Aggregates(sum(months.values()), months, sorted(days))
+
+
+def streaks(days: List[str], today: datetime.date) -> Tuple[int, int]:
+    """
+    :param days: ISO dates with entries, in date order
+    :param today: today at user's
+    :return: current streak (consecutive days up to today, or up to yesterday if user has not written today yet)
+        and longest streak, in days
+    """
+    longest = run = 0
+    previous: Optional[datetime.date] = None
+    for day in map(datetime.date.fromisoformat, days):
+        run = run + 1 if previous is not None and (day - previous).days == 1 else 1
+        longest = max(longest, run)
+        previous = day
+    current = run if previous is not None and (today - previous).days in (0, 1) else 0
+    return current, longest
+
+
+def summarize(aggregates: Aggregates, today: datetime.date) -> UserStats:
+    """
+    :param aggregates: aggregates of user
+    :param today: today at user's
+    """
+    days = aggregates.days
+    current, longest = streaks(days, today)
+    return UserStats(
+        entries=aggregates.entries,
+        days=len(days),
+        first_date=days[0] if days else None,
+        last_date=days[-1] if days else None,
+        current_streak=current,
+        longest_streak=longest,
+        months=dict(sorted(aggregates.months.items())),
+    )
@@ -0,0 +1,16 @@
+from .backend import StorageBackend, EntryWrite, Aggregates
+
+# engines (and their db drivers, e.g. `firebase_admin`) are only imported once used, to keep startup fast
+_engines = {
+    "FirebaseBackend": "firebase_backend",
+    "SqliteBackend": "sqlite_backend",
+}
+
+
+def __getattr__(name: str):
+    if name in _engines:
+        import importlib
+
+        module = importlib.import_module(f"{__name__}.{_engines[name]}")
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,164 @@
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Set
+
+# receives either a full set of invited user ids (that replaces the previous one),
+# or `None` and changes as user id -> whether user is invited now
+InvitedUsersCallback = Callable[[Optional[Set[str]], Dict[str, bool]], None]
+
+
+class EntryWrite(NamedTuple):
+    """
+    Single diary entry to be written
+    """
+
+    user_id: int
+    date: str  # ISO date, e.g. `2021-07-29`
+    message_id: int
+    content: dict
+    # whether entry is published for the first time (not edited or rewritten), so that it is counted by month index
+    # and aggregates
+    is_new: bool = False
+
+
+class Aggregates(NamedTuple):
+    """
+    Aggregates of entries of a user, kept up to date by `write_entries`
+    """
+
+    entries: int
+    # month (`YYYY-MM`) -> number of entries
+    months: Dict[str, int]
+    # ISO dates with entries, in date order
+    days: List[str]
+
+
+class StorageBackend(ABC):
+    """
+    Storage engine that `Dao` delegates to.
+
+    Stores diary entries by (user, date), message -> date mapping, user profiles and invited users.
+    """
+
+    @abstractmethod
+    def get_invited_user_ids(self) -> Set[str]:
+        """
+        :return: ids of all invited users
+        """
+
+    def listen_invited_users(self, callback: InvitedUsersCallback) -> Optional[Callable[[], None]]:
+        """
+        Subscribes to changes of invited users, if backend supports it.
+
+        :param callback: called on every change
+        :return: function that unsubscribes, or `None` if not supported
+        """
+        return None
+
+    @abstractmethod
+    def is_user_invited(self, user_id: int) -> bool:
+        pass
+
+    @abstractmethod
+    def set_user_invited(self, user_id: int, invited: bool) -> None:
+        """
+        Invites or revokes user
+        """
+
+    @abstractmethod
+    def get_profile(self, user_id: int) -> Dict[str, Any]:
+        """
+        :return: user profile, e.g. `{"timezone": "Europe/Paris"}` (missing fields are `None`)
+        """
+
+    @abstractmethod
+    def update_profile(self, user_id: int, fields: Dict[str, Any]) -> None:
+        pass
+
+    @abstractmethod
+    def get_user_timezones(self) -> Dict[int, str]:
+        """
+        :return: user id -> timezone name, for all users who have set their timezone
+        """
+
+    @abstractmethod
+    def has_entries_on(self, user_id: int, date: str) -> bool:
+        pass
+
+    @abstractmethod
+    def get_message_date(self, user_id: int, message_id: int) -> Optional[str]:
+        """
+        :return: ISO date of entry with given message id, `None` if message is not diary content
+        """
+
+    @abstractmethod
+    def get_entry(self, user_id: int, date: str, message_id: int) -> Optional[Dict[str, Any]]:
+        """
+        :return: content of a single entry, `None` if there is no such entry
+        """
+
+    @abstractmethod
+    def write_entries(self, writes: List[EntryWrite]) -> None:
+        """
+        Atomically writes entries together with their message -> date mapping.
+        Entries with same (user, message id) are overridden.
+        """
+
+    @abstractmethod
+    def get_entry_counts(self, user_id: int, month: str) -> Dict[str, int]:
+        """
+        Reads month index of user.
+
+        :param month: month, e.g. `2021-07`
+        :return: ISO date -> number of entries, for dates of month with entries
+        """
+
+    def rebuild_month_index(self, user_id: int) -> None:
+        """
+        Recounts month index of user from entries, e.g. for entries written before the index existed.
+        Backends that derive the index from entries do not need to.
+        """
+
+    @abstractmethod
+    def get_aggregates(self, user_id: int) -> Aggregates:
+        """
+        :return: aggregates of entries of user, see `utils.stats`
+        """
+
+    def rebuild_aggregates(self, user_id: int) -> None:
+        """
+        Recomputes aggregates of user from entries, e.g. for entries written before aggregates existed.
+        Backends that derive aggregates from entries do not need to.
+        """
+
+    @abstractmethod
+    def update_entry(self, user_id: int, date: str, message_id: int, fields: Dict[str, Any]) -> None:
+        """
+        Updates fields of an existing entry.
+
+        :param fields: field path (e.g. `archive/{file_unique_id}`) -> new value, `None` removes field
+        """
+
+    @abstractmethod
+    def iter_user_ids(self) -> Iterator[int]:
+        """
+        :return: ids of all users with stored data
+        """
+
+    @abstractmethod
+    def iter_entries(
+            self, user_id: int, start_date: Optional[str] = None, end_date: Optional[str] = None, page_size: int = 100
+    ) -> Iterator[EntryWrite]:
+        """
+        Streams entries of user ordered by (date, message id), reading them page by page.
+
+        :param user_id: user whose entries they are
+        :param start_date: first date (inclusive), `None` to start from the very first entry
+        :param end_date: last date (inclusive), `None` to read up to the very last entry
+        :param page_size: max number of dates (or entries, depending on backend) read at once
+        :return: entries as `EntryWrite`s, so that they can be written back
+        """
+
+    def close(self) -> None:
+        """
+        Releases backend resources
+        """
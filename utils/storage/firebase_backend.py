@@ -0,0 +1,196 @@
+import logging
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from firebase_admin import db
+
+from utils.stats import aggregate
+from utils.storage.backend import StorageBackend, EntryWrite, Aggregates, InvitedUsersCallback
+
+
+def _children(node: Any) -> List[Tuple[str, Any]]:
+    """
+    Lists children of a node. Nodes with (mostly) sequential integer keys are returned by Firebase as lists.
+    """
+    if isinstance(node, dict):
+        return list(node.items())
+    if isinstance(node, list):
+        return [(str(key), value) for key, value in enumerate(node) if value is not None]
+    return []
+
+
+class FirebaseBackend(StorageBackend):
+    """
+    Backend storing data in Firebase Realtime Database under given root, as follows:
+
+    - `invited_users/{user_id}`
+    - `users/{user_id}/timezone`
+    - `user_timezones/{user_id}` -> timezone, so that timezones of all users are read at once
+    - `users/{user_id}/by_date/{date}/{message_id}` -> content
+    - `users/{user_id}/message_date/{message_id}` -> date
+    - `users/{user_id}/month_index/{month}/{date}` -> number of entries
+    - `users/{user_id}/stats` -> aggregates of entries, read at once:
+      `entries` -> number of entries, `months/{month}` -> number of entries, `days/{date}` -> `True`
+    """
+
+    def __init__(self, root: str):
+        """
+        :param root: db root, e.g. `libreta`
+        """
+        self.root = root
+
+    def _ref(self, path: str = "") -> db.Reference:
+        return db.reference(f"{self.root}/{path}" if path else self.root)
+
+    def get_invited_user_ids(self) -> Set[str]:
+        data = self._ref("invited_users").get(shallow=True)
+        return set(data.keys()) if isinstance(data, dict) else set()
+
+    def listen_invited_users(self, callback: InvitedUsersCallback) -> Optional[Callable[[], None]]:
+        def on_event(event: db.Event):
+            path = event.path.strip("/")
+            if path == "":
+                # the whole node has been replaced (also sent first on subscribe) or patched
+                if event.event_type == "put":
+                    callback(set(event.data.keys()) if isinstance(event.data, dict) else set(), {})
+                elif isinstance(event.data, dict):
+                    callback(None, {user_id: value is not None for user_id, value in event.data.items()})
+            else:
+                # single user (or something inside user record) has changed
+                user_id, _, subpath = path.partition("/")
+                if subpath == "":
+                    callback(None, {user_id: event.data is not None})
+                elif event.data is not None:
+                    callback(None, {user_id: True})
+
+        try:
+            registration = self._ref("invited_users").listen(on_event)
+        except Exception as e:
+            logging.warning(f"Could not listen to invited users: {e}")
+            return None
+        return registration.close
+
+    def is_user_invited(self, user_id: int) -> bool:
+        return self._ref(f"invited_users/{user_id}").get() is not None
+
+    def set_user_invited(self, user_id: int, invited: bool) -> None:
+        if invited:
+            self._ref(f"invited_users/{user_id}").set(True)
+        else:
+            self._ref(f"invited_users/{user_id}").delete()
+
+    def get_profile(self, user_id: int) -> Dict[str, Any]:
+        return {"timezone": self._ref(f"users/{user_id}/timezone").get()}
+
+    def update_profile(self, user_id: int, fields: Dict[str, Any]) -> None:
+        updates = {f"users/{user_id}/{key}": value for key, value in fields.items()}
+        if "timezone" in fields:
+            updates[f"user_timezones/{user_id}"] = fields["timezone"]
+        self._ref().update(updates)
+
+    def get_user_timezones(self) -> Dict[int, str]:
+        timezones = self._ref("user_timezones").get()
+        if timezones is None:
+            # index does not exist yet, build it from profiles once
+            timezones = {}
+            for user_id in self.iter_user_ids():
+                timezone = self._ref(f"users/{user_id}/timezone").get()
+                if timezone is not None:
+                    timezones[str(user_id)] = timezone
+            self._ref("user_timezones").set(timezones)
+        return {int(user_id): timezone for user_id, timezone in _children(timezones)}
+
+    def has_entries_on(self, user_id: int, date: str) -> bool:
+        return self._ref(f"users/{user_id}/by_date/{date}").get(shallow=True) is not None
+
+    def get_message_date(self, user_id: int, message_id: int) -> Optional[str]:
+        date = self._ref(f"users/{user_id}/message_date/{message_id}").get()
+        return date if isinstance(date, str) else None
+
+    def get_entry(self, user_id: int, date: str, message_id: int) -> Optional[Dict[str, Any]]:
+        content = self._ref(f"users/{user_id}/by_date/{date}/{message_id}").get()
+        return content if isinstance(content, dict) else None
+
+    def write_entries(self, writes: List[EntryWrite]) -> None:
+        # single multi-path update
+        updates: Dict[str, Any] = {}
+        new_counts: Dict[Tuple[int, str], int] = {}
+        for write in writes:
+            updates[f"users/{write.user_id}/by_date/{write.date}/{write.message_id}"] = write.content
+            updates[f"users/{write.user_id}/message_date/{write.message_id}"] = write.date
+            # idempotent, so it is written by edits and replays as well
+            updates[f"users/{write.user_id}/stats/days/{write.date}"] = True
+            if write.is_new:
+                new_counts[write.user_id, write.date] = new_counts.get((write.user_id, write.date), 0) + 1
+        new_month_counts: Dict[Tuple[int, str], int] = {}
+        for (user_id, date), count in new_counts.items():
+            # server-side increment, so that concurrent writers do not lose counts
+            updates[f"users/{user_id}/month_index/{date[:7]}/{date}"] = {".sv": {"increment": count}}
+            new_month_counts[user_id, date[:7]] = new_month_counts.get((user_id, date[:7]), 0) + count
+        new_user_counts: Dict[int, int] = {}
+        for (user_id, month), count in new_month_counts.items():
+            updates[f"users/{user_id}/stats/months/{month}"] = {".sv": {"increment": count}}
+            new_user_counts[user_id] = new_user_counts.get(user_id, 0) + count
+        for user_id, count in new_user_counts.items():
+            updates[f"users/{user_id}/stats/entries"] = {".sv": {"increment": count}}
+        if updates:
+            self._ref().update(updates)
+
+    def get_entry_counts(self, user_id: int, month: str) -> Dict[str, int]:
+        counts = self._ref(f"users/{user_id}/month_index/{month}").get()
+        return {date: int(count) for date, count in _children(counts)}
+
+    def rebuild_month_index(self, user_id: int) -> None:
+        index: Dict[str, Dict[str, int]] = {}
+        for entry in self.iter_entries(user_id):
+            month = index.setdefault(entry.date[:7], {})
+            month[entry.date] = month.get(entry.date, 0) + 1
+        self._ref(f"users/{user_id}/month_index").set(index)
+
+    def get_aggregates(self, user_id: int) -> Aggregates:
+        stats = self._ref(f"users/{user_id}/stats").get()
+        if not isinstance(stats, dict):
+            return Aggregates(0, {}, [])
+        months = {month: int(count) for month, count in _children(stats.get("months"))}
+        days = sorted(date for date, _ in _children(stats.get("days")))
+        return Aggregates(int(stats.get("entries", 0)), months, days)
+
+    def rebuild_aggregates(self, user_id: int) -> None:
+        aggregates = aggregate(self.iter_entries(user_id))
+        self._ref(f"users/{user_id}/stats").set({
+            "entries": aggregates.entries,
+            "months": aggregates.months,
+            "days": {date: True for date in aggregates.days},
+        })
+
+    def update_entry(self, user_id: int, date: str, message_id: int, fields: Dict[str, Any]) -> None:
+        self._ref(f"users/{user_id}/by_date/{date}/{message_id}").update(fields)
+
+    def iter_user_ids(self) -> Iterator[int]:
+        users = self._ref("users").get(shallow=True)
+        for key, _ in _children(users):
+            if key.isdigit():
+                yield int(key)
+
+    def iter_entries(
+            self, user_id: int, start_date: Optional[str] = None, end_date: Optional[str] = None, page_size: int = 100
+    ) -> Iterator[EntryWrite]:
+        ref = self._ref(f"users/{user_id}/by_date")
+        last_date: Optional[str] = None
+        while True:
+            # key-ordered range query of the next `page_size` dates
+            query = ref.order_by_key()
+            start = start_date if last_date is None else last_date
+            if start is not None:
+                query = query.start_at(start)
+            if end_date is not None:
+                query = query.end_at(end_date)
+            # `start_at` is inclusive, so the last date of previous page is read again
+            limit = page_size if last_date is None else page_size + 1
+            days = query.limit_to_first(limit).get() or {}
+            dates = [date for date in days if date != last_date]
+            for date in dates:
+                for message_id, content in sorted(_children(days[date]), key=lambda item: int(item[0])):
+                    yield EntryWrite(user_id, date, int(message_id), content)
+            if len(days) < limit or not dates:
+                return
+            last_date = dates[-1]
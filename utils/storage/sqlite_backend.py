@@ -0,0 +1,210 @@
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from utils.storage.backend import StorageBackend, EntryWrite, Aggregates
+
+schema = """
+CREATE TABLE IF NOT EXISTS entries (
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (user_id, date, message_id)
+);
+CREATE TABLE IF NOT EXISTS message_dates (
+    user_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    PRIMARY KEY (user_id, message_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS profiles (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invited_users (
+    user_id INTEGER PRIMARY KEY
+);
+"""
+
+
+def _set_path(data: Dict[str, Any], path: str, value: Any) -> None:
+    """
+    Sets value at slash-separated path inside nested dicts, same as Firebase does. `None` removes value.
+    """
+    *parents, key = path.split("/")
+    for parent in parents:
+        data = data.setdefault(parent, {})
+    if value is None:
+        data.pop(key, None)
+    else:
+        data[key] = value
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Backend storing data in a local SQLite database in WAL mode.
+
+    Every thread gets its own connection, so that readers do not block each other.
+    Month index is not stored, entries are counted using primary key index instead.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: path to database file
+        """
+        self.path = path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        with self._conn() as conn:
+            conn.executescript(schema)
+
+    def _conn(self) -> sqlite3.Connection:
+        """
+        :return: connection of current thread
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL is consistent on crash with `NORMAL`, only last transactions may be lost on power loss
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def get_invited_user_ids(self) -> Set[str]:
+        rows = self._conn().execute("SELECT user_id FROM invited_users").fetchall()
+        return {str(user_id) for user_id, in rows}
+
+    def is_user_invited(self, user_id: int) -> bool:
+        row = self._conn().execute("SELECT 1 FROM invited_users WHERE user_id = ?", (user_id,)).fetchone()
+        return row is not None
+
+    def set_user_invited(self, user_id: int, invited: bool) -> None:
+        with self._conn() as conn:
+            if invited:
+                conn.execute("INSERT OR IGNORE INTO invited_users (user_id) VALUES (?)", (user_id,))
+            else:
+                conn.execute("DELETE FROM invited_users WHERE user_id = ?", (user_id,))
+
+    def get_profile(self, user_id: int) -> Dict[str, Any]:
+        row = self._conn().execute("SELECT data FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        profile = {"timezone": None}
+        if row is not None:
+            profile.update(json.loads(row[0]))
+        return profile
+
+    def update_profile(self, user_id: int, fields: Dict[str, Any]) -> None:
+        with self._conn() as conn:
+            row = conn.execute("SELECT data FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+            data = json.loads(row[0]) if row is not None else {}
+            data.update(fields)
+            conn.execute(
+                "INSERT OR REPLACE INTO profiles (user_id, data) VALUES (?, ?)", (user_id, json.dumps(data))
+            )
+
+    def get_user_timezones(self) -> Dict[int, str]:
+        rows = self._conn().execute(
+            "SELECT user_id, json_extract(data, '$.timezone') FROM profiles "
+            "WHERE json_extract(data, '$.timezone') IS NOT NULL"
+        ).fetchall()
+        return dict(rows)
+
+    def has_entries_on(self, user_id: int, date: str) -> bool:
+        row = self._conn().execute(
+            "SELECT 1 FROM entries WHERE user_id = ? AND date = ? LIMIT 1", (user_id, date)
+        ).fetchone()
+        return row is not None
+
+    def get_message_date(self, user_id: int, message_id: int) -> Optional[str]:
+        row = self._conn().execute(
+            "SELECT date FROM message_dates WHERE user_id = ? AND message_id = ?", (user_id, message_id)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def get_entry(self, user_id: int, date: str, message_id: int) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT content FROM entries WHERE user_id = ? AND date = ? AND message_id = ?", (user_id, date, message_id)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def write_entries(self, writes: List[EntryWrite]) -> None:
+        # single transaction
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (user_id, date, message_id, content) VALUES (?, ?, ?, ?)",
+                [(w.user_id, w.date, w.message_id, json.dumps(w.content)) for w in writes],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO message_dates (user_id, message_id, date) VALUES (?, ?, ?)",
+                [(w.user_id, w.message_id, w.date) for w in writes],
+            )
+
+    def get_entry_counts(self, user_id: int, month: str) -> Dict[str, int]:
+        rows = self._conn().execute(
+            "SELECT date, COUNT(*) FROM entries WHERE user_id = ? AND date BETWEEN ? AND ? GROUP BY date",
+            (user_id, f"{month}-01", f"{month}-31"),
+        ).fetchall()
+        return dict(rows)
+
+    def get_aggregates(self, user_id: int) -> Aggregates:
+        conn = self._conn()
+        months = dict(conn.execute(
+            "SELECT substr(date, 1, 7), COUNT(*) FROM entries WHERE user_id = ? GROUP BY 1", (user_id,)
+        ).fetchall())
+        days = [date for date, in conn.execute(
+            "SELECT DISTINCT date FROM entries WHERE user_id = ? ORDER BY date", (user_id,)
+        ).fetchall()]
+        return Aggregates(sum(months.values()), months, days)
+
+    def update_entry(self, user_id: int, date: str, message_id: int, fields: Dict[str, Any]) -> None:
+        with self._conn() as conn:
+            row = conn.execute(
+                "SELECT content FROM entries WHERE user_id = ? AND date = ? AND message_id = ?",
+                (user_id, date, message_id),
+            ).fetchone()
+            if row is None:
+                return
+            content = json.loads(row[0])
+            for path, value in fields.items():
+                _set_path(content, path, value)
+            conn.execute(
+                "UPDATE entries SET content = ? WHERE user_id = ? AND date = ? AND message_id = ?",
+                (json.dumps(content), user_id, date, message_id),
+            )
+
+    def iter_user_ids(self) -> Iterator[int]:
+        rows = self._conn().execute(
+            "SELECT user_id FROM profiles UNION SELECT DISTINCT user_id FROM message_dates"
+        ).fetchall()
+        for user_id, in rows:
+            yield user_id
+
+    def iter_entries(
+            self, user_id: int, start_date: Optional[str] = None, end_date: Optional[str] = None, page_size: int = 100
+    ) -> Iterator[EntryWrite]:
+        # keyset pagination over primary key
+        # below every id, as imported entries have negative ones
+        date, message_id = start_date or "", -(1 << 63)
+        while True:
+            rows = self._conn().execute(
+                "SELECT date, message_id, content FROM entries "
+                "WHERE user_id = ? AND (date > ? OR (date = ? AND message_id > ?)) AND date <= ? "
+                "ORDER BY date, message_id LIMIT ?",
+                (user_id, date, date, message_id, end_date or "9999-12-31", page_size),
+            ).fetchall()
+            # also moves the cursor to the last row read
+            for date, message_id, content in rows:
+                yield EntryWrite(user_id, date, message_id, json.loads(content))
+            if len(rows) < page_size:
+                return
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
@@ -0,0 +1,173 @@
+"""
+Tables of timezones offered to users, grouped by continent, and lookup of timezone by location.
+
+They are built from `pytz.common_timezones` on first use, which reads zone files, so built tables are also saved to
+a JSON file (if `setup_cache` has been called) and loaded from it on following starts, as long as pytz version matches.
+"""
+import functools
+import json
+import logging
+import math
+import os
+import re
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import pytz
+
+cache_path: Optional[str] = None
+
+
+class TimezoneTables(NamedTuple):
+    # all valid timezone names
+    timezones: Set[str]
+    # continent (or similar, e.g. US or India) -> sorted cities
+    cities_by_continent: Dict[str, List[str]]
+    # timezone name -> (latitude, longitude) of its principal location, from `zone.tab`
+    coordinates: Dict[str, Tuple[float, float]]
+
+
+def setup_cache(path: str) -> None:
+    """
+    :param path: path of JSON file tables are cached in
+    """
+    global cache_path
+    cache_path = path
+
+
+def parse_coordinate(value: str, degree_digits: int) -> float:
+    """
+    Parses ISO 6709 coordinate of `zone.tab`, e.g. `+4230` or `-0012345` (degrees, minutes and optionally seconds)
+    """
+    sign = -1 if value[0] == "-" else 1
+    digits = value[1:]
+    degrees = int(digits[:degree_digits])
+    minutes = int(digits[degree_digits:degree_digits + 2])
+    seconds = int(digits[degree_digits + 2:] or 0)
+    return sign * (degrees + minutes / 60 + seconds / 3600)
+
+
+def read_coordinates() -> Dict[str, Tuple[float, float]]:
+    """
+    :return: timezone name -> (latitude, longitude), for timezones listed in `zone.tab` bundled with pytz
+    """
+    coordinates = {}
+    with pytz.open_resource("zone.tab") as f:
+        for line in f.read().decode().splitlines():
+            if line.startswith("#") or not line.strip():
+                continue
+            _, location, tz = line.split("\t")[:3]
+            latitude, longitude = re.match(r"([+-]\d+)([+-]\d+)", location).groups()
+            coordinates[tz] = (parse_coordinate(latitude, 2), parse_coordinate(longitude, 3))
+    return coordinates
+
+
+def build_tables() -> TimezoneTables:
+    structured_timezones: Dict[str, List[str]] = {}
+    for tz in pytz.common_timezones:
+        # skip UTC, GMT etc, as they are not geographical places
+        if "/" not in tz:
+            continue
+        #  parse into continent and city
+        #  `maxsplit` is needed as timezones with three parts exist,
+        #  e.g. `America/Kentucky/Louisville`
+        cont, city = tz.split("/", maxsplit=1)
+        structured_timezones.setdefault(cont, []).append(city)
+    common_timezones = set(pytz.common_timezones)
+    return TimezoneTables(
+        common_timezones,
+        {cont: sorted(cities) for cont, cities in sorted(structured_timezones.items())},
+        {tz: location for tz, location in read_coordinates().items() if tz in common_timezones},
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_tables() -> TimezoneTables:
+    """
+    :return: timezone tables, loaded from cache file if possible
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                data = json.load(f)
+            if data["pytz"] == pytz.__version__:
+                coordinates = {tz: tuple(location) for tz, location in data["coordinates"].items()}
+                return TimezoneTables(set(data["timezones"]), data["cities_by_continent"], coordinates)
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Ignoring timezone cache: {e}")
+    tables = build_tables()
+    if cache_path is not None:
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "pytz": pytz.__version__,
+                    "timezones": sorted(tables.timezones),
+                    "cities_by_continent": tables.cities_by_continent,
+                    "coordinates": tables.coordinates,
+                },
+                f,
+            )
+        os.replace(tmp_path, cache_path)
+    return tables
+
+
+def _unit_vector(latitude: float, longitude: float) -> Tuple[float, float, float]:
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    return math.cos(latitude) * math.cos(longitude), math.cos(latitude) * math.sin(longitude), math.sin(latitude)
+
+
+class ZoneLocator(object):
+    """
+    Nearest neighbour search of timezones by location.
+
+    Principal locations of timezones are put on a unit sphere, where straight-line distance between points grows with
+    distance along the surface, and indexed by a KD-tree. Resolved timezone is the one with the nearest location,
+    which is right for all but places close to timezone borders.
+    """
+
+    def __init__(self, coordinates: Dict[str, Tuple[float, float]]):
+        """
+        :param coordinates: timezone name -> (latitude, longitude)
+        """
+        points = [(_unit_vector(latitude, longitude), tz) for tz, (latitude, longitude) in coordinates.items()]
+        self._root = self._build(points, 0)
+
+    def _build(self, points: list, depth: int) -> Optional[tuple]:
+        """
+        :return: node as (point, timezone, split axis, left subtree, right subtree)
+        """
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda item: item[0][axis])
+        middle = len(points) // 2
+        point, tz = points[middle]
+        return point, tz, axis, self._build(points[:middle], depth + 1), self._build(points[middle + 1:], depth + 1)
+
+    def nearest(self, latitude: float, longitude: float) -> Optional[str]:
+        """
+        :return: name of timezone with the nearest location, `None` if there are no timezones
+        """
+        # (squared distance, timezone) of the nearest point found so far
+        best = [math.inf, None]
+        self._search(self._root, _unit_vector(latitude, longitude), best)
+        return best[1]
+
+    def _search(self, node: Optional[tuple], target: Tuple[float, float, float], best: list) -> None:
+        if node is None:
+            return
+        point, tz, axis, left, right = node
+        distance = sum((a - b) ** 2 for a, b in zip(point, target))
+        if distance < best[0]:
+            best[0], best[1] = distance, tz
+        offset = target[axis] - point[axis]
+        near, far = (left, right) if offset < 0 else (right, left)
+        self._search(near, target, best)
+        # the other side may only contain a nearer point, if splitting plane is nearer than the best point
+        if offset ** 2 < best[0]:
+            self._search(far, target, best)
+
+
+@functools.lru_cache(maxsize=None)
+def get_locator() -> ZoneLocator:
+    return ZoneLocator(get_tables().coordinates)
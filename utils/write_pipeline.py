@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class WritePipeline(object):
+    """
+    Write-behind pipeline, that coalesces keyed updates (e.g. multi-path updates) into periodic flushes.
+
+    Updates are merged into a single pending batch (by `merge`, by default later values for the same key win),
+    which is flushed once it holds `max_batch_size` keys or once its oldest update has waited for `max_delay` seconds.
+    Every submitted update gets a `Future`, that completes when its batch has been written.
+
+    If a batch cannot be written, it is written again group by group (e.g. by user), so that a single bad update
+    fails only the futures of its group.
+    """
+
+    # number of groups that may fail in a row, before the rest of failed batch is failed without being written
+    max_failed_groups = 3
+
+    def __init__(
+            self,
+            flush: Callable[[Dict[Hashable, Any]], None],
+            max_batch_size: int = 500,
+            max_delay: float = 0.2,
+            merge: Optional[Callable[[Any, Any], Any]] = None,
+            group: Optional[Callable[[Hashable], Hashable]] = None,
+    ):
+        """
+        :param flush: function that writes a merged update to db
+        :param max_batch_size: number of pending keys that triggers a flush
+        :param max_delay: max time (in seconds) an update may wait before being flushed
+        :param merge: function of pending and later value of a key, that returns the value to be written
+        :param group: function of a key, that returns the group it is written again with if its batch fails
+        """
+        self._flush = flush
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._merge = merge or (lambda pending, value: value)
+        self._group = group or (lambda key: key)
+        self._pending: Dict[Hashable, Any] = {}
+        # futures of submitted updates, with their keys
+        self._futures: List[Tuple[Future, List[Hashable]]] = []
+        self._oldest: Optional[float] = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="write_pipeline", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def submit(self, updates: Dict[Hashable, Any]) -> Future:
+        """
+        Schedules update to be written.
+
+        :param updates: key (e.g. path relative to db root) -> value
+        :return: future, that completes once update has been written (or raises, if write failed)
+        """
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write pipeline has been closed")
+            for key, value in updates.items():
+                self._pending[key] = self._merge(self._pending[key], value) if key in self._pending else value
+            self._futures.append((future, list(updates)))
+            if self._oldest is None:
+                # first pending update, let flusher start counting down
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            elif len(self._pending) >= self.max_batch_size:
+                self._cond.notify()
+        return future
+
+    def close(self) -> None:
+        """
+        Flushes pending updates and stops the pipeline
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+        else:
+            # pipeline has not been started, flush on caller's thread
+            self._flush_pending()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed and not self._is_due():
+                    timeout = None if self._oldest is None else self._oldest + self.max_delay - time.monotonic()
+                    self._cond.wait(timeout)
+                closed = self._closed
+            self._flush_pending()
+            if closed:
+                return
+
+    def _is_due(self) -> bool:
+        if self._oldest is None:
+            return False
+        return len(self._pending) >= self.max_batch_size or time.monotonic() - self._oldest >= self.max_delay
+
+    def _flush_pending(self) -> None:
+        # take pending batch
+        with self._cond:
+            batch, futures = self._pending, self._futures
+            self._pending, self._futures, self._oldest = {}, [], None
+        if not futures:
+            return
+        # write it
+        try:
+            self._flush(batch)
+        except Exception as e:
+            logging.error(f"Failed to flush {len(batch)} keys, writing them by group: {e}")
+            errors = self._flush_groups(batch, e)
+        else:
+            logging.debug(f"Flushed {len(batch)} keys of {len(futures)} writes.")
+            errors = {}
+        for future, keys in futures:
+            error = next((errors[key] for key in keys if key in errors), None)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+    def _flush_groups(self, batch: Dict[Hashable, Any], error: Exception) -> Dict[Hashable, Exception]:
+        """
+        Writes failed batch again group by group
+
+        :param error: error of writing the whole batch
+        :return: key -> error, for keys that have not been written
+        """
+        groups: Dict[Hashable, Dict[Hashable, Any]] = {}
+        for key, value in batch.items():
+            groups.setdefault(self._group(key), {})[key] = value
+        if len(groups) == 1:
+            return dict.fromkeys(batch, error)
+        errors: Dict[Hashable, Exception] = {}
+        failed_in_row = 0
+        for updates in groups.values():
+            if failed_in_row >= self.max_failed_groups:
+                # db is likely unavailable, rather than some updates bad
+                errors.update(dict.fromkeys(updates, error))
+                continue
+            try:
+                self._flush(updates)
+            except Exception as e:
+                errors.update(dict.fromkeys(updates, e))
+                failed_in_row += 1
+            else:
+                failed_in_row = 0
+        failed_groups = len({self._group(key) for key in errors})
+        logging.error(f"Failed to flush {failed_groups} of {len(groups)} groups.")
+        return errors
@@ -0,0 +1,201 @@
+"""
+Webhook ingestion mode, alternative to long polling.
+
+Telegram pushes updates to a built-in HTTP server, which puts them straight into dispatcher's (bounded) update queue.
+When the queue is full, the server answers 503 so that Telegram redelivers the update later.
+
+To test locally, start the bot with `INGEST_MODE=webhook` and POST a recorded update:
+
+    curl -X POST -H "Content-Type: application/json" \
+         -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+         --data @update.json http://127.0.0.1:8443/$WEBHOOK_PATH
+"""
+import hmac
+import json
+import logging
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue, Full
+from signal import signal, SIGINT, SIGTERM, SIGABRT
+from typing import Optional
+
+from telegram import Update
+from telegram.ext import Updater
+
+secret_token_header = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to `WebhookServer`
+    """
+
+    server: "_HTTPServer"
+    # max time (in seconds) a read of request may block, so that stalled clients do not hold threads forever
+    timeout = 10
+
+    def do_GET(self):
+        webhook = self.server.webhook
+        if self.path != "/healthz":
+            self._reply(404)
+            return
+        is_healthy = webhook.dispatcher.running
+        self._reply(200 if is_healthy else 503, {
+            "status": "ok" if is_healthy else "unavailable",
+            "queue_size": webhook.update_queue.qsize(),
+            "max_queue_size": webhook.update_queue.maxsize,
+        })
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path.strip("/") != webhook.url_path:
+            self._reply(404)
+            return
+        # validate secret token
+        if webhook.secret_token is not None:
+            token = self.headers.get(secret_token_header, "")
+            if not hmac.compare_digest(token.encode(), webhook.secret_token.encode()):
+                self._reply(403)
+                return
+        # validate body size
+        length = self.headers.get("Content-Length")
+        if length is None or not length.isdigit():
+            self._reply(411)
+            return
+        if int(length) > webhook.max_body_size:
+            self._reply(413)
+            return
+        # read body, which may be shorter than announced
+        try:
+            body = self.rfile.read(int(length))
+        except socket.timeout:
+            logging.debug("Webhook request body has not been received in time.")
+            self.close_connection = True
+            self._reply(408)
+            return
+        # parse update
+        try:
+            data = json.loads(body)
+            update = Update.de_json(data, webhook.bot)
+        except Exception as e:
+            logging.debug(f"Invalid webhook update: {e}")
+            self._reply(400)
+            return
+        if update is None or not webhook.dispatcher.running:
+            self._reply(503)
+            return
+        # push into dispatcher
+        try:
+            webhook.update_queue.put_nowait(update)
+        except Full:
+            logging.warning("Update queue is full, asking Telegram to redeliver.")
+            self._reply(503)
+            return
+        self._reply(200)
+
+    def _reply(self, code: int, body: Optional[dict] = None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Webhook: {format % args}")
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, webhook: "WebhookServer"):
+        super().__init__(address, WebhookRequestHandler)
+        self.webhook = webhook
+
+
+class WebhookServer(object):
+    """
+    Runs `Updater`'s dispatcher, fed by a built-in HTTP server instead of polling.
+    """
+
+    def __init__(
+            self,
+            updater: Updater,
+            listen: str = "127.0.0.1",
+            port: int = 8443,
+            url_path: str = "",
+            webhook_url: Optional[str] = None,
+            secret_token: Optional[str] = None,
+            max_body_size: int = 1 << 20,
+            max_queue_size: int = 1000,
+            drain_timeout: float = 10.0,
+    ):
+        """
+        :param updater: updater, whose dispatcher will process updates
+        :param listen: address to listen on
+        :param port: port to listen on
+        :param url_path: path that Telegram posts updates to
+        :param webhook_url: public url of webhook, if given it is registered with Telegram on start
+        :param secret_token: if given, requests without matching `X-Telegram-Bot-Api-Secret-Token` are rejected
+        :param max_body_size: max size (in bytes) of a single update
+        :param max_queue_size: max number of updates waiting for dispatcher
+        :param drain_timeout: max time (in seconds) to wait for queued updates on shutdown
+        """
+        self.updater = updater
+        self.bot = updater.bot
+        self.dispatcher = updater.dispatcher
+        self.address = (listen, port)
+        self.url_path = url_path.strip("/")
+        self.webhook_url = webhook_url
+        self.secret_token = secret_token
+        self.max_body_size = max_body_size
+        self.drain_timeout = drain_timeout
+        self.update_queue: Queue = Queue(max_queue_size)
+        self._httpd: Optional[_HTTPServer] = None
+        self._stop_event = threading.Event()
+
+    def start(self) -> None:
+        """
+        Starts dispatcher, job queue and HTTP server
+        """
+        # make dispatcher consume bounded queue, has to be done before it is started
+        self.dispatcher.update_queue = self.updater.update_queue = self.update_queue
+        self.updater.job_queue.start()
+        dispatcher_ready = threading.Event()
+        threading.Thread(
+            target=self.dispatcher.start, name="dispatcher", kwargs={"ready": dispatcher_ready}
+        ).start()
+        dispatcher_ready.wait()
+
+        self._httpd = _HTTPServer(self.address, self)
+        threading.Thread(target=self._httpd.serve_forever, name="webhook", daemon=True).start()
+        logging.info(f"Listening for webhook updates on {self.address[0]}:{self.address[1]}/{self.url_path}")
+
+        if self.webhook_url is not None:
+            api_kwargs = {"secret_token": self.secret_token} if self.secret_token is not None else None
+            self.bot.set_webhook(self.webhook_url, api_kwargs=api_kwargs)
+
+    def idle(self, stop_signals=(SIGINT, SIGTERM, SIGABRT)) -> None:
+        """
+        Blocks until one of the signals is received, then stops. Counterpart of `Updater.idle`.
+        """
+        for sig in stop_signals:
+            signal(sig, lambda signum, frame: self._stop_event.set())
+        while not self._stop_event.wait(1):
+            pass
+        self.stop()
+
+    def stop(self) -> None:
+        """
+        Stops accepting updates, lets dispatcher process queued ones and stops it
+        """
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+        deadline = time.monotonic() + self.drain_timeout
+        while not self.update_queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.updater.stop()